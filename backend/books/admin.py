@@ -1,10 +1,18 @@
+import os
 import math
 
-from django.contrib import admin
+from django.contrib import admin, messages
 from django import forms
-from django.utils.html import mark_safe
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, mark_safe
 
-from books.models import Book, BookLlm, Image, BookFile
+from django.conf import settings
+
+from books import search
+from books.regeneration import regenerate_books_in_background
+from books.models import Book, BookLlm, Image, BookFile, RequestProfile
 
 
 class ImageInlineForm(forms.ModelForm):
@@ -31,8 +39,10 @@ class ImageInline(admin.TabularInline):
 
     def resize_illustration(self, obj):
         if obj.illustration:
-            width = obj.illustration.width
-            height = obj.illustration.height
+            # Rows without metadata are filled by backfill_image_metadata, the file is not decoded here
+            if not (obj.width and obj.height):
+                return '—'
+            width, height = obj.width, obj.height
             max_size = max(width, height)
             if max_size > 100:
                 proportion_side = math.ceil(max_size / 100)
@@ -53,26 +63,84 @@ class BookLlmInline(admin.StackedInline):
     extra = 0
 
 
+def _start_regeneration(model_admin, request, book_ids, **options):
+    book_ids = sorted(set(book_ids))
+    regenerate_books_in_background(book_ids, **options)
+    model_admin.message_user(
+        request,
+        f'Regeneration of {len(book_ids)} books started with {settings.REGENERATION_WORKERS} workers, '
+        'the progress is in the server log and the new files appear among the book files.',
+        messages.SUCCESS,
+    )
+
+
+class RequestProfileInline(admin.TabularInline):
+    model = RequestProfile
+    extra = 0
+    classes = ['collapse']
+    fields = ('profile_link', 'created', 'method', 'path', 'duration', 'trigger', 'profiler')
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def profile_link(self, obj):
+        return format_html('<a href="{}">{}</a>', reverse('admin:books_requestprofile_change', args=[obj.pk]), obj.pk)
+    profile_link.short_description = 'Profile'
+
+
 @admin.register(Book)
 class BookAdmin(admin.ModelAdmin):
     list_display = ['pk', 'book_title', 'author']
-    inlines = [BookLlmInline, BookFileInline, ImageInline]
+    inlines = [BookLlmInline, BookFileInline, ImageInline, RequestProfileInline]
+    actions = ['regenerate_illustrations', 'rebuild_files']
+    # Used only without a full-text index, the text is compressed and cannot be matched with LIKE
+    search_fields = ['title', 'author']
+
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.enabled():
+            return queryset.filter(pk__in=search.search_book_ids(search_term, limit=None)), False
+        return super().get_search_results(request, queryset, search_term)
 
     def book_title(self, obj):
         return f'{obj.title[:30]}...' if len(obj.title) > 30 else obj.title
     book_title.short_description = 'Book Title'
 
+    @admin.action(description='Regenerate illustrations and files of selected books')
+    def regenerate_illustrations(self, request, queryset):
+        _start_regeneration(self, request, queryset.values_list('pk', flat=True))
+
+    @admin.action(description='Rebuild files of selected books (keep illustrations)')
+    def rebuild_files(self, request, queryset):
+        _start_regeneration(self, request, queryset.values_list('pk', flat=True), images=False)
+
 
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
-    list_display = ['pk', 'thumb_photo', 'book_title', 'title']
-    fields = ('status', 'title', 'book', 'resize_illustration', 'illustration', 'image_prompt', 'created', 'modified')
-    readonly_fields = ['created', 'modified', 'resize_illustration']
+    list_display = ['pk', 'thumb_photo', 'book_title', 'title', 'source']
+    list_filter = ['source']
+    fields = ('status', 'title', 'book', 'resize_illustration', 'illustration', 'original', 'image_prompt', 'source',
+              'width', 'height', 'file_size', 'image_format', 'content_hash', 'created', 'modified')
+    readonly_fields = ['created', 'modified', 'resize_illustration', 'source',
+                       'width', 'height', 'file_size', 'image_format', 'content_hash']
+    search_fields = ['image_prompt', 'title']
+    actions = ['regenerate_images']
+
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.enabled():
+            return queryset.filter(pk__in=search.search_image_ids(search_term, limit=None)), False
+        return super().get_search_results(request, queryset, search_term)
 
     def book_title(self, obj):
         return f'{obj.book.title[:30]}...' if len(obj.book.title) > 30 else obj.book.title
     book_title.short_description = 'Book Title'
 
+    @admin.action(description='Regenerate selected illustrations and the files of their books')
+    def regenerate_images(self, request, queryset):
+        image_ids = list(queryset.values_list('pk', flat=True))
+        _start_regeneration(self, request, queryset.values_list('book_id', flat=True), image_ids=image_ids)
+
     def thumb_photo(self, obj):
         if obj.illustration:
             return mark_safe(f'<img src="{obj.illustration.url}" width="100">')
@@ -81,8 +149,10 @@ class ImageAdmin(admin.ModelAdmin):
 
     def resize_illustration(self, obj):
         if obj.illustration:
-            width = obj.illustration.width
-            height = obj.illustration.height
+            # Rows without metadata are filled by backfill_image_metadata, the file is not decoded here
+            if not (obj.width and obj.height):
+                return '—'
+            width, height = obj.width, obj.height
             max_size = max(width, height)
             if max_size > 500:
                 proportion_side = math.ceil(max_size / 500)
@@ -108,4 +178,42 @@ class BookLlmAdmin(admin.ModelAdmin):
 
     def book_title(self, obj):
         return f'{obj.book.title[:30]}...' if len(obj.book.title) > 30 else obj.book.title
-    book_title.short_description = 'Book Title'
\ No newline at end of file
+    book_title.short_description = 'Book Title'
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'created', 'method', 'path', 'status_code', 'duration', 'trigger', 'profiler', 'book']
+    list_filter = ['trigger', 'profiler', 'method']
+    fields = ('book', 'created', 'method', 'path', 'status_code', 'duration', 'trigger', 'profiler',
+              'memory_peak', 'download', 'report_text')
+    readonly_fields = fields
+    raw_id_fields = ['book']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        # Profiles show code paths, they are downloaded through the admin and not from public media
+        download = self.admin_site.admin_view(self.download_view)
+        return [path('<int:pk>/download/', download, name='books_requestprofile_download')] + super().get_urls()
+
+    def download_view(self, request, pk):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        if not self.has_view_permission(request, profile) or not profile.file:
+            raise Http404
+        _, extension = os.path.splitext(profile.file.name)
+        return FileResponse(profile.file.open('rb'), as_attachment=True, filename=f'profile_{profile.pk}{extension}')
+
+    def download(self, obj):
+        if obj.file:
+            return format_html('<a href="{}">Download</a>', reverse('admin:books_requestprofile_download', args=[obj.pk]))
+        return None
+    download.short_description = 'Profile file'
+
+    def report_text(self, obj):
+        return format_html('<pre style="font-size: 12px; overflow-x: auto">{}</pre>', obj.report)
+    report_text.short_description = 'Report'
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BooksConfig(AppConfig):
     name = 'books'
+
+    def ready(self):
+        # Keeps the full-text search index up to date
+        from . import signals  # noqa: F401
@@ -0,0 +1,39 @@
+import time
+
+
+class Deadline:
+    """
+    Latency budget of one request and the record of what was simplified to meet it.
+    """
+
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.degraded = {}
+
+    def reserve(self, seconds):
+        """
+        Deadline that expires `seconds` earlier, e.g. to leave time for rendering.
+        It records into the same report.
+        """
+        deadline = Deadline(self.budget)
+        deadline.expires_at = self.expires_at - seconds
+        deadline.degraded = self.degraded
+        return deadline
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def timeout_ms(self, reserve=0):
+        """
+        Remaining time minus reserve in milliseconds, as the genai HTTP timeout.
+        """
+        return max(int((self.remaining() - reserve) * 1000), 1)
+
+    def note(self, key, value):
+        self.degraded.setdefault(key, []).append(value)
+
+    def report(self):
+        if not self.degraded:
+            return {}
+        return {'latency_budget': self.budget, **self.degraded}
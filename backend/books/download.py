@@ -0,0 +1,100 @@
+import re
+import mimetypes
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """
+    Returns (start, end) of a single byte range of the Range header, both inclusive.
+    None means the whole file: no header, several ranges or an invalid one, which may be ignored.
+    False means the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+
+    if not first:
+        # bytes=-500 is the last 500 bytes
+        suffix = int(last)
+        return (max(size - suffix, 0), size - 1) if suffix and size else False
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, end
+
+
+def iter_range(file, start, length):
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def sendfile_response(field_file, filename):
+    """
+    An empty response that tells the front proxy to send the file itself
+    (SENDFILE_BACKEND = 'x-accel-redirect' for nginx, 'x-sendfile' for Apache and others).
+    The proxy also serves Range requests then.
+    """
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = HttpResponse(content_type=content_type)
+    if settings.SENDFILE_BACKEND == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = quote(f"{settings.SENDFILE_URL}{field_file.name}")
+    else:
+        response['X-Sendfile'] = field_file.path
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+def file_response(request, field_file, filename, etag=''):
+    """
+    Sends a stored file as an attachment, honouring Range and If-Range headers,
+    or offloads it to the front proxy when SENDFILE_BACKEND is set.
+    """
+    if settings.SENDFILE_BACKEND:
+        return sendfile_response(field_file, filename)
+
+    size = field_file.size
+    byte_range = parse_range(request.headers.get('Range'), size)
+    # A range of an older version of the file would be spliced into the new one
+    if_range = request.headers.get('If-Range')
+    if byte_range is not None and if_range and if_range != f'"{etag}"':
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(field_file.open('rb'), as_attachment=True, filename=filename)
+    else:
+        start, end = byte_range
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = StreamingHttpResponse(
+            iter_range(field_file.open('rb'), start, end - start + 1), status=206, content_type=content_type
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Accept-Ranges'] = 'bytes'
+    return response
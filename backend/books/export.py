@@ -0,0 +1,243 @@
+import os
+import json
+import asyncio
+import uuid
+import base64
+import hashlib
+import zipfile
+import mimetypes
+from datetime import datetime, timezone
+from html import escape
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import pdf
+from .models import BookFile
+
+
+def create_pdf(book_data, output_filename="generated_book.pdf"):
+    pdf.layout_cache.resize(settings.PDF_LAYOUT_CACHE_BYTES)
+    pdf.create_pdf(
+        book_data,
+        output_filename,
+        workers=settings.PDF_RENDER_WORKERS,
+        min_parallel_items=settings.PDF_PARALLEL_MIN_ITEMS,
+    )
+
+
+def _text_to_html(text):
+    return escape(text).replace("\n", "<br/>")
+
+
+HTML_STYLE = """
+body { font-family: 'DejaVu Sans', sans-serif; font-size: 1.1em; line-height: 1.4; max-width: 40em; margin: 0 auto; padding: 1em; }
+h1, h2 { text-align: center; }
+figure { margin: 1em 0; text-align: center; }
+img { max-width: 100%; height: auto; }
+"""
+
+
+def create_html(book_data, output_filename="generated_book.html"):
+    """
+    Creates a single self-contained HTML file. Images are embedded as data URIs
+    and encoded chunk by chunk, so no file is ever fully held in memory.
+    """
+    print(f"🌐 Create an HTML: {output_filename}...")
+    title = book_data.get("title", "Book")
+    author = book_data.get("author", "")
+
+    with open(output_filename, 'w', encoding='utf-8') as out:
+        out.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8"/>\n')
+        # <title> takes text only, the line breaks of _text_to_html are for the body
+        out.write(f'<title>{escape(title)}</title>\n<style>{HTML_STYLE}</style>\n</head>\n<body>\n')
+        out.write(f'<h1>{_text_to_html(title)}</h1>\n<h2>{_text_to_html(author)}</h2>\n')
+
+        for item in book_data.get("content", []):
+            if item["type"] == "text":
+                out.write(f'<p>{_text_to_html(item["data"])}</p>\n')
+            elif item["type"] == "image_prompt" and "image_path" in item:
+                img_path = item["image_path"]
+                if not os.path.exists(img_path):
+                    continue
+                mime_type = mimetypes.guess_type(img_path)[0] or 'image/png'
+                out.write(f'<figure><img alt="{escape(item["data"])}" src="data:{mime_type};base64,')
+                with open(img_path, 'rb') as f:
+                    # A multiple of 3 bytes keeps base64 chunks free of padding
+                    for chunk in iter(lambda: f.read(3 * 64 * 1024), b''):
+                        out.write(base64.b64encode(chunk).decode('ascii'))
+                out.write('"/></figure>\n')
+
+        out.write('</body>\n</html>\n')
+    print(f"✨ HTML is ready: {output_filename}")
+
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+EPUB_XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><meta charset="utf-8"/><title>{title}</title><link rel="stylesheet" href="style.css"/></head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def create_epub(book_data, output_filename="generated_book.epub"):
+    """
+    Creates an EPUB 3 file. Pages are written straight into the zip
+    and illustrations are copied from disk without being loaded whole.
+    """
+    print(f"📖 Create an EPUB: {output_filename}...")
+    # Escaped only: <title> and the package metadata take text, not markup
+    title = escape(book_data.get("title", "Book"))
+    author = escape(book_data.get("author", ""))
+    modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    manifest = []
+    body = [
+        f'<h1>{_text_to_html(book_data.get("title", "Book"))}</h1>',
+        f'<h2>{_text_to_html(book_data.get("author", ""))}</h2>',
+    ]
+
+    with zipfile.ZipFile(output_filename, 'w', compression=zipfile.ZIP_DEFLATED) as epub:
+        # The mimetype entry must come first and stay uncompressed
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', EPUB_CONTAINER)
+        epub.writestr('OEBPS/style.css', HTML_STYLE)
+
+        image_index = 0
+        for item in book_data.get("content", []):
+            if item["type"] == "text":
+                body.append(f'<p>{_text_to_html(item["data"])}</p>')
+            elif item["type"] == "image_prompt" and "image_path" in item:
+                img_path = item["image_path"]
+                if not os.path.exists(img_path):
+                    continue
+                image_index += 1
+                _, extension = os.path.splitext(img_path)
+                image_name = f'images/image_{image_index}{extension.lower()}'
+                mime_type = mimetypes.guess_type(img_path)[0] or 'image/png'
+                # Images are already compressed, deflating them again only costs CPU
+                epub.write(img_path, f'OEBPS/{image_name}', compress_type=zipfile.ZIP_STORED)
+                manifest.append(f'<item id="image_{image_index}" href="{image_name}" media-type="{mime_type}"/>')
+                body.append(f'<figure><img alt="{escape(item["data"])}" src="{image_name}"/></figure>')
+
+        epub.writestr('OEBPS/book.xhtml', EPUB_XHTML.format(title=title, body='\n'.join(body)))
+        epub.writestr('OEBPS/nav.xhtml', EPUB_XHTML.format(
+            title=title,
+            body=f'<nav epub:type="toc"><ol><li><a href="book.xhtml">{title}</a></li></ol></nav>',
+        ))
+        epub.writestr('OEBPS/content.opf', f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">urn:uuid:{uuid.uuid4()}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:creator>{author}</dc:creator>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="style" href="style.css" media-type="text/css"/>
+    <item id="book" href="book.xhtml" media-type="application/xhtml+xml"/>
+    {chr(10).join(manifest)}
+  </manifest>
+  <spine>
+    <itemref idref="book"/>
+  </spine>
+</package>
+""")
+    print(f"✨ EPUB is ready: {output_filename}")
+
+
+EXPORTERS = {
+    BookFile.Format.PDF: create_pdf,
+    BookFile.Format.EPUB: create_epub,
+    BookFile.Format.HTML: create_html,
+}
+
+
+def book_data_hash(book_data):
+    """
+    Hash of the structured content, used to reuse an already exported file.
+    """
+    return hashlib.sha256(json.dumps(book_data, sort_keys=True).encode()).hexdigest()
+
+
+def _cached_book_file(book, export_format, source_hash, status=BookFile.Status.PUBLISHED):
+    return book.files.filter(format=export_format, source_hash=source_hash, status=status).exclude(file='')
+
+
+def _temp_path(book, export_format, status=BookFile.Status.PUBLISHED):
+    # Create a temporary directory if it doesn't exist
+    temp_dir = os.path.join(settings.BASE_DIR, 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    # A draft, the final file and other exports of the same book can be rendered at the same time
+    suffix = '_draft' if status == BookFile.Status.DRAFT else ''
+    return os.path.join(temp_dir, f"generated_book_{book.id}{suffix}_{uuid.uuid4().hex[:8]}.{export_format}")
+
+
+def _save_book_file(book, export_format, source_hash, temp_path, status=BookFile.Status.PUBLISHED):
+    with open(temp_path, 'rb') as f:
+        book_file = BookFile(book=book, format=export_format, source_hash=source_hash, status=status)
+        book_file.file.save(os.path.basename(temp_path), f)
+    return book_file
+
+
+def export_book(book, book_data, export_format=BookFile.Format.PDF, draft=False, rebuild=False):
+    """
+    Returns a BookFile in the requested format, building it only if the book
+    has no file of that format made from the same structured content.
+    A draft file is stored with the draft status next to the final one.
+    With rebuild the file is built anyway, e.g. after a change of the layout,
+    and replaces the files it would have reused.
+    """
+    status = BookFile.Status.DRAFT if draft else BookFile.Status.PUBLISHED
+    source_hash = book_data_hash(book_data)
+    cached = _cached_book_file(book, export_format, source_hash, status)
+    book_file = None if rebuild else cached.first()
+    if book_file:
+        print(f"♻️ Reusing {export_format} file: {book_file.file.name}")
+        return book_file
+
+    temp_path = _temp_path(book, export_format, status)
+    try:
+        EXPORTERS[export_format](book_data, temp_path)
+        book_file = _save_book_file(book, export_format, source_hash, temp_path, status)
+        if rebuild:
+            for replaced in cached.exclude(pk=book_file.pk):
+                replaced.delete()
+        return book_file
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+async def aexport_book(book, book_data, export_format=BookFile.Format.PDF, draft=False):
+    """
+    Async version of export_book. Rendering runs in a worker thread,
+    so the event loop keeps serving other books meanwhile.
+    """
+    status = BookFile.Status.DRAFT if draft else BookFile.Status.PUBLISHED
+    source_hash = book_data_hash(book_data)
+    book_file = await _cached_book_file(book, export_format, source_hash, status).afirst()
+    if book_file:
+        print(f"♻️ Reusing {export_format} file: {book_file.file.name}")
+        return book_file
+
+    temp_path = _temp_path(book, export_format, status)
+    try:
+        await asyncio.to_thread(EXPORTERS[export_format], book_data, temp_path)
+        return await sync_to_async(_save_book_file)(book, export_format, source_hash, temp_path, status)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,84 @@
+import zlib
+
+from django.db import models
+
+
+# The first byte of a stored value tells how the rest is encoded
+RAW, ZLIB, ZLIB_DICTIONARY = b'\x00', b'\x01', b'\x02'
+# Values shorter than this are stored as they are, zlib would only make them longer
+MIN_COMPRESS_BYTES = 64
+
+# Preset dictionaries of CompressedTextField, zlib starts with them as if it had already seen them.
+# They help short values most. A dictionary must never change once rows were written with it,
+# add one under a new name instead.
+DICTIONARIES = {
+    # Structured books as saved by generation.save_book_llm
+    'book_llm': (
+        b'{\n  "title": "",\n  "author": "",\n  "content": [\n'
+        b'    {\n      "type": "text",\n      "data": "'
+        b'"\n    },\n    {\n      "type": "image_prompt",\n      "data": "A detailed book illustration of the following scene: '
+        b'",\n      "image_path": "/media/books/image/illustration/.png"\n    },\n'
+        b' the of and to a in was he that it his her with as had for you on at she not but said '
+    ),
+}
+
+
+def compress_text(value, dictionary=None, level=6):
+    data = value.encode('utf-8')
+    if len(data) < MIN_COMPRESS_BYTES:
+        return RAW + data
+    if dictionary:
+        compressor = zlib.compressobj(level, zdict=DICTIONARIES[dictionary])
+        return ZLIB_DICTIONARY + compressor.compress(data) + compressor.flush()
+    return ZLIB + zlib.compress(data, level)
+
+
+def decompress_text(value, dictionary=None):
+    value = bytes(value)
+    marker, data = value[:1], value[1:]
+    if marker == ZLIB:
+        data = zlib.decompress(data)
+    elif marker == ZLIB_DICTIONARY:
+        decompressor = zlib.decompressobj(zdict=DICTIONARIES[dictionary])
+        data = decompressor.decompress(data) + decompressor.flush()
+    elif marker != RAW:
+        raise ValueError(f"Unknown compressed text marker {marker!r}")
+    return data.decode('utf-8')
+
+
+class CompressedTextField(models.TextField):
+    """
+    A TextField stored as zlib-compressed bytes in a binary column.
+    Models, forms, the admin and serializers see a plain str.
+    Compressed values cannot be filtered with text lookups such as icontains.
+    """
+
+    def __init__(self, *args, dictionary=None, level=6, **kwargs):
+        if dictionary is not None and dictionary not in DICTIONARIES:
+            raise ValueError(f"Unknown compression dictionary {dictionary!r}")
+        self.dictionary = dictionary
+        self.level = level
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.dictionary is not None:
+            kwargs['dictionary'] = self.dictionary
+        if self.level != 6:
+            kwargs['level'] = self.level
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        return connection.data_types['BinaryField']
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or isinstance(value, str):
+            # Rows written before the column was compressed
+            return value
+        return decompress_text(value, self.dictionary)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super().get_db_prep_value(value, connection, prepared)
+        if value is None:
+            return None
+        return connection.Database.Binary(compress_text(value, self.dictionary, self.level))
@@ -0,0 +1,658 @@
+import os
+import json
+import uuid
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from google import genai
+from google.genai import types
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.db import connection
+
+from .export import export_book, aexport_book
+from .images import normalize_image, placeholder_image
+from .models import BookLlm, Image
+from .routing import ModelRouter
+from .scheduling import charge_images
+from .schema import parse_book_structure
+from .similarity import find_similar_image
+from .structuring import structure_locally
+
+
+client = genai.Client(api_key=settings.GEMINI_API_KEY)
+
+# Models are tried in this order until the routers have measured them
+TEXT_MODELS = ["gemini-2.5-flash", "gemini-flash-latest", "gemini-2.0-flash"]
+IMAGE_MODELS = ["gemini-2.5-flash-image"]
+
+# Side of the placeholder picture in draft books, small to keep drafts fast
+DRAFT_PLACEHOLDER_SIZE = 512
+
+# Threads that validate and convert generated pictures, while the next ones are being generated
+ingest_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_INGEST_WORKERS, thread_name_prefix='image-ingest')
+
+text_router = ModelRouter(
+    TEXT_MODELS,
+    window=settings.MODEL_STATS_WINDOW,
+    min_samples=settings.MODEL_STATS_MIN_SAMPLES,
+    hedging=settings.MODEL_HEDGING,
+)
+image_router = ModelRouter(
+    IMAGE_MODELS,
+    window=settings.MODEL_STATS_WINDOW,
+    min_samples=settings.MODEL_STATS_MIN_SAMPLES,
+    hedging=settings.MODEL_HEDGING,
+)
+
+BOOK_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    temperature=0.7
+)
+
+# The book text follows the prompt as a separate part, without copying it into the prompt string
+BOOK_PROMPT = """
+    Analyze the following text and turn it into a structure for an illustrated book.
+    Divide the text into logical parts. Between the parts of the text, add descriptions for illustrations that best fit that moment.
+
+    Return the response ONLY in JSON format:
+    {
+      "title": "Book Title",
+      "author": "Author",
+      "content": [
+        {"type": "text", "data": "A piece of text..."},
+        {"type": "image_prompt", "data": "A detailed description of what should be in the picture for this moment..."},
+        {"type": "text", "data": "The next piece of text..."}
+      ]
+    }
+
+    Make at least 5-7 illustrations for this book. The descriptions for the images (image_prompt) should be in English for better generation.
+
+    Text:
+    """
+
+
+def _with_timeout(config, deadline):
+    """
+    Limits the HTTP timeout of a genai call to what is left of the deadline.
+    """
+    if deadline is None:
+        return config
+    config = config or types.GenerateContentConfig()
+    return config.model_copy(update={"http_options": types.HttpOptions(timeout=deadline.timeout_ms())})
+
+
+def get_book_content_with_markers(text, deadline=None):
+    """
+    Sends text to Gemini and receives a structured list of blocks (text and illustration prompts).
+    A malformed answer is repaired locally, only an unusable one falls through to the next model.
+    """
+    print("🚀 Analyzing the book text and placing markers for illustrations...")
+
+    def request(model_name):
+        response = client.models.generate_content(
+            model=model_name, contents=[BOOK_PROMPT, text], config=_with_timeout(BOOK_CONFIG, deadline)
+        )
+        return parse_book_structure(response.text or '', text)
+
+    return text_router.call(request, deadline)
+
+
+async def aget_book_content_with_markers(text, deadline=None):
+    """
+    Async version of get_book_content_with_markers.
+    """
+    print("🚀 Analyzing the book text and placing markers for illustrations...")
+
+    async def request(model_name):
+        response = await client.aio.models.generate_content(
+            model=model_name, contents=[BOOK_PROMPT, text], config=_with_timeout(BOOK_CONFIG, deadline)
+        )
+        return parse_book_structure(response.text or '', text)
+
+    return await text_router.acall(request, deadline)
+
+
+def structure_book(book, deadline=None, structuring='llm'):
+    """
+    Structured content of the book from Gemini, or from local heuristics when
+    requested or when no model answered (LOCAL_STRUCTURING_FALLBACK).
+    """
+    if structuring == 'local':
+        return structure_locally(book.text, book.title, book.author)
+    try:
+        return get_book_content_with_markers(book.text, deadline)
+    except Exception as e:
+        if not settings.LOCAL_STRUCTURING_FALLBACK:
+            raise
+        print(f"  ⚠️ {e} Falling back to local structuring")
+        if deadline:
+            deadline.degraded['structuring'] = 'local'
+        return structure_locally(book.text, book.title, book.author)
+
+
+async def astructure_book(book, deadline=None, structuring='llm'):
+    """
+    Async version of structure_book.
+    """
+    if structuring == 'local':
+        return structure_locally(book.text, book.title, book.author)
+    try:
+        return await aget_book_content_with_markers(book.text, deadline)
+    except Exception as e:
+        if not settings.LOCAL_STRUCTURING_FALLBACK:
+            raise
+        print(f"  ⚠️ {e} Falling back to local structuring")
+        if deadline:
+            deadline.degraded['structuring'] = 'local'
+        return structure_locally(book.text, book.title, book.author)
+
+
+def _response_image_bytes(response):
+    if response.candidates and response.candidates[0].content.parts:
+        for part in response.candidates[0].content.parts:
+            if part.inline_data:
+                return part.inline_data.data
+    raise Exception("The response contains no image")
+
+
+def _test_image_paths():
+    test_images_dir = 'test_images'
+    return [os.path.join(test_images_dir, f) for f in os.listdir(test_images_dir) if
+            f.endswith(('.png', '.jpg', '.jpeg'))]
+
+
+def save_image(book, item, content, image_name, original=None, source=Image.Source.GENERATED):
+    """
+    Saves an illustration for the image_prompt item and adds its path to the item.
+    """
+    image_instance = Image(book=book, image_prompt=item["data"], source=source)
+    if original is not None:
+        image_instance.original.save(original.name, original, save=False)
+    image_instance.illustration.save(image_name, content, save=True)
+
+    # Add the path to the saved file to book_data
+    item["image_path"] = image_instance.illustration.path
+    print(f"    ✅ Image saved to model: {image_instance.illustration.name}")
+    return image_instance
+
+
+def ingest_image(image_bytes, image_name):
+    """
+    Validates a generated picture and converts it to IMAGE_STORAGE_FORMAT (IMAGE_STORAGE_QUALITY,
+    IMAGE_MAX_DIMENSION). Returns the content and the name to store, and the original bytes
+    to keep next to it with IMAGE_KEEP_ORIGINAL, else None. Raises ValueError for broken pictures.
+    """
+    stored, extension = normalize_image(
+        image_bytes, settings.IMAGE_STORAGE_FORMAT, settings.IMAGE_STORAGE_QUALITY, settings.IMAGE_MAX_DIMENSION
+    )
+    name = os.path.splitext(image_name)[0] + extension
+    original = None
+    if settings.IMAGE_KEEP_ORIGINAL and stored is not image_bytes:
+        original = ContentFile(image_bytes, name=image_name)
+    return ContentFile(stored), name, original
+
+
+def _save_ingested(book, pending, deadline, wait):
+    """
+    Saves the pictures of pending (future, item, number) whose conversion is done, or all with wait.
+    Returns the ones still being converted.
+    """
+    still_pending = []
+    for future, item, image_number in pending:
+        if not wait and not future.done():
+            still_pending.append((future, item, image_number))
+            continue
+        try:
+            content, image_name, original = future.result()
+        except ValueError as e:
+            print(f"    ❌ Picture {image_number}: {e}")
+            if deadline:
+                substitute_image(book, item, image_number, deadline)
+            continue
+        save_image(book, item, content, image_name, original)
+        charge_images()
+    return still_pending
+
+
+def substitute_image(book, item, image_number, deadline):
+    """
+    Stands in for an illustration that does not fit into the latency budget,
+    as set by DEADLINE_SUBSTITUTE: a placeholder, a test image or nothing.
+    """
+    print(f"  ⏭ Picture {image_number} does not fit the latency budget, using {settings.DEADLINE_SUBSTITUTE}")
+    deadline.note('substituted_images', image_number)
+
+    if settings.DEADLINE_SUBSTITUTE == 'placeholder':
+        save_image(
+            book, item, ContentFile(placeholder_image(item["data"])), f"placeholder_{book.id}_{image_number}.png",
+            source=Image.Source.PLACEHOLDER,
+        )
+    elif settings.DEADLINE_SUBSTITUTE == 'test_images':
+        image_paths = _test_image_paths()
+        if image_paths:
+            source_path = image_paths[(image_number - 1) % len(image_paths)]
+            with open(source_path, 'rb') as f:
+                save_image(book, item, File(f), os.path.basename(source_path), source=Image.Source.TEST)
+
+
+def reuse_similar_image(book, item, image_number):
+    """
+    Looks for an existing illustration of a near-duplicate prompt (IMAGE_REUSE, IMAGE_REUSE_THRESHOLD).
+    In 'suggest' mode the match is only noted in the item, in 'auto' mode its file is copied
+    for the item and True is returned, so that no new picture is generated.
+    """
+    if settings.IMAGE_REUSE not in ('suggest', 'auto'):
+        return False
+    match = find_similar_image(item["data"], settings.IMAGE_REUSE_THRESHOLD)
+    if match is None:
+        return False
+
+    image, similarity = match
+    if settings.IMAGE_REUSE == 'suggest':
+        item["similar_image"] = {"id": image.pk, "similarity": similarity}
+        print(f"  💡 Picture {image_number} could reuse picture {image.pk} (similarity {similarity:.2f})")
+        return False
+
+    print(f"  ♻️ Reusing picture {image.pk} for picture {image_number} (similarity {similarity:.2f})")
+    extension = os.path.splitext(image.illustration.name)[1]
+    # A copy, so that deleting either book does not delete the picture of the other one
+    with image.illustration.open('rb') as f:
+        save_image(book, item, File(f), f"reused_{book.id}_{image_number}{extension}", source=Image.Source.REUSED)
+    return True
+
+
+def _images_to_generate(book, book_data):
+    """
+    Numbered image_prompt items that no existing picture was reused for.
+    Reused pictures take no generation time, so they are left out of the latency budget.
+    """
+    items = [item for item in book_data.get("content", []) if item["type"] == "image_prompt"]
+    return [(number, item) for number, item in enumerate(items, start=1) if not reuse_similar_image(book, item, number)]
+
+
+def _image_limit(count, deadline, concurrent):
+    """
+    How many of count illustrations can still be generated before the deadline,
+    judging by the median latency of the image model.
+    """
+    if deadline is None:
+        return count
+
+    per_image = image_router.expected_latency() or settings.DEADLINE_IMAGE_ESTIMATE
+    available = deadline.remaining()
+    if available < per_image:
+        limit = 0
+    elif concurrent:
+        limit = count
+    else:
+        limit = min(count, int(available // per_image))
+
+    if limit < count:
+        print(f"  ⏭ Only {limit} of {count} pictures fit the latency budget")
+        deadline.degraded['illustration_limit'] = limit
+    return limit
+
+
+def generate_images(book, book_data, deadline=None):
+    """
+    Iterates through the content, finds image_prompt, generates images,
+    and saves them to the Image model.
+    With a deadline, pictures that do not fit into it are substituted.
+    """
+    print("🎨 Generating illustrations...")
+    image_deadline = deadline.reserve(settings.DEADLINE_RENDER_RESERVE) if deadline else None
+
+    items = _images_to_generate(book, book_data)
+    limit = _image_limit(len(items), image_deadline, concurrent=False)
+
+    pending = []
+    for position, (image_count, item) in enumerate(items, start=1):
+        prompt = item["data"]
+        if image_deadline and (position > limit or not image_deadline.remaining()):
+            substitute_image(book, item, image_count, image_deadline)
+            continue
+        print(f"  - Generating a picture {image_count}: {prompt[:50]}...")
+
+        def request(img_model, prompt=prompt):
+            response = client.models.generate_content(
+                model=img_model, contents=[prompt], config=_with_timeout(None, image_deadline)
+            )
+            return _response_image_bytes(response)
+
+        try:
+            image_bytes = image_router.call(request, image_deadline)
+        except Exception as e:
+            print(f"    ❌ {e}")
+            if image_deadline:
+                substitute_image(book, item, image_count, image_deadline)
+            continue
+        # Converted in the pool while the next picture is being generated
+        future = ingest_executor.submit(ingest_image, image_bytes, f"gen_{book.id}_{image_count}.png")
+        pending = _save_ingested(book, pending + [(future, item, image_count)], image_deadline, wait=False)
+
+    _save_ingested(book, pending, image_deadline, wait=True)
+    return book_data
+
+
+async def agenerate_images(book, book_data, deadline=None):
+    """
+    Async version of generate_images. Illustrations of the book are requested concurrently,
+    at most IMAGE_GENERATION_CONCURRENCY at a time to stay below the rate limits of the image model.
+    """
+    print("🎨 Generating illustrations...")
+    image_deadline = deadline.reserve(settings.DEADLINE_RENDER_RESERVE) if deadline else None
+    semaphore = asyncio.Semaphore(settings.IMAGE_GENERATION_CONCURRENCY)
+    saves = []
+
+    def save_and_charge(item, content, image_name, original):
+        save_image(book, item, content, image_name, original)
+        charge_images()
+
+    async def generate(item, image_number):
+        prompt = item["data"]
+
+        async def request(img_model):
+            response = await client.aio.models.generate_content(
+                model=img_model, contents=[prompt], config=_with_timeout(None, image_deadline)
+            )
+            return _response_image_bytes(response)
+
+        try:
+            async with semaphore:
+                print(f"  - Generating a picture {image_number}: {prompt[:50]}...")
+                image_bytes = await image_router.acall(request, image_deadline)
+            content, image_name, original = await asyncio.get_running_loop().run_in_executor(
+                ingest_executor, ingest_image, image_bytes, f"gen_{book.id}_{image_number}.png"
+            )
+            saving = asyncio.ensure_future(sync_to_async(save_and_charge)(item, content, image_name, original))
+            saves.append(saving)
+            # A save that has started is finished even if the deadline cancels this task
+            await asyncio.shield(saving)
+        except Exception as e:
+            print(f"    ❌ {e}")
+
+    items = await sync_to_async(_images_to_generate)(book, book_data)
+    limit = _image_limit(len(items), image_deadline, concurrent=True)
+    tasks = [asyncio.create_task(generate(item, number)) for number, item in items[:limit]]
+    if tasks:
+        timeout = image_deadline.remaining() if image_deadline else None
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if saves:
+            await asyncio.gather(*saves, return_exceptions=True)
+
+    if image_deadline:
+        # Items whose picture failed, did not arrive in time or was not requested; saved ones have image_path
+        for number, item in items:
+            if "image_path" not in item:
+                await sync_to_async(substitute_image)(book, item, number, image_deadline)
+    return book_data
+
+
+def regenerate_image(image):
+    """
+    Draws the illustration of an existing Image again from its prompt, replacing its file.
+    Returns the path of the replaced file, the structured text of the book still refers to it.
+    """
+    old_path = image.illustration.path if image.illustration else None
+    # The original of the previous picture, django_cleanup removes its file when the image is saved
+    image.original = ''
+    if settings.USE_TEST_IMAGES:
+        image_paths = _test_image_paths()
+        source_path = image_paths[image.pk % len(image_paths)]
+        image.source = Image.Source.TEST
+        with open(source_path, 'rb') as f:
+            image.illustration.save(os.path.basename(source_path), File(f), save=True)
+    else:
+        def request(img_model):
+            response = client.models.generate_content(model=img_model, contents=[image.image_prompt])
+            return _response_image_bytes(response)
+
+        content, image_name, original = ingest_image(image_router.call(request), f"regen_{image.book_id}_{image.pk}.png")
+        image.source = Image.Source.GENERATED
+        if original is not None:
+            image.original.save(original.name, original, save=False)
+        image.illustration.save(image_name, content, save=True)
+    print(f"    ✅ Picture {image.pk} redrawn: {image.illustration.name}")
+    return old_path
+
+
+def use_test_images(book, book_data):
+    """
+    Attaches images from the test_images folder to image_prompt items cyclically.
+    """
+    image_paths = _test_image_paths()
+    print(f"Found {len(image_paths)} test images.")
+
+    image_index = 0
+    for item in book_data.get("content", []):
+        if item["type"] == "image_prompt":
+            if image_index < len(image_paths):
+                source_path = image_paths[image_index]
+
+                # Copy the file to media and save it in the ImageField
+                with open(source_path, 'rb') as f:
+                    save_image(book, item, File(f), os.path.basename(source_path), source=Image.Source.TEST)
+
+                image_index = (image_index + 1) % len(image_paths)  # Use images cyclically
+    return book_data
+
+
+def save_book_llm(book, book_data, book_llm=None):
+    text = json.dumps(book_data, ensure_ascii=False, indent=2)
+    if book_llm is None:
+        return BookLlm.objects.create(book=book, text=text)
+    book_llm.text = text
+    book_llm.save()
+    return book_llm
+
+
+def save_degradation(book, deadline):
+    """
+    Records on the book what was simplified to meet its latency budget.
+    """
+    if deadline is not None:
+        book.degradation = deadline.report()
+        book.save(update_fields=['degradation'])
+
+
+def start_book(book, deadline=None, structuring='llm'):
+    """
+    Step 1 of the pipeline: structures the book and saves the result as BookLlm.
+    """
+    try:
+        print("Step 1: Getting book content with markers")
+        # 1. We get the structure
+        book_data = structure_book(book, deadline, structuring)
+        book_llm_instance = save_book_llm(book, book_data)
+        print("Step 1 finished")
+        return book_data, book_llm_instance
+    except Exception:
+        save_degradation(book, deadline)
+        raise
+
+
+def finish_book(book, book_data, book_llm_instance, export_format, deadline=None):
+    """
+    Steps 2 and 3 of the pipeline: illustrations and the final BookFile.
+    """
+    try:
+        if settings.USE_TEST_IMAGES:
+            print("Step 2: Using test images")
+            book_data_with_images = use_test_images(book, book_data)
+        else:
+            print("Step 2: Generating and saving images")
+            # 2. Generate and save images
+            book_data_with_images = generate_images(book, book_data, deadline)
+        # Update the BookLlm record with image paths
+        save_book_llm(book, book_data_with_images, book_llm_instance)
+        print("Step 2 finished")
+
+        print(f"Step 3: Creating {export_format.upper()}")
+        # 3. Create the book file in the requested format
+        book_file = export_book(book, book_data_with_images, export_format)
+        print("Step 3 finished")
+        return book_file
+    finally:
+        save_degradation(book, deadline)
+
+
+def generate_book(book, export_format, deadline=None, structuring='llm'):
+    """
+    Runs the whole pipeline for a saved book and returns the resulting BookFile.
+    With a deadline (books.deadline.Deadline) the pipeline degrades to fit into it.
+    """
+    book_data, book_llm_instance = start_book(book, deadline, structuring)
+    return finish_book(book, book_data, book_llm_instance, export_format, deadline)
+
+
+def draft_book_data(book_data):
+    """
+    Copy of the structured content where illustrations that are not generated yet
+    are replaced by one shared placeholder picture.
+    """
+    placeholder_path = os.path.join(settings.BASE_DIR, 'tmp', 'draft_placeholder.png')
+    if not os.path.exists(placeholder_path):
+        os.makedirs(os.path.dirname(placeholder_path), exist_ok=True)
+        temp_path = f"{placeholder_path}.{uuid.uuid4().hex}"
+        with open(temp_path, 'wb') as f:
+            f.write(placeholder_image("The illustration is being drawn...", size=DRAFT_PLACEHOLDER_SIZE))
+        os.replace(temp_path, placeholder_path)
+
+    content = [
+        {**item, "image_path": placeholder_path}
+        if item["type"] == "image_prompt" and "image_path" not in item else item
+        for item in book_data.get("content", [])
+    ]
+    return {**book_data, "content": content}
+
+
+def draft_book(book, export_format, deadline=None, structuring='llm'):
+    """
+    Step 1 and a draft BookFile with placeholders instead of illustrations,
+    available seconds after the request instead of minutes.
+    Returns the draft and the arguments finish_book needs for the final file.
+    The latency budget is the one of the draft: the final pass runs after the response, without a deadline.
+    """
+    book_data, book_llm_instance = start_book(book, deadline, structuring)
+    print(f"Step 1.5: Creating a draft {export_format.upper()}")
+    try:
+        draft_file = export_book(book, draft_book_data(book_data), export_format, draft=True)
+    finally:
+        save_degradation(book, deadline)
+    print("Step 1.5 finished")
+    return draft_file, (book, book_data, book_llm_instance, export_format, None)
+
+
+def finish_book_in_background(*finish_args, done=None):
+    """
+    Runs finish_book in a daemon thread, so that the draft can be returned right away.
+    The final file is then listed among the book files next to the draft.
+    done is called when the thread ends, e.g. to free the generation slot of the book.
+    """
+    def run():
+        try:
+            finish_book(*finish_args)
+        except Exception as e:
+            print(f"❌ Final version of the book {finish_args[0].id} failed: {e}")
+        finally:
+            connection.close()
+            if done is not None:
+                done()
+
+    # With the context of the request, so that the illustrations are charged to its client
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(run,), name=f"book-{finish_args[0].id}", daemon=True)
+    thread.start()
+    return thread
+
+
+async def astart_book(book, deadline=None, structuring='llm'):
+    """
+    Async version of start_book.
+    """
+    try:
+        print("Step 1: Getting book content with markers")
+        book_data = await astructure_book(book, deadline, structuring)
+        book_llm_instance = await sync_to_async(save_book_llm)(book, book_data)
+        print("Step 1 finished")
+        return book_data, book_llm_instance
+    except Exception:
+        await sync_to_async(save_degradation)(book, deadline)
+        raise
+
+
+async def afinish_book(book, book_data, book_llm_instance, export_format, deadline=None):
+    """
+    Async version of finish_book.
+    """
+    try:
+        if settings.USE_TEST_IMAGES:
+            print("Step 2: Using test images")
+            book_data_with_images = await sync_to_async(use_test_images)(book, book_data)
+        else:
+            print("Step 2: Generating and saving images")
+            book_data_with_images = await agenerate_images(book, book_data, deadline)
+        await sync_to_async(save_book_llm)(book, book_data_with_images, book_llm_instance)
+        print("Step 2 finished")
+
+        print(f"Step 3: Creating {export_format.upper()}")
+        book_file = await aexport_book(book, book_data_with_images, export_format)
+        print("Step 3 finished")
+        return book_file
+    finally:
+        await sync_to_async(save_degradation)(book, deadline)
+
+
+async def agenerate_book(book, export_format, deadline=None, structuring='llm'):
+    """
+    Async version of generate_book. Gemini calls are awaited, ORM and storage
+    go through sync_to_async and rendering runs in a thread.
+    """
+    book_data, book_llm_instance = await astart_book(book, deadline, structuring)
+    return await afinish_book(book, book_data, book_llm_instance, export_format, deadline)
+
+
+async def adraft_book(book, export_format, deadline=None, structuring='llm'):
+    """
+    Async version of draft_book.
+    """
+    book_data, book_llm_instance = await astart_book(book, deadline, structuring)
+    print(f"Step 1.5: Creating a draft {export_format.upper()}")
+    try:
+        draft_data = await asyncio.to_thread(draft_book_data, book_data)
+        draft_file = await aexport_book(book, draft_data, export_format, draft=True)
+    finally:
+        await sync_to_async(save_degradation)(book, deadline)
+    print("Step 1.5 finished")
+    return draft_file, (book, book_data, book_llm_instance, export_format, None)
+
+
+# Keeps references to running background tasks, the event loop only keeps weak ones
+background_tasks = set()
+
+
+def afinish_book_in_background(*finish_args, done=None):
+    """
+    Async version of finish_book_in_background, the final pass runs as a task
+    of the event loop that served the draft.
+    """
+    async def run():
+        try:
+            await afinish_book(*finish_args)
+        except Exception as e:
+            print(f"❌ Final version of the book {finish_args[0].id} failed: {e}")
+        finally:
+            if done is not None:
+                done()
+
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
@@ -0,0 +1,104 @@
+import io
+import hashlib
+import textwrap
+
+from PIL import Image as PILImage, ImageDraw, ImageFont
+
+
+def read_image_metadata(file):
+    """
+    Reads dimensions, byte size, format and sha256 of an image file in a single pass.
+    Returns a dict with the keys of the matching Image model fields.
+    """
+    file.seek(0)
+    data = file.read()
+    file.seek(0)
+
+    with PILImage.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        image_format = img.format or ''
+
+    return {
+        'width': width,
+        'height': height,
+        'file_size': len(data),
+        'image_format': image_format.lower(),
+        'content_hash': hashlib.sha256(data).hexdigest(),
+    }
+
+
+# Pillow format and file extension of the storage formats of illustrations
+STORAGE_FORMATS = {'jpeg': ('JPEG', '.jpg'), 'webp': ('WEBP', '.webp'), 'png': ('PNG', '.png')}
+
+
+# Modes Pillow writes in each storage format, other modes are converted first
+WRITABLE_MODES = {'JPEG': ('RGB',), 'WEBP': ('RGB', 'RGBA'), 'PNG': ('1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA')}
+
+
+def _flatten(img):
+    """
+    RGB copy of the image, transparent parts on white: JPEG has no alpha channel.
+    """
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = PILImage.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _writable(img, pil_format):
+    """
+    The image in a mode the format can store, e.g. a CMYK JPEG as RGB for PNG.
+    """
+    modes = WRITABLE_MODES.get(pil_format)
+    if modes is None or img.mode in modes:
+        return img
+    if pil_format == 'JPEG':
+        return _flatten(img)
+    return img.convert('RGBA' if img.has_transparency_data else 'RGB')
+
+
+def normalize_image(data, storage_format, quality=85, max_dimension=0):
+    """
+    Validates image bytes by decoding them and converts them to the storage format
+    ('jpeg', 'webp', 'png' or 'original'), downscaled so that the longer side is at most
+    max_dimension (0 for no limit). Returns the bytes and their file extension, data that is
+    already in the format and size is returned as is. Raises ValueError if data is not an image.
+    """
+    try:
+        img = PILImage.open(io.BytesIO(data))
+        img.load()
+    except PILImage.UnidentifiedImageError as e:
+        raise ValueError("Not a valid image") from e
+    except (OSError, SyntaxError, PILImage.DecompressionBombError) as e:
+        raise ValueError(f"Not a valid image: {e}") from e
+
+    # Errors from here on are not about the picture, they are raised as they are
+    with img:
+        pil_format, extension = STORAGE_FORMATS.get(storage_format, (img.format, f'.{img.format.lower()}'))
+        too_large = max_dimension and max(img.size) > max_dimension
+        if img.format == pil_format and not too_large:
+            return data, extension
+        if too_large:
+            img.thumbnail((max_dimension, max_dimension), PILImage.Resampling.LANCZOS)
+        output = io.BytesIO()
+        _writable(img, pil_format).save(output, format=pil_format, quality=quality, optimize=True)
+    return output.getvalue(), extension
+
+
+def placeholder_image(text, size=1024):
+    """
+    PNG bytes of a light grey square with the wrapped text, used instead
+    of an illustration that could not be generated in time.
+    """
+    img = PILImage.new('RGB', (size, size), (235, 235, 235))
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=size // 28)
+    lines = textwrap.wrap(text, width=40)[:20]
+    draw.multiline_text((size // 2, size // 2), '\n'.join(lines), fill=(90, 90, 90), font=font,
+                        anchor='mm', align='center', spacing=size // 80)
+
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
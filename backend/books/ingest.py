@@ -0,0 +1,213 @@
+import os
+import re
+import codecs
+import zipfile
+import posixpath
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+UPLOAD_EXTENSIONS = ('.txt', '.md', '.epub')
+CHUNK_SIZE = 64 * 1024
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+# Tags that end a line of the extracted EPUB text
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'section', 'tr'}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+WHITESPACE_RE = re.compile(r'\s+')
+OPF_NS = {'opf': 'http://www.idpf.org/2007/opf', 'container': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class MaxSizeUploadHandler(FileUploadHandler):
+    """
+    Stops an upload as soon as it exceeds max_bytes, before the rest of it
+    is written to disk by the next handlers.
+    """
+
+    def __init__(self, max_bytes, request=None):
+        super().__init__(request)
+        self.max_bytes = max_bytes
+        self.received = 0
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length and content_length > self.max_bytes:
+            raise UploadTooLarge(f"The upload is larger than {self.max_bytes} bytes")
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            raise UploadTooLarge(f"The upload is larger than {self.max_bytes} bytes")
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class TextCollector:
+    """
+    Gathers decoded chunks into one string with normalized line ends,
+    counting characters on the way so that an oversized text is rejected early.
+    """
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.pending_cr = False
+
+    def add(self, text):
+        if self.pending_cr:
+            text = '\r' + text
+        # A \r\n pair may be split between two chunks
+        self.pending_cr = text.endswith('\r')
+        if self.pending_cr:
+            text = text[:-1]
+        text = text.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '')
+        self.length += len(text)
+        if self.length > self.max_chars:
+            raise ValueError(f"The book text is longer than {self.max_chars} characters")
+        self.parts.append(text)
+
+    def text(self):
+        if self.pending_cr:
+            self.parts.append('\n')
+        text = ''.join(self.parts)
+        self.parts = []
+        return text.strip()
+
+
+def _detect_encoding(head):
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    return None, 0
+
+
+def decode_stream(file, max_chars, fallback_encoding='cp1251'):
+    """
+    Decodes a text file chunk by chunk: by its BOM, else as UTF-8,
+    and once UTF-8 fails, again from the start with fallback_encoding.
+    """
+    file.seek(0)
+    encoding, skip = _detect_encoding(file.read(4))
+    for candidate in ([encoding] if encoding else ['utf-8', fallback_encoding]):
+        file.seek(skip)
+        # Only a guessed UTF-8 has to fail loudly, to move on to the fallback encoding
+        guessed = encoding is None and candidate == 'utf-8'
+        decoder = codecs.getincrementaldecoder(candidate)(errors='strict' if guessed else 'replace')
+        collector = TextCollector(max_chars)
+        try:
+            while chunk := file.read(CHUNK_SIZE):
+                collector.add(decoder.decode(chunk))
+            collector.add(decoder.decode(b'', final=True))
+        except UnicodeDecodeError:
+            print(f"  ⚠️ The file is not {candidate}, decoding it as {fallback_encoding}")
+            continue
+        return collector.text()
+
+
+class EpubTextParser(HTMLParser):
+    """
+    Extracts the text of an XHTML document, one block element per line.
+    Headings get a blank line around them, as the local structuring expects.
+    """
+
+    def __init__(self, collector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style', 'head'):
+            self.skip += 1
+        elif tag in BLOCK_TAGS:
+            self.collector.add('\n\n' if tag in HEADING_TAGS or tag == 'p' else '\n')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style', 'head'):
+            self.skip = max(self.skip - 1, 0)
+        # <br/> is reported as a start and an end tag, one line break is enough
+        elif tag in BLOCK_TAGS and tag != 'br':
+            self.collector.add('\n\n' if tag in HEADING_TAGS or tag == 'p' else '\n')
+
+    def handle_data(self, data):
+        if not self.skip:
+            # Line breaks of the XHTML source are not line breaks of the text
+            self.collector.add(WHITESPACE_RE.sub(' ', data))
+
+
+def _epub_spine(archive):
+    """
+    Paths of the documents of an EPUB in reading order.
+    """
+    container = ElementTree.fromstring(archive.read('META-INF/container.xml'))
+    opf_path = container.find('.//container:rootfile', OPF_NS).get('full-path')
+    opf = ElementTree.fromstring(archive.read(opf_path))
+    base = posixpath.dirname(opf_path)
+    manifest = {item.get('id'): item.get('href') for item in opf.iterfind('.//opf:manifest/opf:item', OPF_NS)}
+    return [
+        posixpath.normpath(posixpath.join(base, manifest[itemref.get('idref')]))
+        for itemref in opf.iterfind('.//opf:spine/opf:itemref', OPF_NS)
+        if itemref.get('idref') in manifest
+    ]
+
+
+def read_epub(file, max_chars):
+    """
+    Streams the documents of the EPUB spine through the HTML parser.
+    The character limit also protects from archives that unpack to huge sizes.
+    """
+    collector = TextCollector(max_chars)
+    try:
+        with zipfile.ZipFile(file) as archive:
+            for path in _epub_spine(archive):
+                parser = EpubTextParser(collector)
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                with archive.open(path) as document:
+                    while chunk := document.read(CHUNK_SIZE):
+                        parser.feed(decoder.decode(chunk))
+                parser.feed(decoder.decode(b'', final=True))
+                parser.close()
+    except (zipfile.BadZipFile, KeyError, AttributeError, ElementTree.ParseError) as e:
+        raise ValueError(f"Not a valid EPUB file: {e}")
+
+    # Paragraph tags leave runs of blank lines and spaces behind
+    lines = (' '.join(line.split()) for line in collector.text().split('\n'))
+    paragraphs, paragraph = [], []
+    for line in lines:
+        if line:
+            paragraph.append(line)
+        elif paragraph:
+            paragraphs.append('\n'.join(paragraph))
+            paragraph = []
+    if paragraph:
+        paragraphs.append('\n'.join(paragraph))
+    return '\n\n'.join(paragraphs)
+
+
+def read_book_upload(upload, max_chars, fallback_encoding='cp1251'):
+    """
+    Text of an uploaded .txt, .md or .epub file. Large uploads are already on disk
+    (TemporaryUploadedFile), they are read from there in chunks.
+    """
+    extension = os.path.splitext(upload.name)[1].lower()
+    if extension not in UPLOAD_EXTENSIONS:
+        raise ValueError(f"Unsupported file type {extension or upload.name}, expected one of {', '.join(UPLOAD_EXTENSIONS)}")
+
+    print(f"📥 Reading the uploaded book {upload.name} ({upload.size} bytes)...")
+    if extension == '.epub':
+        text = read_epub(upload, max_chars)
+    else:
+        text = decode_stream(upload, max_chars, fallback_encoding)
+    if not text:
+        raise ValueError("The uploaded file contains no text")
+    return text
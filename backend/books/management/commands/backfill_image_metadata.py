@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from books.images import read_image_metadata
+from books.models import Image
+
+
+def _read_metadata(name):
+    with Image._meta.get_field('illustration').storage.open(name, 'rb') as f:
+        return read_image_metadata(f)
+
+
+class Command(BaseCommand):
+    help = 'Fills dimensions, size, format and hash of existing illustrations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Number of parallel readers')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per bulk update')
+        parser.add_argument('--all', action='store_true', help='Recompute rows that already have a hash')
+
+    def handle(self, *args, **options):
+        # Plain values: only the names are needed, the files are read in the worker threads
+        queryset = Image.objects.exclude(illustration='').order_by('id')
+        if not options['all']:
+            queryset = queryset.filter(content_hash='')
+
+        total = queryset.count()
+        self.stdout.write(f'Images to process: {total}')
+
+        done = failed = 0
+        batch_size = options['batch_size']
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            last_id = 0
+            while True:
+                # Keyset pagination keeps every batch query cheap on large tables
+                batch = list(queryset.filter(id__gt=last_id).values_list('id', 'illustration')[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                updated = []
+                futures = [(image_id, name, executor.submit(_read_metadata, name)) for image_id, name in batch]
+                for image_id, name, future in futures:
+                    try:
+                        metadata = future.result()
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f'  ❌ Image {image_id} ({name}): {e}')
+                        continue
+                    # Only the id and the metadata are set, bulk_update writes nothing else
+                    updated.append(Image(id=image_id, **metadata))
+
+                Image.objects.bulk_update(updated, Image.METADATA_FIELDS)
+                done += len(updated)
+                self.stdout.write(f'  - {done + failed}/{total}')
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {done} updated, {failed} failed'))
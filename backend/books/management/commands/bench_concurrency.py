@@ -0,0 +1,96 @@
+import io
+import json
+import time
+import asyncio
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from books import generation
+from books.models import Book
+
+
+class LatencyStubClient:
+    """
+    Stands in for genai.Client: answers like Gemini after a fixed delay,
+    with the same blocking (models) and async (aio.models) interfaces.
+    """
+
+    def __init__(self, text_latency, image_latency, illustrations):
+        self.text_latency = text_latency
+        self.image_latency = image_latency
+        self.illustrations = illustrations
+        self.models = SimpleNamespace(generate_content=self._generate_content)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._agenerate_content))
+
+        image = io.BytesIO()
+        PILImage.new('RGB', (64, 64), 'white').save(image, format='PNG')
+        self.image_bytes = image.getvalue()
+
+    def _response(self, model):
+        if 'image' in model:
+            part = SimpleNamespace(inline_data=SimpleNamespace(data=self.image_bytes))
+            return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+        content = []
+        for index in range(self.illustrations):
+            content.append({"type": "text", "data": f"Part {index + 1} of the story."})
+            content.append({"type": "image_prompt", "data": f"Illustration {index + 1}"})
+        return SimpleNamespace(text=json.dumps({"title": "Stub", "author": "Stub", "content": content}))
+
+    def _latency(self, model):
+        return self.image_latency if 'image' in model else self.text_latency
+
+    def _generate_content(self, model, contents, config=None):
+        time.sleep(self._latency(model))
+        return self._response(model)
+
+    async def _agenerate_content(self, model, contents, config=None):
+        await asyncio.sleep(self._latency(model))
+        return self._response(model)
+
+
+class Command(BaseCommand):
+    help = 'Compares how many books one worker holds in flight on the sync (WSGI) and async (ASGI) paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=32)
+        parser.add_argument('--threads', type=int, default=4, help='Threads of the sync worker')
+        parser.add_argument('--illustrations', type=int, default=5)
+        parser.add_argument('--text-latency', type=float, default=2.0, help='Seconds per structuring call')
+        parser.add_argument('--image-latency', type=float, default=1.0, help='Seconds per image call')
+
+    def handle(self, *args, **options):
+        generation.client = LatencyStubClient(
+            options['text_latency'], options['image_latency'], options['illustrations']
+        )
+        settings.USE_TEST_IMAGES = False
+        count = options['books']
+
+        books = [Book.objects.create(title=f'Benchmark {index}', text='Stub text') for index in range(count)]
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                list(executor.map(lambda book: generation.generate_book(book, 'html'), books))
+            self._report('sync', options['threads'], count, time.perf_counter() - started)
+
+            async def run_all():
+                await asyncio.gather(*(generation.agenerate_book(book, 'html') for book in books))
+
+            # The cached HTML files of the sync run must not be reused
+            for book in books:
+                book.files.all().delete()
+            started = time.perf_counter()
+            asyncio.run(run_all())
+            self._report('async', count, count, time.perf_counter() - started)
+        finally:
+            for book in books:
+                book.delete()
+
+    def _report(self, path, in_flight, count, elapsed):
+        self.stdout.write(self.style.SUCCESS(
+            f'{path}: {count} books in {elapsed:.1f}s, {count / elapsed:.2f} books/s, {in_flight} books in flight'
+        ))
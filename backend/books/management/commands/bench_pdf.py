@@ -0,0 +1,124 @@
+import os
+import time
+import random
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from books import pdf
+
+
+PARAGRAPH = (
+    "The road wound through the hills towards the old mill, where the river turned "
+    "slowly under the wooden wheel and the miller's children watched the boats go by. "
+) * 6
+
+
+def synthetic_images(directory, count, size=1024):
+    """
+    Writes distinct noisy PNG files, similar in size to generated illustrations.
+    Distinct files matter: reportlab embeds an identical image only once.
+    """
+    image_paths = []
+    for index in range(count):
+        image_path = os.path.join(directory, f'synthetic_{index}.png')
+        PILImage.frombytes('RGB', (size, size), random.randbytes(size * size * 3)).save(image_path)
+        image_paths.append(image_path)
+    return image_paths
+
+
+def synthetic_book(pages, image_paths, images_every=5):
+    """
+    Builds book_data of roughly the given number of letter pages (two text blocks per page)
+    with an illustration every images_every pages.
+    """
+    content = []
+    for page in range(pages):
+        content.append({"type": "text", "data": f"{page + 1}. {PARAGRAPH}"})
+        content.append({"type": "text", "data": PARAGRAPH})
+        if page % images_every == images_every - 1:
+            content.append({
+                "type": "image_prompt",
+                "data": "An old mill by the river",
+                "image_path": image_paths[page // images_every % len(image_paths)],
+            })
+    return {"title": "Synthetic book", "author": "Benchmark", "content": content}
+
+
+def _measure(book_data, output_filename, workers):
+    """
+    Runs in a fresh process so that its peak RSS belongs to this render only.
+    """
+    started = time.perf_counter()
+    pdf.create_pdf(book_data, output_filename, workers=workers, min_parallel_items=0)
+    elapsed = time.perf_counter() - started
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return elapsed, peak_rss / 1024
+
+
+def _measure_rebuild(book_data, output_filename):
+    """
+    Renders the book twice in one process, with an empty layout cache and then with the one
+    filled by the first render, as when a book is rebuilt.
+    """
+    timings = []
+    pdf.layout_cache.clear()
+    for _ in range(2):
+        started = time.perf_counter()
+        pdf.create_pdf(book_data, output_filename, workers=1)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+class Command(BaseCommand):
+    help = 'Measures PDF rendering time and peak memory of a synthetic book with one and several workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=500)
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, settings.PDF_RENDER_WORKERS])
+        parser.add_argument('--images-every', type=int, default=5, help='One illustration per this many pages')
+        parser.add_argument('--distinct-images', type=int, default=0,
+                            help='Generate this many distinct images instead of reusing test_images')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Also compare a render with an empty layout cache to a rebuild that reuses it')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if options['distinct_images']:
+                image_paths = synthetic_images(temp_dir, options['distinct_images'])
+            else:
+                test_images_dir = os.path.join(settings.BASE_DIR, 'test_images')
+                image_paths = sorted(os.path.join(test_images_dir, f) for f in os.listdir(test_images_dir))
+
+            book_data = synthetic_book(options['pages'], image_paths, options['images_every'])
+            illustrations = sum(1 for item in book_data['content'] if item['type'] == 'image_prompt')
+            self.stdout.write(f"Synthetic book: {len(book_data['content'])} content blocks, {illustrations} illustrations")
+
+            baseline = None
+            for workers in options['workers']:
+                output_filename = os.path.join(temp_dir, f'bench_{workers}.pdf')
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    elapsed, peak_rss = executor.submit(_measure, book_data, output_filename, workers).result()
+
+                baseline = baseline or elapsed
+                size = os.path.getsize(output_filename) / 1024 / 1024
+                self.stdout.write(self.style.SUCCESS(
+                    f'workers={workers}: {elapsed:.2f}s, speedup x{baseline / elapsed:.2f}, '
+                    f'peak RSS {peak_rss:.0f} MB, {size:.1f} MB'
+                ))
+
+            if options['rebuild']:
+                output_filename = os.path.join(temp_dir, 'bench_rebuild.pdf')
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    cold, warm = executor.submit(_measure_rebuild, book_data, output_filename).result()
+                self.stdout.write(self.style.SUCCESS(
+                    f'rebuild with the layout cache: {cold:.2f}s cold, {warm:.2f}s warm, speedup x{cold / warm:.2f}'
+                ))
@@ -0,0 +1,82 @@
+import time
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from books.models import Book, Image, ImagePromptBand
+from books.similarity import minhash, band_keys, find_similar_image
+
+
+class Rollback(Exception):
+    pass
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'der', 'mon', 'tal', 'wen', 'gor', 'ish', 'ble', 'tra']
+# Prompts use thousands of distinct words, with a few of them very frequent
+VOCABULARY = sorted({''.join(random.Random(index).choices(SYLLABLES, k=3)) for index in range(20000)})
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+
+def synthetic_prompt():
+    words = ' '.join(random.choices(VOCABULARY, WEIGHTS, k=random.randint(12, 30)))
+    return f"A detailed book illustration of the following scene: {words}."
+
+
+def reworded(prompt, changes=2):
+    """
+    The prompt with a few words replaced, like a prompt of a slightly edited text.
+    """
+    words = prompt.split()
+    for _ in range(changes):
+        words[random.randrange(8, len(words))] = random.choice(VOCABULARY)
+    return ' '.join(words)
+
+
+class Command(BaseCommand):
+    help = 'Measures near-duplicate prompt lookups against many illustrations (the data is rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=100_000)
+        parser.add_argument('--lookups', type=int, default=500)
+        parser.add_argument('--threshold', type=float, default=0.6)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._bench(options['images'], options['lookups'], options['threshold'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _bench(self, count, lookups, threshold):
+        started = time.perf_counter()
+        book = Book.objects.create(title='Prompt index benchmark', text='-')
+        prompts = [synthetic_prompt() for _ in range(count)]
+        for start in range(0, count, 5000):
+            images = Image.objects.bulk_create(
+                Image(
+                    book=book, illustration='bench/missing.png', width=1, height=1,
+                    image_prompt=prompt, prompt_minhash=minhash(prompt),
+                )
+                for prompt in prompts[start:start + 5000]
+            )
+            ImagePromptBand.objects.bulk_create(
+                (ImagePromptBand(image=image, key=key) for image in images for key in band_keys(image.prompt_minhash)),
+                batch_size=5000,
+            )
+        self.stdout.write(f"{count} illustrations indexed in {time.perf_counter() - started:.0f}s")
+
+        for label, make_query in (
+            ('reworded prompts', lambda: reworded(random.choice(prompts))),
+            ('unrelated prompts', synthetic_prompt),
+        ):
+            found, elapsed = 0, 0.0
+            for _ in range(lookups):
+                query = make_query()
+                started = time.perf_counter()
+                found += find_similar_image(query, threshold) is not None
+                elapsed += time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"{label}: {elapsed / lookups * 1000:.2f} ms per lookup, {found}/{lookups} matched"
+            ))
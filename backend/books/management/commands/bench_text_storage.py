@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from books.fields import compress_text, decompress_text
+from books.structuring import structure_locally
+
+
+WORDS = (
+    "the of and to a in was he that it his her with as had for you on at she not but said "
+    "river mill road hills wheel water morning evening light house garden window door children "
+    "old young long small great little slowly quietly suddenly again never always before after "
+    "walked looked turned remembered answered whispered waited watched carried opened closed "
+    "miller boat village forest winter summer letter mother father brother sister stranger"
+).split()
+
+
+def synthetic_text(chars):
+    """
+    Random sentences over a small vocabulary, with word frequencies falling off
+    like in natural text. Far less repetitive than a repeated paragraph.
+    """
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    paragraphs, length = [], 0
+    while length < chars:
+        sentences = []
+        for _ in range(random.randint(3, 8)):
+            words = random.choices(WORDS, weights, k=random.randint(6, 24))
+            sentences.append(' '.join(words).capitalize() + random.choice('..!?'))
+        paragraph = ' '.join(sentences)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)
+
+
+def _timed(function, value, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = function(value)
+    return result, (time.perf_counter() - started) / repeat * 1000
+
+
+class Command(BaseCommand):
+    help = 'Compares plain and compressed storage of Book.text and BookLlm.text: size, compression time and read latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='Book text file, a synthetic text by default')
+        parser.add_argument('--chars', type=int, default=300_000, help='Length of the synthetic text')
+        parser.add_argument('--rows', type=int, default=200, help='Rows of each kind in the benchmark database')
+        parser.add_argument('--reads', type=int, default=500, help='Random reads for the latency measurement')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as f:
+                text = f.read()
+        else:
+            text = synthetic_text(options['chars'])
+        # Stored the same way as generation.save_book_llm does
+        book_llm = json.dumps(structure_locally(text), ensure_ascii=False, indent=2)
+
+        for name, value, dictionary in (('Book.text', text, None), ('BookLlm.text', book_llm, 'book_llm')):
+            raw = len(value.encode('utf-8'))
+            self.stdout.write(f"{name}: {raw / 1024:.0f} KB")
+            for label, variant in (('zlib', None), (f'zlib + {dictionary} dictionary', dictionary)):
+                if label != 'zlib' and not dictionary:
+                    continue
+                compressed, compress_ms = _timed(lambda v: compress_text(v, variant), value, 5)
+                _, decompress_ms = _timed(lambda v: decompress_text(v, variant), compressed, 20)
+                self.stdout.write(self.style.SUCCESS(
+                    f'  {label}: {len(compressed) / 1024:.0f} KB (x{raw / len(compressed):.1f}), '
+                    f'compress {compress_ms:.2f} ms, decompress {decompress_ms:.2f} ms'
+                ))
+
+        self._bench_database(text, book_llm, options['rows'], options['reads'])
+
+    def _bench_database(self, text, book_llm, rows, reads):
+        """
+        Fills two SQLite databases with the same rows, as TEXT and as compressed BLOB,
+        then compares file sizes and the latency of random reads including decompression.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = {}
+            for kind in ('plain', 'compressed'):
+                path = os.path.join(temp_dir, f'{kind}.sqlite3')
+                connection = sqlite3.connect(path)
+                column_type = 'BLOB' if kind == 'compressed' else 'TEXT'
+                connection.execute(f'CREATE TABLE book (id INTEGER PRIMARY KEY, text {column_type}, llm {column_type})')
+                for row in range(rows):
+                    # Every row differs, as different books do
+                    book_text = f'{row}\n{text}'
+                    llm_text = book_llm.replace('"title": "', f'"title": "{row} ', 1)
+                    if kind == 'compressed':
+                        book_text, llm_text = compress_text(book_text), compress_text(llm_text, 'book_llm')
+                    connection.execute('INSERT INTO book (text, llm) VALUES (?, ?)', (book_text, llm_text))
+                connection.commit()
+                size = os.path.getsize(path)
+
+                started = time.perf_counter()
+                for _ in range(reads):
+                    book_text, llm_text = connection.execute(
+                        'SELECT text, llm FROM book WHERE id = ?', (random.randint(1, rows),)
+                    ).fetchone()
+                    if kind == 'compressed':
+                        decompress_text(book_text), decompress_text(llm_text, 'book_llm')
+                read_ms = (time.perf_counter() - started) / reads * 1000
+                connection.close()
+                results[kind] = size, read_ms
+
+        plain_size, plain_ms = results['plain']
+        size, read_ms = results['compressed']
+        self.stdout.write(f"SQLite with {rows} books: plain {plain_size / 1024 / 1024:.1f} MB, read {plain_ms:.2f} ms")
+        self.stdout.write(self.style.SUCCESS(
+            f"SQLite with {rows} books: compressed {size / 1024 / 1024:.1f} MB (x{plain_size / size:.1f}), "
+            f"read {read_ms:.2f} ms"
+        ))
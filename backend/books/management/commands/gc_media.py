@@ -0,0 +1,201 @@
+import os
+import time
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+
+from books.models import Book, Image
+
+
+# Files of BASE_DIR/tmp that are reused between requests, see generation.draft_book_data
+TMP_KEEP = {'draft_placeholder.png'}
+
+
+def _scan_dir(path):
+    """
+    Files and subdirectories of one directory. DirEntry types come with the listing,
+    so nothing is stat-ed here.
+    """
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(entry.path)
+    return files, subdirs
+
+
+def scan_tree(root, executor):
+    """
+    Paths of all files under root, directories are listed in parallel.
+    """
+    pending = {executor.submit(_scan_dir, root)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            files, subdirs = future.result()
+            yield from files
+            pending |= {executor.submit(_scan_dir, subdir) for subdir in subdirs}
+
+
+def referenced_files():
+    """
+    Names of all files referenced by FileFields of all models, read in bulk.
+    """
+    names = set()
+    for model in apps.get_models():
+        for field in model._meta.concrete_fields:
+            if isinstance(field, models.FileField):
+                queryset = model._default_manager.exclude(**{field.name: ''}).exclude(**{f'{field.name}__isnull': True})
+                names.update(queryset.values_list(field.name, flat=True).iterator(chunk_size=10_000))
+    return names
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return path, None, None
+    return path, stat.st_size, stat.st_mtime
+
+
+class Command(BaseCommand):
+    help = 'Finds files in MEDIA_ROOT that no model references and stale files in BASE_DIR/tmp, and deletes or archives them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+        parser.add_argument('--archive', metavar='DIR', help='Move orphans into DIR, keeping their paths, instead of deleting')
+        parser.add_argument('--min-age', type=float, default=24,
+                            help='Hours since the last change, newer files may belong to a request in progress')
+        parser.add_argument('--failed-books', action='store_true',
+                            help='Also delete books older than --min-age whose generation started but produced no file')
+        parser.add_argument('--workers', type=int, default=16, help='Parallel directory listings and stats')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Do not ask for confirmation')
+
+    def handle(self, *args, **options):
+        # Without MEDIA_ROOT (it is only set with DEBUG) the current directory would be scanned
+        if not settings.MEDIA_ROOT:
+            raise CommandError('MEDIA_ROOT is not set')
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        base_dir = os.path.abspath(settings.BASE_DIR)
+        if base_dir == media_root or base_dir.startswith(media_root + os.sep):
+            raise CommandError(f'MEDIA_ROOT {media_root} contains the project directory {base_dir}')
+        tmp_root = os.path.join(settings.BASE_DIR, 'tmp')
+        archive = os.path.abspath(options['archive']) if options['archive'] else None
+        if archive and archive.startswith((media_root + os.sep, tmp_root + os.sep)):
+            raise CommandError('The archive directory must be outside of MEDIA_ROOT and tmp')
+        min_mtime = time.time() - options['min_age'] * 3600
+
+        if options['failed_books']:
+            self._delete_failed_books(options)
+
+        started = time.perf_counter()
+        # Loaded first: a file saved during the scan is new enough to be skipped by its age
+        referenced = referenced_files()
+        self.stdout.write(f'{len(referenced)} files referenced in the database ({time.perf_counter() - started:.1f}s)')
+
+        scanned = 0
+        candidates = []
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for root, is_orphan in (
+                (media_root, lambda name: name not in referenced),
+                (tmp_root, lambda name: name not in TMP_KEEP),
+            ):
+                if not os.path.isdir(root):
+                    continue
+                for path in scan_tree(root, executor):
+                    scanned += 1
+                    name = os.path.relpath(path, root).replace(os.sep, '/')
+                    if is_orphan(name):
+                        candidates.append((root, path))
+
+            # Only the unreferenced files are stat-ed, for their age and size
+            stats = dict(
+                (path, (size, mtime)) for path, size, mtime in executor.map(_stat, [path for _, path in candidates])
+            )
+
+        orphans = []
+        skipped_new = 0
+        for root, path in candidates:
+            size, mtime = stats[path]
+            if mtime is None:
+                continue
+            if mtime > min_mtime:
+                skipped_new += 1
+                continue
+            orphans.append((root, path, size))
+        self.stdout.write(
+            f'{scanned} files scanned in {time.perf_counter() - started:.1f}s, {len(orphans)} orphans, '
+            f'{skipped_new} unreferenced files newer than {options["min_age"]:g}h kept'
+        )
+        self._report(orphans)
+
+        if not orphans or options['dry_run']:
+            return
+        if options['interactive']:
+            verb = f'moved to {archive}' if archive else 'deleted'
+            answer = input(f'{len(orphans)} files will be {verb}. Type "yes" to continue: ')
+            if answer != 'yes':
+                raise CommandError('Cancelled')
+        self._remove(orphans, archive)
+
+    def _delete_failed_books(self, options):
+        """
+        Books whose generation started, they have a structured text or illustrations,
+        but that got no file, draft or final, and stopped long ago. Books only added in the admin are kept.
+        Deleted through the ORM, so that django_cleanup removes the files of their illustrations.
+        """
+        cutoff = timezone.now() - timezone.timedelta(hours=options['min_age'])
+        started = Q(llm_texts__isnull=False) | Q(images__isnull=False)
+        book_ids = list(
+            Book.objects.filter(started, created__lt=cutoff, files__isnull=True)
+            .values_list('id', flat=True).distinct().order_by('id')
+        )
+        images = Image.objects.filter(book__in=book_ids).count()
+        self.stdout.write(f'{len(book_ids)} failed books with {images} illustrations')
+        if book_ids:
+            self.stdout.write(f'  Ids: {", ".join(map(str, book_ids))}')
+        if not book_ids or options['dry_run']:
+            return
+        if options['interactive'] and input(f'{len(book_ids)} books will be deleted. Type "yes" to continue: ') != 'yes':
+            raise CommandError('Cancelled')
+        for book in Book.objects.filter(pk__in=book_ids).iterator(chunk_size=500):
+            book.delete()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {len(book_ids)} failed books'))
+
+    def _report(self, orphans):
+        by_dir = defaultdict(lambda: [0, 0])
+        for root, path, size in orphans:
+            directory = os.path.normpath(os.path.join(os.path.basename(root), os.path.relpath(path, root), os.pardir))
+            by_dir[directory][0] += 1
+            by_dir[directory][1] += size
+        for directory, (count, size) in sorted(by_dir.items(), key=lambda item: -item[1][1]):
+            self.stdout.write(f'  {directory}: {count} files, {size / 1024 / 1024:.1f} MB')
+        total = sum(size for _, _, size in orphans)
+        self.stdout.write(self.style.SUCCESS(f'Orphans: {len(orphans)} files, {total / 1024 / 1024:.1f} MB'))
+
+    def _remove(self, orphans, archive):
+        removed = failed = 0
+        for root, path, _ in orphans:
+            try:
+                if archive:
+                    target = os.path.join(archive, os.path.basename(root), os.path.relpath(path, root))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as e:
+                failed += 1
+                self.stderr.write(f'  ❌ {path}: {e}')
+        verb = 'Archived' if archive else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {removed} files, {failed} failed'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from books import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of books and illustration prompts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if not search.enabled():
+            self.stdout.write(self.style.WARNING('Full-text search needs SQLite or PostgreSQL'))
+            return
+        search.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
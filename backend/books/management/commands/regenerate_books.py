@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from books.models import Book, BookFile, Image
+from books.regeneration import regenerate_books
+
+
+class Command(BaseCommand):
+    help = 'Redraws illustrations and rebuilds files of many books through a bounded worker pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('book_ids', nargs='*', type=int, help='Books to regenerate')
+        parser.add_argument('--all', action='store_true', help='All books with a structured text')
+        parser.add_argument('--images', nargs='+', type=int, metavar='IMAGE_ID',
+                            help='Only these illustrations, and the files of their books')
+        parser.add_argument('--files-only', action='store_true', help='Rebuild files, keep the illustrations')
+        parser.add_argument('--formats', nargs='+', choices=BookFile.Format.values,
+                            help='Formats to build, by default the formats each book already has')
+        parser.add_argument('--workers', type=int, help='Books regenerated at the same time (REGENERATION_WORKERS)')
+
+    def handle(self, *args, **options):
+        book_ids = list(options['book_ids'])
+        if options['all']:
+            book_ids += Book.objects.filter(llm_texts__isnull=False).distinct().order_by('pk').values_list('pk', flat=True)
+        if options['images']:
+            book_ids += Image.objects.filter(pk__in=options['images']).values_list('book_id', flat=True).distinct()
+        if not book_ids:
+            raise CommandError('Pass book ids, --images or --all')
+
+        failed = regenerate_books(
+            sorted(set(book_ids)),
+            workers=options['workers'],
+            report=self.stdout.write,
+            images=not options['files_only'],
+            image_ids=options['images'],
+            formats=options['formats'],
+        )
+        if failed:
+            raise CommandError(f"Failed books: {', '.join(map(str, failed))}")
+        self.stdout.write(self.style.SUCCESS('Done'))
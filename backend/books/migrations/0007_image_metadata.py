@@ -0,0 +1,44 @@
+# Generated by Django 6.0 on 2026-10-18 12:00
+
+import main.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0006_remove_bookllm_text_with_image_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='SHA-256 of the illustration file', max_length=64, verbose_name='Content hash'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True, verbose_name='File size, bytes'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Height, px'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='image_format',
+            field=models.CharField(blank=True, editable=False, max_length=10, verbose_name='Image format'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Width, px'),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='illustration',
+            field=models.ImageField(height_field='height', upload_to=main.models.PathAndRename('books/image/illustration'), verbose_name='Illustration', width_field='width'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0007_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookfile',
+            name='format',
+            field=models.CharField(choices=[('pdf', 'PDF'), ('epub', 'EPUB'), ('html', 'HTML')], default='pdf', max_length=10, verbose_name='Format'),
+        ),
+        migrations.AddField(
+            model_name='bookfile',
+            name='source_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the structured text the file was built from', max_length=64, verbose_name='Source hash'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0008_bookfile_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='degradation',
+            field=models.JSONField(blank=True, default=dict, help_text='What was simplified to meet the latency budget of the request', verbose_name='Degradation'),
+        ),
+    ]
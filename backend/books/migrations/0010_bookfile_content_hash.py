@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0009_book_degradation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookfile',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the file, used as its ETag', max_length=64, verbose_name='Content hash'),
+        ),
+    ]
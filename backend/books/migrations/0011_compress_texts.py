@@ -0,0 +1,95 @@
+# Generated by Django 6.0 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+import books.fields
+
+
+BATCH_SIZE = 200
+
+
+def copy_texts(apps, source, target):
+    """
+    Copies source into target for every Book and BookLlm, in batches ordered by pk,
+    so that only one batch of texts is in memory at a time.
+    """
+    for model_name in ('Book', 'BookLlm'):
+        model = apps.get_model('books', model_name)
+        last_pk = 0
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', source)[:BATCH_SIZE])
+            if not batch:
+                break
+            for instance in batch:
+                setattr(instance, target, getattr(instance, source))
+            model.objects.bulk_update(batch, [target])
+            last_pk = batch[-1].pk
+            print(f"  {model_name}: {target} is filled up to pk {last_pk}")
+
+
+def compress_texts(apps, schema_editor):
+    copy_texts(apps, 'text', 'text_compressed')
+
+
+def decompress_texts(apps, schema_editor):
+    copy_texts(apps, 'text_compressed', 'text')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0010_bookfile_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='text_compressed',
+            field=books.fields.CompressedTextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='bookllm',
+            name='text_compressed',
+            field=books.fields.CompressedTextField(dictionary='book_llm', null=True),
+        ),
+        # Nullable, so that the migration can be reversed
+        migrations.AlterField(
+            model_name='book',
+            name='text',
+            field=models.TextField(null=True, verbose_name='Text of the book'),
+        ),
+        migrations.AlterField(
+            model_name='bookllm',
+            name='text',
+            field=models.TextField(help_text='Structured text of the book created by LLM', null=True, verbose_name='Structured text of the book'),
+        ),
+        migrations.RunPython(compress_texts, decompress_texts),
+        migrations.RemoveField(
+            model_name='book',
+            name='text',
+        ),
+        migrations.RemoveField(
+            model_name='bookllm',
+            name='text',
+        ),
+        migrations.RenameField(
+            model_name='book',
+            old_name='text_compressed',
+            new_name='text',
+        ),
+        migrations.RenameField(
+            model_name='bookllm',
+            old_name='text_compressed',
+            new_name='text',
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='text',
+            field=books.fields.CompressedTextField(verbose_name='Text of the book'),
+        ),
+        migrations.AlterField(
+            model_name='bookllm',
+            name='text',
+            field=books.fields.CompressedTextField(dictionary='book_llm', help_text='Structured text of the book created by LLM', verbose_name='Structured text of the book'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-18 17:00
+
+from django.db import migrations
+
+from books import search
+
+
+def create_index(apps, schema_editor):
+    search.create_tables(schema_editor)
+    search.rebuild(apps)
+
+
+def drop_index(apps, schema_editor):
+    search.drop_tables(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0011_compress_texts'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-18 18:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from books.similarity import minhash, band_keys
+
+
+BATCH_SIZE = 500
+
+
+def index_prompts(apps, schema_editor):
+    """
+    Computes the MinHash signatures and band keys of existing prompts, in batches ordered by pk.
+    """
+    Image = apps.get_model('books', 'Image')
+    ImagePromptBand = apps.get_model('books', 'ImagePromptBand')
+    last_pk = 0
+    while batch := list(Image.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'image_prompt')[:BATCH_SIZE]):
+        bands = []
+        for image in batch:
+            image.prompt_minhash = minhash(image.image_prompt)
+            bands += [ImagePromptBand(image=image, key=key) for key in band_keys(image.prompt_minhash)]
+        Image.objects.bulk_update(batch, ['prompt_minhash'])
+        ImagePromptBand.objects.bulk_create(bands)
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0012_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='prompt_minhash',
+            field=models.BinaryField(blank=True, default=b'', help_text='Signature of the prompt for finding illustrations of similar prompts', verbose_name='Prompt MinHash'),
+        ),
+        migrations.CreateModel(
+            name='ImagePromptBand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField(db_index=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prompt_bands', to='books.image')),
+            ],
+        ),
+        migrations.RunPython(index_prompts, migrations.RunPython.noop),
+    ]
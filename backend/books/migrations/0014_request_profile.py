@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-18 19:00
+
+import django.db.models.deletion
+import main.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0013_image_prompt_minhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='Дата изменения')),
+                ('method', models.CharField(max_length=10, verbose_name='Method')),
+                ('path', models.CharField(max_length=500, verbose_name='Path')),
+                ('status_code', models.PositiveSmallIntegerField(verbose_name='Status code')),
+                ('duration', models.FloatField(verbose_name='Duration, s')),
+                ('trigger', models.CharField(choices=[('header', 'X-Profile header'), ('sample', 'Sampled'), ('slow', 'Slow request')], max_length=10, verbose_name='Trigger')),
+                ('profiler', models.CharField(choices=[('cprofile', 'cProfile and tracemalloc'), ('sampling', 'Stack sampling')], max_length=10, verbose_name='Profiler')),
+                ('memory_peak', models.PositiveBigIntegerField(blank=True, null=True, verbose_name='Peak traced memory, bytes')),
+                ('report', models.TextField(blank=True, verbose_name='Report')),
+                ('file', models.FileField(help_text='pstats dump (.prof) or collapsed stacks (.txt)', max_length=500, upload_to=main.models.PathAndRename('books/request_profile/file'), verbose_name='Profile file')),
+                ('book', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='profiles', to='books.book', verbose_name='Book')),
+            ],
+            options={
+                'ordering': ['-created'],
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-18 20:00
+
+import main.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0014_request_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='original',
+            field=models.FileField(blank=True, help_text='The picture as it was generated, before conversion to the storage format', upload_to=main.models.PathAndRename('books/image/original'), verbose_name='Original'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 6.0 on 2026-10-19 00:04
+
+import os
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_test_images(apps, schema_editor):
+    """
+    Existing copies of the test_images files are recognized by their hash and taken out of the reuse index.
+    Placeholders saved before cannot be told apart from generated pictures and stay as they are.
+    """
+    Image = apps.get_model('books', 'Image')
+    ImagePromptBand = apps.get_model('books', 'ImagePromptBand')
+    test_images_dir = os.path.join(settings.BASE_DIR, 'test_images')
+    if not os.path.isdir(test_images_dir):
+        return
+    hashes = set()
+    for name in os.listdir(test_images_dir):
+        with open(os.path.join(test_images_dir, name), 'rb') as f:
+            hashes.add(hashlib.sha256(f.read()).hexdigest())
+    test_images = Image.objects.filter(content_hash__in=hashes)
+    ImagePromptBand.objects.filter(image__in=test_images).delete()
+    test_images.update(source='test')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_image_original'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='source',
+            field=models.CharField(choices=[('generated', 'Generated'), ('reused', 'Reused'), ('placeholder', 'Placeholder'), ('test', 'Test image')], default='generated', editable=False, help_text='Placeholders and test images are not reused for similar prompts', max_length=20, verbose_name='Source'),
+        ),
+        migrations.RunPython(mark_test_images, migrations.RunPython.noop),
+    ]
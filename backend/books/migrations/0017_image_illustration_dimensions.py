@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-19 00:06
+
+import main.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0016_image_source'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='illustration',
+            field=models.ImageField(upload_to=main.models.PathAndRename('books/image/illustration'), verbose_name='Illustration'),
+        ),
+    ]
@@ -1,6 +1,12 @@
+import hashlib
+
 from django.db import models
 from main.models import Date, Common, PathAndRename
 
+from .fields import CompressedTextField
+from .images import read_image_metadata
+from .similarity import minhash, band_keys
+
 
 class Book(Date):
     title = models.CharField(
@@ -13,9 +19,15 @@ class Book(Date):
         max_length=255,
         blank=True
     )
-    text = models.TextField(
+    text = CompressedTextField(
         verbose_name="Text of the book"
     )
+    degradation = models.JSONField(
+        verbose_name="Degradation",
+        help_text='What was simplified to meet the latency budget of the request',
+        default=dict,
+        blank=True,
+    )
 
     def __str__(self):
         return f'id:{self.id}, title:{self.title}'
@@ -28,8 +40,9 @@ class BookLlm(Common):
         on_delete=models.CASCADE,
         verbose_name="Book",
     )
-    text = models.TextField(
+    text = CompressedTextField(
         verbose_name="Structured text of the book",
+        dictionary='book_llm',
         help_text='Structured text of the book created by LLM',
     )
 
@@ -38,6 +51,18 @@ class BookLlm(Common):
 
 
 class Image(Common):
+
+    class Source(models.TextChoices):
+        GENERATED = 'generated', 'Generated'
+        REUSED = 'reused', 'Reused'
+        PLACEHOLDER = 'placeholder', 'Placeholder'
+        TEST = 'test', 'Test image'
+
+    # Pictures offered for prompts similar to theirs, see books.similarity
+    REUSABLE_SOURCES = (Source.GENERATED, Source.REUSED)
+    # Filled from the illustration file by update_metadata
+    METADATA_FIELDS = ('width', 'height', 'file_size', 'image_format', 'content_hash')
+
     title = models.CharField(
         verbose_name="Illustration title",
         max_length=255,
@@ -53,17 +78,154 @@ class Image(Common):
         verbose_name='Illustration',
         upload_to=PathAndRename('books/image/illustration'),
     )
+    original = models.FileField(
+        verbose_name='Original',
+        help_text='The picture as it was generated, before conversion to the storage format',
+        upload_to=PathAndRename('books/image/original'),
+        blank=True,
+    )
     image_prompt =  models.CharField(
         verbose_name="Illustration prompt",
         max_length=2000,
         blank=True
     )
+    source = models.CharField(
+        verbose_name='Source',
+        help_text='Placeholders and test images are not reused for similar prompts',
+        choices=Source.choices,
+        default=Source.GENERATED,
+        max_length=20,
+        editable=False,
+    )
+    # Filled by update_metadata. Not width_field/height_field of the ImageField: those decode
+    # the file on every load of a row without dimensions and raise when it is missing
+    width = models.PositiveIntegerField(
+        verbose_name='Width, px',
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    height = models.PositiveIntegerField(
+        verbose_name='Height, px',
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    file_size = models.PositiveBigIntegerField(
+        verbose_name='File size, bytes',
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    image_format = models.CharField(
+        verbose_name='Image format',
+        max_length=10,
+        blank=True,
+        editable=False,
+    )
+    content_hash = models.CharField(
+        verbose_name='Content hash',
+        help_text='SHA-256 of the illustration file',
+        max_length=64,
+        blank=True,
+        db_index=True,
+        editable=False,
+    )
+    prompt_minhash = models.BinaryField(
+        verbose_name='Prompt MinHash',
+        help_text='Signature of the prompt for finding illustrations of similar prompts',
+        blank=True,
+        default=b'',
+        editable=False,
+    )
+
+    _loaded_illustration_name = None
+    _loaded_source = None
 
     def __str__(self):
         return f'id:{self.id}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'illustration' in instance.__dict__:
+            instance._loaded_illustration_name = instance.illustration.name
+        instance._loaded_source = instance.__dict__.get('source')
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        # Fields computed here are saved along with the ones the caller asked for
+        computed_fields = set()
+        if self.illustration and (
+            not self.content_hash
+            or not self.illustration._committed
+            or self.illustration.name != self._loaded_illustration_name
+        ):
+            self.update_metadata()
+            computed_fields.update(self.METADATA_FIELDS)
+
+        signature = minhash(self.image_prompt) if update_fields is None or 'image_prompt' in update_fields else None
+        prompt_changed = signature is not None and signature != bytes(self.prompt_minhash)
+        if prompt_changed:
+            self.prompt_minhash = signature
+            computed_fields.add('prompt_minhash')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, *computed_fields}
+        source_changed = self.source != self._loaded_source and (update_fields is None or 'source' in update_fields)
+        super().save(*args, **kwargs)
+        self._loaded_illustration_name = self.illustration.name
+        self._loaded_source = self.source
+        if prompt_changed or source_changed:
+            self.update_prompt_bands()
+
+    def update_prompt_bands(self):
+        """
+        Replaces the locality-sensitive hashing keys of the prompt, see books.similarity.
+        Placeholders and test images get none, they are never offered for reuse.
+        """
+        self.prompt_bands.all().delete()
+        if self.source in self.REUSABLE_SOURCES:
+            ImagePromptBand.objects.bulk_create(
+                ImagePromptBand(image=self, key=key) for key in band_keys(bytes(self.prompt_minhash))
+            )
+
+    def update_metadata(self):
+        """
+        Reads the illustration once and stores its dimensions, size, format and hash.
+        A missing or unreadable file leaves them empty, the row is saved anyway.
+        """
+        try:
+            metadata = read_image_metadata(self.illustration.file)
+        except (OSError, ValueError) as e:
+            print(f"  ⚠️ Could not read the illustration {self.illustration.name} of image {self.pk}: {e}")
+            return
+        for field, value in metadata.items():
+            setattr(self, field, value)
+        if self.illustration._committed:
+            self.illustration.close()
+
+
+class ImagePromptBand(models.Model):
+    """
+    One band key of the MinHash signature of an illustration prompt.
+    Illustrations sharing any key with a prompt are the candidates for its reuse.
+    """
+    image = models.ForeignKey(
+        to=Image,
+        related_name='prompt_bands',
+        on_delete=models.CASCADE,
+    )
+    key = models.BigIntegerField(db_index=True)
+
 
 class BookFile(Common):
+
+    class Format(models.TextChoices):
+        PDF = 'pdf', 'PDF'
+        EPUB = 'epub', 'EPUB'
+        HTML = 'html', 'HTML'
+
     book = models.ForeignKey(
         to=Book,
         related_name='files',
@@ -77,6 +239,117 @@ class BookFile(Common):
         blank=True,
         null=True,
     )
+    format = models.CharField(
+        verbose_name='Format',
+        choices=Format.choices,
+        default=Format.PDF,
+        max_length=10,
+    )
+    source_hash = models.CharField(
+        verbose_name='Source hash',
+        help_text='SHA-256 of the structured text the file was built from',
+        max_length=64,
+        blank=True,
+        editable=False,
+    )
+    content_hash = models.CharField(
+        verbose_name='Content hash',
+        help_text='SHA-256 of the file, used as its ETag',
+        max_length=64,
+        blank=True,
+        editable=False,
+    )
 
     def __str__(self):
-        return f'id:{self.id}, title:{self.book.title}'
\ No newline at end of file
+        return f'id:{self.id}, title:{self.book.title}'
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.content_hash:
+            self.update_content_hash()
+        super().save(*args, **kwargs)
+
+    def update_content_hash(self):
+        """
+        Hashes the file in chunks, without reading it into memory at once.
+        Reads it through the storage: a FieldFile closed here could not be sent in the response afterwards.
+        """
+        sha256 = hashlib.sha256()
+        with self.file.storage.open(self.file.name, 'rb') as f:
+            for chunk in f.chunks():
+                sha256.update(chunk)
+        self.content_hash = sha256.hexdigest()
+
+
+class RequestProfile(Date):
+    """
+    Profile of an API request, see books.profiling.
+    """
+
+    class Trigger(models.TextChoices):
+        HEADER = 'header', 'X-Profile header'
+        SAMPLE = 'sample', 'Sampled'
+        SLOW = 'slow', 'Slow request'
+
+    class Profiler(models.TextChoices):
+        CPROFILE = 'cprofile', 'cProfile and tracemalloc'
+        SAMPLING = 'sampling', 'Stack sampling'
+
+    book = models.ForeignKey(
+        to=Book,
+        related_name='profiles',
+        on_delete=models.CASCADE,
+        verbose_name="Book",
+        blank=True,
+        null=True,
+    )
+    method = models.CharField(
+        verbose_name='Method',
+        max_length=10,
+    )
+    path = models.CharField(
+        verbose_name='Path',
+        max_length=500,
+    )
+    status_code = models.PositiveSmallIntegerField(
+        verbose_name='Status code',
+    )
+    duration = models.FloatField(
+        verbose_name='Duration, s',
+    )
+    trigger = models.CharField(
+        verbose_name='Trigger',
+        choices=Trigger.choices,
+        max_length=10,
+    )
+    profiler = models.CharField(
+        verbose_name='Profiler',
+        choices=Profiler.choices,
+        max_length=10,
+    )
+    memory_peak = models.PositiveBigIntegerField(
+        verbose_name='Peak traced memory, bytes',
+        blank=True,
+        null=True,
+    )
+    report = models.TextField(
+        verbose_name='Report',
+        blank=True,
+    )
+    file = models.FileField(
+        verbose_name='Profile file',
+        help_text='pstats dump (.prof) or collapsed stacks (.txt)',
+        upload_to=PathAndRename('books/request_profile/file'),
+        max_length=500,
+    )
+
+    def __str__(self):
+        return f'id:{self.id}, {self.method} {self.path}'
+
+    @classmethod
+    def prune(cls, keep):
+        """
+        Deletes all but the newest `keep` profiles, with their files.
+        """
+        old = cls.objects.order_by('-created', '-pk').values_list('pk', flat=True)[keep:]
+        for profile in cls.objects.filter(pk__in=list(old)):
+            profile.delete()
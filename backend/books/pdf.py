@@ -0,0 +1,261 @@
+"""
+PDF rendering with reportlab.
+
+The module deliberately does not import Django, so that it can be loaded
+by the spawned worker processes of the parallel renderer.
+"""
+import os
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfWriter
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+
+# Rough layout cost of an illustration expressed in characters of text
+IMAGE_WEIGHT = 2000
+
+# Style attributes that affect how a paragraph is parsed and broken into lines
+LAYOUT_STYLE_ATTRS = (
+    'name', 'fontName', 'fontSize', 'leading', 'alignment', 'firstLineIndent',
+    'leftIndent', 'rightIndent', 'wordWrap', 'autoLeading', 'splitLongWords',
+)
+
+
+class LayoutCache:
+    """
+    LRU cache of parsed and line-broken paragraphs, bounded by an approximate memory budget.
+    Lives for the whole process, so rebuilds of a book reuse the layout of unchanged text.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+
+
+layout_cache = LayoutCache()
+
+
+class CachedParagraph(Paragraph):
+    """
+    Paragraph that takes its parsed fragments and line breaks from layout_cache,
+    keyed by (text hash, style, frame width).
+    The pieces a paragraph is split into at page breaks are not cached.
+    """
+
+    def __init__(self, text, style=None, bulletText=None, frags=None, **kwargs):
+        self._layout_key = None
+        if frags is not None or style is None:
+            super().__init__(text, style, bulletText=bulletText, frags=frags, **kwargs)
+            return
+
+        self._layout_key = (
+            hashlib.blake2b(text.encode(), digest_size=16).digest(),
+            tuple(getattr(style, attr, None) for attr in LAYOUT_STYLE_ATTRS),
+        )
+        # Line lists and fragments take a few times the size of the text itself
+        self._layout_size = 4 * len(text) + 512
+
+        parsed = layout_cache.get(self._layout_key)
+        if parsed is None:
+            super().__init__(text, style, bulletText=bulletText, **kwargs)
+            layout_cache.set(self._layout_key, (self.frags, self.bulletText), self._layout_size)
+        else:
+            frags, bulletText = parsed
+            super().__init__(text, style, bulletText=bulletText, frags=frags, **kwargs)
+
+    def wrap(self, availWidth, availHeight):
+        if self._layout_key is None:
+            return super().wrap(availWidth, availHeight)
+
+        key = self._layout_key + (availWidth,)
+        wrapped = layout_cache.get(key)
+        if wrapped is None:
+            super().wrap(availWidth, availHeight)
+            layout_cache.set(key, (self._wrapWidths, self.blPara, self.height), self._layout_size)
+        else:
+            self.width = availWidth
+            self._wrapWidths, self.blPara, self.height = wrapped
+        return self.width, self.height
+
+
+def get_styles():
+    styles = getSampleStyleSheet()
+
+    # Font setup
+    font_path = "DejaVu_Sans/DejaVuSans.ttf"
+    if os.path.exists(font_path):
+        pdfmetrics.registerFont(TTFont('DejaVuSans', font_path))
+        font_name = 'DejaVuSans'
+    else:
+        font_name = 'Helvetica'
+
+    styles.add(ParagraphStyle(name='BookText', fontName=font_name, fontSize=14, leading=18, spaceAfter=12))
+    styles.add(ParagraphStyle(name='BookTitle', fontName=font_name, fontSize=28, alignment=1, spaceAfter=30))
+    styles.add(ParagraphStyle(name='BookAuthor', fontName=font_name, fontSize=18, alignment=1, spaceAfter=50))
+    return styles
+
+
+def iter_story(book_data, content, styles, title_page=True):
+    """
+    Yields flowables one by one. Illustrations are opened only to be measured
+    and drawn and are released right after (lazy=2).
+    """
+    # Title page
+    if title_page:
+        yield Spacer(1, 2 * inch)
+        yield CachedParagraph(book_data.get("title", "Book"), styles['BookTitle'])
+        yield CachedParagraph(book_data.get("author", ""), styles['BookAuthor'])
+        yield PageBreak()
+
+    # Main content
+    for item in content:
+        if item["type"] == "text":
+            text_data = item["data"].replace("\n", "<br/>")
+            yield CachedParagraph(text_data, styles['BookText'])
+        elif item["type"] == "image_prompt" and "image_path" in item:
+            img_path = item["image_path"]
+            if os.path.exists(img_path):
+                yield RLImage(img_path, width=5.5*inch, height=5.5*inch, kind='proportional', lazy=2)
+                yield Spacer(1, 12)
+
+
+class LazyStory(list):
+    """
+    Story list for reportlab that is filled from a flowable generator as the
+    document consumes it, so only a small window of flowables exists at a time.
+    reportlab checks len() before taking every flowable, which triggers a refill.
+    """
+
+    def __init__(self, flowables, lookahead=16):
+        super().__init__()
+        self._flowables = iter(flowables)
+        self._lookahead = lookahead
+
+    def __len__(self):
+        while super().__len__() < self._lookahead:
+            flowable = next(self._flowables, None)
+            if flowable is None:
+                break
+            self.append(flowable)
+        return super().__len__()
+
+
+def render_part(book_data, content, output_filename, title_page=True):
+    """
+    Renders the title page (optionally) and the given content items into one PDF file.
+    """
+    doc = SimpleDocTemplate(output_filename, pagesize=letter)
+    doc.build(LazyStory(iter_story(book_data, content, get_styles(), title_page)))
+    return output_filename
+
+
+def split_content(content, parts):
+    """
+    Splits content items into consecutive chunks of roughly equal layout cost.
+    An illustration stays in the same chunk as the text that precedes it.
+    """
+    weights = [len(item["data"]) if item["type"] == "text" else IMAGE_WEIGHT for item in content]
+    target = sum(weights) / parts
+
+    chunks, chunk, chunk_weight = [], [], 0
+    for item, weight in zip(content, weights):
+        if chunk_weight >= target and item["type"] == "text" and len(chunks) < parts - 1:
+            chunks.append(chunk)
+            chunk, chunk_weight = [], 0
+        chunk.append(item)
+        chunk_weight += weight
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def create_pdf(book_data, output_filename="generated_book.pdf", workers=1, min_parallel_items=200):
+    """
+    Creates a PDF file based on the received data.
+    Books with at least min_parallel_items content blocks are rendered in parts
+    by a pool of worker processes, and the parts are merged into one file.
+    Every part starts on a new page.
+    """
+    print(f"📚 Create a PDF: {output_filename}...")
+    content = book_data.get("content", [])
+
+    if workers <= 1 or len(content) < min_parallel_items:
+        render_part(book_data, content, output_filename)
+        print(f"✨ PDF is ready: {output_filename}")
+        return
+
+    chunks = split_content(content, workers)
+    part_filenames = [f"{output_filename}.part{index}" for index in range(len(chunks))]
+    print(f"  - Rendering {len(chunks)} parts with {workers} workers...")
+
+    try:
+        # spawn: forking a process with a running web server and its threads is unsafe,
+        # and one task per child returns the memory of every part to the system
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            max_tasks_per_child=1,
+        ) as executor:
+            futures = [
+                executor.submit(render_part, book_data | {"content": []}, chunk, part_filename, index == 0)
+                for index, (chunk, part_filename) in enumerate(zip(chunks, part_filenames))
+            ]
+            for future in futures:
+                future.result()
+
+        writer = PdfWriter()
+        for part_filename in part_filenames:
+            writer.append(part_filename)
+        writer.write(output_filename)
+        writer.close()
+    finally:
+        for part_filename in part_filenames:
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+
+    print(f"✨ PDF is ready: {output_filename}")
@@ -0,0 +1,282 @@
+import io
+import os
+import sys
+import time
+import random
+import marshal
+import pstats
+import cProfile
+import threading
+import itertools
+import tracemalloc
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+PROFILE_HEADER = 'X-Profile'
+# Views whose pk kwarg is a book id, other responses name the book in the X-Book-Id header
+BOOK_URL_NAMES = {'book-detail', 'book-export', 'book-files'}
+REPORT_LINES = 40
+
+# cProfile (sys.monitoring since Python 3.12) and tracemalloc are process-wide,
+# only one request at a time is profiled with them
+_deep_lock = threading.Lock()
+
+
+class StackSampler:
+    """
+    One background thread that records the stacks of the threads of all sampled requests
+    every PROFILING_SAMPLE_INTERVAL seconds. Cheap enough to run on every request,
+    so that the profile of an unexpectedly slow request is already there when it ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sampled = {}
+        self._tokens = itertools.count()
+        self._labels = {}
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            token = next(self._tokens)
+            self._sampled[token] = (thread_id, Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+                self._thread.start()
+        return token
+
+    def stop(self, token):
+        with self._lock:
+            return self._sampled.pop(token)[1]
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})'
+        return label
+
+    def _stack(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def _run(self):
+        while True:
+            time.sleep(settings.PROFILING_SAMPLE_INTERVAL)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._sampled.values():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self._stack(frame)] += 1
+            del frames
+
+
+sampler = StackSampler()
+
+
+def _short_path(filename):
+    # Relative to the longest sys.path entry it is under, as in tracebacks of installed packages
+    for entry in sorted(filter(None, sys.path), key=len, reverse=True):
+        if filename.startswith(entry + os.sep):
+            return filename[len(entry) + 1:]
+    return filename
+
+
+def _sampled_report(samples):
+    """
+    Functions by inclusive and by self samples, the collapsed stacks themselves go to the file.
+    """
+    total = sum(samples.values())
+    inclusive, own = Counter(), Counter()
+    for stack, count in samples.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+    lines = [f'{total} samples every {settings.PROFILING_SAMPLE_INTERVAL * 1000:g} ms']
+    for title, counter in (('Inclusive', inclusive), ('Self', own)):
+        lines += ['', f'{title} samples:']
+        lines += [f'{count:8d} {count / total:6.1%}  {frame}' for frame, count in counter.most_common(REPORT_LINES)]
+    return '\n'.join(lines)
+
+
+def _memory_report(snapshot, peak):
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*'),
+    ))
+    lines = [f'Peak traced memory: {peak / 1024 / 1024:.1f} MB', '', 'Allocated at the end of the request:']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:REPORT_LINES // 2]]
+    return '\n'.join(lines)
+
+
+class RequestProfiler:
+    """
+    Profile of one request: cProfile and tracemalloc when it is profiled on purpose,
+    the stack sampler when it is only watched for being slow.
+    """
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.profile = None
+        self.samples = None
+        self.memory = None
+        self.duration = None
+
+    def start(self):
+        if self.trigger != 'slow' and _deep_lock.acquire(blocking=False):
+            self.profile = cProfile.Profile()
+            tracemalloc.start()
+            self.profile.enable()
+        else:
+            # Another request holds the process-wide profilers, or the request may turn out slow
+            self.samples = sampler.start(threading.get_ident())
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        if self.profile is not None:
+            self.profile.disable()
+            try:
+                self.memory = tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+                _deep_lock.release()
+        else:
+            self.samples = sampler.stop(self.samples)
+
+    def wanted(self):
+        return self.trigger != 'slow' or self.duration >= settings.PROFILING_SLOW_SECONDS
+
+    def save(self, request, response):
+        """
+        Saves the profile. A failure is only logged, it never replaces the response of the request.
+        """
+        from .models import RequestProfile
+
+        profile = None
+        try:
+            profile = self._profile(request, response)
+            profile.save()
+            RequestProfile.prune(settings.PROFILING_MAX_PROFILES)
+        except Exception as e:
+            print(f"  ❌ Could not save the profile of {request.method} {request.path}: {e}")
+            # The file is written before the row, it would be left without one
+            if profile is not None and profile.pk is None and profile.file:
+                profile.file.delete(save=False)
+            return
+        print(f"  ⏱️ {self.trigger} profile of {request.method} {request.path} ({self.duration:.2f}s) saved, id {profile.id}")
+
+    def _profile(self, request, response):
+        from .models import Book, RequestProfile
+
+        book_id = _book_id(request, response)
+        # The book may not exist, or the request itself deleted it
+        if book_id is not None and not Book.objects.filter(pk=book_id).exists():
+            book_id = None
+        profile = RequestProfile(
+            book_id=book_id,
+            method=request.method,
+            path=request.get_full_path()[:500],
+            status_code=response.status_code,
+            duration=self.duration,
+            trigger=self.trigger,
+        )
+        if self.profile is not None:
+            stats = pstats.Stats(self.profile, stream=io.StringIO())
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_LINES)
+            snapshot, peak = self.memory
+            profile.profiler = RequestProfile.Profiler.CPROFILE
+            profile.memory_peak = peak
+            profile.report = f'{stats.stream.getvalue().strip()}\n\n{_memory_report(snapshot, peak)}'
+            # The format of pstats.Stats.dump_stats, readable by pstats and snakeviz
+            profile.file.save('profile.prof', ContentFile(marshal.dumps(stats.stats)), save=False)
+        else:
+            profile.profiler = RequestProfile.Profiler.SAMPLING
+            profile.report = _sampled_report(self.samples) if self.samples else 'No samples'
+            # Collapsed stacks for flamegraph.pl or speedscope
+            collapsed = '\n'.join(f'{stack} {count}' for stack, count in self.samples.items())
+            profile.file.save('profile.txt', ContentFile(collapsed.encode()), save=False)
+        return profile
+
+
+def _book_id(request, response):
+    book_id = response.get('X-Book-Id')
+    match = request.resolver_match
+    if book_id is None and match is not None and match.url_name in BOOK_URL_NAMES:
+        book_id = match.kwargs.get('pk')
+    return int(book_id) if book_id and str(book_id).isdigit() else None
+
+
+def _header_asked(request):
+    return settings.PROFILING_HEADER and request.path.startswith(settings.PROFILING_PATH_PREFIX) and bool(
+        request.headers.get(PROFILE_HEADER)
+    )
+
+
+def _trigger(request, header_allowed=False):
+    """
+    Why the request is profiled, or None. header_allowed: the X-Profile header was sent by a staff user,
+    cProfile and tracemalloc slow down the whole process and other clients cannot turn them on.
+    """
+    if not request.path.startswith(settings.PROFILING_PATH_PREFIX):
+        return None
+    if header_allowed:
+        return 'header'
+    if settings.PROFILING_SAMPLE_RATE and random.random() < settings.PROFILING_SAMPLE_RATE:
+        return 'sample'
+    if settings.PROFILING_SLOW_SECONDS:
+        return 'slow'
+    return None
+
+
+class ProfilingMiddleware:
+    """
+    Profiles API requests of staff users asked for with the X-Profile header, a PROFILING_SAMPLE_RATE share of them,
+    and keeps the stack samples of requests slower than PROFILING_SLOW_SECONDS.
+    Profiles are saved as RequestProfile, linked to the book of the request, and viewed in the admin.
+    Under ASGI the event loop thread runs other requests as well, their frames show up in the profile.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        trigger = _trigger(request, _header_asked(request) and request.user.is_staff)
+        if trigger is None:
+            return self.get_response(request)
+        profiler = RequestProfiler(trigger)
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+        if profiler.wanted():
+            profiler.save(request, response)
+        return response
+
+    async def __acall__(self, request):
+        trigger = _trigger(request, _header_asked(request) and (await request.auser()).is_staff)
+        if trigger is None:
+            return await self.get_response(request)
+        profiler = RequestProfiler(trigger)
+        profiler.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.stop()
+        if profiler.wanted():
+            await sync_to_async(profiler.save)(request, response)
+        return response
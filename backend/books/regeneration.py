@@ -0,0 +1,125 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connection
+
+from .export import export_book
+from .generation import regenerate_image, save_book_llm
+from .models import Book, BookFile
+
+# Books being regenerated in this process, a second request for one of them is skipped
+_in_progress = set()
+_in_progress_lock = threading.Lock()
+
+
+def _book_formats(book, formats):
+    if formats:
+        return list(formats)
+    existing = book.files.filter(status=BookFile.Status.PUBLISHED).exclude(file='')
+    return sorted(set(existing.values_list('format', flat=True))) or [BookFile.Format.PDF]
+
+
+def regenerate_book(book_id, images=True, image_ids=None, formats=None):
+    """
+    Redraws the illustrations of a book (all, or those of image_ids) and rebuilds its files
+    in the given formats, by default in the formats it already has, replacing its published files of those formats.
+    A picture that fails keeps its old file, the rest of the book is regenerated anyway.
+    Returns the number of redrawn and failed pictures.
+    """
+    book = Book.objects.get(pk=book_id)
+    book_llm = book.llm_texts.order_by('-created').first()
+    if book_llm is None:
+        raise ValueError("The book has no structured text yet")
+    book_data = json.loads(book_llm.text)
+
+    redrawn = failed = 0
+    if images:
+        used_paths = {item.get("image_path") for item in book_data.get("content", []) if item["type"] == "image_prompt"}
+        queryset = book.images.exclude(illustration='').order_by('pk')
+        if image_ids is not None:
+            queryset = queryset.filter(pk__in=image_ids)
+        replaced = {}
+        for image in queryset:
+            # Pictures of earlier runs that the book no longer shows are left alone
+            if image.illustration.path not in used_paths:
+                continue
+            try:
+                old_path = regenerate_image(image)
+                replaced[old_path] = image.illustration.path
+                redrawn += 1
+            except Exception as e:
+                failed += 1
+                print(f"    ❌ Picture {image.pk} of the book {book.id}: {e}")
+        for item in book_data.get("content", []):
+            if item.get("image_path") in replaced:
+                item["image_path"] = replaced[item["image_path"]]
+        if replaced:
+            save_book_llm(book, book_data, book_llm)
+
+    for export_format in _book_formats(book, formats):
+        book_file = export_book(book, book_data, export_format, rebuild=True)
+        # Published files of the content before regeneration show the old illustrations
+        outdated = book.files.filter(format=export_format, status=BookFile.Status.PUBLISHED).exclude(pk=book_file.pk)
+        for old_file in outdated:
+            old_file.delete()
+    return redrawn, failed
+
+
+def _regenerate_one(book_id, **options):
+    try:
+        return regenerate_book(book_id, **options)
+    finally:
+        connection.close()
+        with _in_progress_lock:
+            _in_progress.discard(book_id)
+
+
+def regenerate_books(book_ids, workers=None, report=print, **options):
+    """
+    Regenerates books through a pool of at most `workers` threads (REGENERATION_WORKERS),
+    reporting every finished book. A failing book does not stop the others.
+    Returns the ids of the books that failed.
+    """
+    with _in_progress_lock:
+        busy = _in_progress.intersection(book_ids)
+        book_ids = [book_id for book_id in dict.fromkeys(book_ids) if book_id not in busy]
+        _in_progress.update(book_ids)
+    for book_id in sorted(busy):
+        report(f"  ⏭ Book {book_id} is already being regenerated")
+
+    total, failed = len(book_ids), []
+    redrawn = failed_images = 0
+    with ThreadPoolExecutor(max_workers=workers or settings.REGENERATION_WORKERS) as executor:
+        futures = {executor.submit(_regenerate_one, book_id, **options): book_id for book_id in book_ids}
+        for done, future in enumerate(as_completed(futures), start=1):
+            book_id = futures[future]
+            try:
+                book_redrawn, book_failed = future.result()
+            except Exception as e:
+                failed.append(book_id)
+                report(f"  ❌ {done}/{total} Book {book_id}: {e}")
+                continue
+            redrawn += book_redrawn
+            failed_images += book_failed
+            report(f"  🔁 {done}/{total} Book {book_id}: {book_redrawn} pictures redrawn, {book_failed} failed")
+
+    report(f"🔁 Regenerated {total - len(failed)} of {total} books, "
+           f"{redrawn} pictures redrawn, {failed_images} pictures failed")
+    return failed
+
+
+def regenerate_books_in_background(book_ids, **options):
+    """
+    Runs regenerate_books in a daemon thread, for admin actions on many books.
+    """
+    def run():
+        try:
+            regenerate_books(book_ids, **options)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run, name='regenerate-books', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,215 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Threads that run the calls of sync hedged requests
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
+
+class ModelStats:
+    """
+    Rolling window of call outcomes of one model.
+    """
+
+    def __init__(self, window):
+        self.calls = deque(maxlen=window)
+
+    def record(self, latency, ok):
+        self.calls.append((latency, ok))
+
+    def latencies(self):
+        return sorted(latency for latency, ok in self.calls if ok)
+
+    def error_rate(self):
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls) if self.calls else 0
+
+    def percentile(self, q):
+        latencies = self.latencies()
+        if not latencies:
+            return None
+        return latencies[int(q * (len(latencies) - 1))]
+
+
+class ModelRouter:
+    """
+    Tries a list of fallback models, ordered by the latency and error rate
+    observed over the last `window` calls of each model.
+    A model with fewer than `min_samples` calls keeps its configured position
+    behind the measured ones. With hedging, if a call runs longer than the p95
+    latency of its model, the next model is called as well and the first
+    successful answer wins.
+    """
+
+    def __init__(self, models, window=50, min_samples=10, hedging=False):
+        self.models = list(models)
+        self.min_samples = min_samples
+        self.hedging = hedging
+        self.stats = {model: ModelStats(window) for model in self.models}
+        self._lock = threading.Lock()
+
+    def record(self, model, latency, ok):
+        with self._lock:
+            self.stats[model].record(latency, ok)
+
+    def _sort_key(self, index, model):
+        stats = self.stats[model]
+        if len(stats.calls) < self.min_samples:
+            return 1, 0, index
+        median = stats.percentile(0.5)
+        if median is None:
+            return 2, 0, index
+        # Expected time until a successful answer when failed calls are retried
+        return 0, median / max(1 - stats.error_rate(), 0.05), index
+
+    def ordered_models(self):
+        with self._lock:
+            keys = {model: self._sort_key(index, model) for index, model in enumerate(self.models)}
+        return sorted(self.models, key=keys.get)
+
+    def expected_latency(self):
+        """
+        Median latency of the model that would be tried first, None until it is measured.
+        """
+        model = self.ordered_models()[0]
+        with self._lock:
+            stats = self.stats[model]
+            if len(stats.calls) < self.min_samples:
+                return None
+            return stats.percentile(0.5)
+
+    def _skip_for_deadline(self, model, deadline):
+        """
+        True if the model is typically slower than what is left of the deadline.
+        """
+        if deadline is None:
+            return False
+        with self._lock:
+            stats = self.stats[model]
+            median = stats.percentile(0.5) if len(stats.calls) >= self.min_samples else None
+        remaining = deadline.remaining()
+        if remaining > 0 and (median is None or median <= remaining):
+            return False
+        print(f"    ⏭ Skipping {model}: {remaining:.1f}s left of the latency budget")
+        deadline.note('skipped_models', model)
+        return True
+
+    def hedge_deadline(self, model):
+        with self._lock:
+            stats = self.stats[model]
+            if not self.hedging or len(stats.calls) < self.min_samples:
+                return None
+            return stats.percentile(0.95)
+
+    def _timed(self, model, request):
+        started = time.monotonic()
+        try:
+            result = request(model)
+        except Exception:
+            self.record(model, time.monotonic() - started, False)
+            raise
+        self.record(model, time.monotonic() - started, True)
+        return result
+
+    async def _atimed(self, model, request):
+        started = time.monotonic()
+        try:
+            result = await request(model)
+        except Exception:
+            self.record(model, time.monotonic() - started, False)
+            raise
+        self.record(model, time.monotonic() - started, True)
+        return result
+
+    def _log_error(self, model, error):
+        print(f"    ❌ Error with {model}: {error}")
+        return "429" in str(error)
+
+    def call(self, request, deadline=None):
+        """
+        Returns request(model) of the first model that answers without raising.
+        With a deadline, models slower than the remaining budget are skipped.
+        """
+        candidates = self.ordered_models()
+        while candidates:
+            model = candidates.pop(0)
+            if self._skip_for_deadline(model, deadline):
+                continue
+            print(f"    - Trying with {model}...")
+            hedge_after = self.hedge_deadline(model) if candidates else None
+
+            if hedge_after is None:
+                try:
+                    return self._timed(model, request)
+                except Exception as e:
+                    # Under a latency budget the next model is better than waiting
+                    if self._log_error(model, e) and deadline is None:
+                        print("    ⌛ Limit reached, wait 10 seconds...")
+                        time.sleep(10)
+                    continue
+
+            futures = {hedge_executor.submit(self._timed, model, request): model}
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                hedge = candidates.pop(0)
+                print(f"    ⏱ {model} is slower than {hedge_after:.1f}s, hedging with {hedge}...")
+                futures[hedge_executor.submit(self._timed, hedge, request)] = hedge
+
+            # A slower call that lost the race keeps running and is still recorded
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        self._log_error(futures[future], e)
+
+        raise Exception("Unable to get a response from any of the Gemini models.")
+
+    async def acall(self, request, deadline=None):
+        """
+        Async version of call, request(model) returns a coroutine.
+        The call that loses a hedged race is cancelled.
+        """
+        candidates = self.ordered_models()
+        while candidates:
+            model = candidates.pop(0)
+            if self._skip_for_deadline(model, deadline):
+                continue
+            print(f"    - Trying with {model}...")
+            hedge_after = self.hedge_deadline(model) if candidates else None
+
+            if hedge_after is None:
+                try:
+                    return await self._atimed(model, request)
+                except Exception as e:
+                    # Under a latency budget the next model is better than waiting
+                    if self._log_error(model, e) and deadline is None:
+                        print("    ⌛ Limit reached, wait 10 seconds...")
+                        await asyncio.sleep(10)
+                    continue
+
+            tasks = {asyncio.create_task(self._atimed(model, request)): model}
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                hedge = candidates.pop(0)
+                print(f"    ⏱ {model} is slower than {hedge_after:.1f}s, hedging with {hedge}...")
+                tasks[asyncio.create_task(self._atimed(hedge, request))] = hedge
+
+            pending = set(tasks)
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        try:
+                            return task.result()
+                        except Exception as e:
+                            self._log_error(tasks[task], e)
+            finally:
+                for task in pending:
+                    task.cancel()
+
+        raise Exception("Unable to get a response from any of the Gemini models.")
@@ -0,0 +1,336 @@
+import math
+import time
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+# Lease of the book being generated in the current context, charged for its illustrations
+current_lease = ContextVar('current_lease', default=None)
+
+# Idle clients are forgotten once there are more than this many
+MAX_IDLE_CLIENTS = 1000
+
+
+class QuotaExceeded(Exception):
+    """
+    The client has to retry after retry_after seconds (429 Too Many Requests).
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    """
+    Images per minute of one client. A book reserves its estimated illustrations when it is admitted
+    and gets back what it did not use when it ends. Illustrations beyond the estimate are charged
+    as they are generated, they can leave the bucket in debt, and new books wait until it is paid off.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, count=1):
+        """
+        Seconds until a new book of count illustrations can be admitted, 0 if it can now.
+        A book larger than the whole bucket only waits for a full one.
+        """
+        self._refill()
+        needed = min(count, self.capacity)
+        return 0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def charge(self, count):
+        self._refill()
+        self.tokens -= count
+
+    def refund(self, count):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + count)
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class Client:
+    def __init__(self, key, weight, images_per_minute):
+        self.key = key
+        self.weight = weight
+        # Stride scheduling: a client is served when its pass is the lowest, and every served
+        # book moves the pass by 1 / weight, so a client with weight 2 gets twice the slots
+        self.pass_ = 0.0
+        self.running = 0
+        self.waiting = deque()
+        self.bucket = TokenBucket(images_per_minute) if images_per_minute else None
+
+    def in_flight(self):
+        return self.running + len(self.waiting)
+
+    def idle(self):
+        return not self.in_flight() and (self.bucket is None or self.bucket.full())
+
+
+class Waiter:
+    """
+    A request waiting for a generation slot, woken up from whatever thread frees one.
+    """
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class Lease:
+    """
+    A generation slot held by a client until its book is finished, including a background final pass.
+    """
+
+    def __init__(self, scheduler, client, reserved=0):
+        self.scheduler = scheduler
+        self.client = client
+        # Illustrations already taken from the quota of the client at admission and not generated yet
+        self.reserved = reserved
+        self.started = time.monotonic()
+        self.released = False
+
+    def charge_images(self, count=1):
+        self.scheduler.charge_images(self, count)
+
+    def release(self):
+        self.scheduler.release(self)
+
+
+class FairScheduler:
+    """
+    Shares `slots` concurrent book generations of the process between API clients.
+    When all slots are busy, a freed slot goes to the waiting client with the lowest
+    stride pass (weighted round-robin), so a batch of one client queues behind itself
+    instead of in front of everybody else. Per client, at most `max_books` books are
+    running or waiting and `images_per_minute` illustrations are generated, a book reserving
+    its estimated illustrations when it is admitted; beyond that, or after waiting
+    `queue_timeout` seconds, QuotaExceeded is raised.
+    """
+
+    def __init__(self, slots, max_books, images_per_minute=0, weights=None, queue_timeout=60):
+        self.slots = slots
+        self.max_books = max_books
+        self.images_per_minute = images_per_minute
+        self.weights = weights or {}
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.clients = {}
+        self.virtual_time = 0.0
+        # Average generation time, for retry hints
+        self.book_seconds = 60.0
+        self._lock = threading.Lock()
+
+    def _client(self, key):
+        client = self.clients.get(key)
+        if client is None:
+            if len(self.clients) > MAX_IDLE_CLIENTS:
+                for idle_key in [k for k, c in self.clients.items() if c.idle()]:
+                    del self.clients[idle_key]
+            client = self.clients[key] = Client(key, self.weights.get(key, 1.0), self.images_per_minute)
+        return client
+
+    def _admit(self, key, images, loop=None):
+        """
+        Checks the quotas, reserves the illustrations and returns a granted waiter, or a waiter queued for a slot.
+        """
+        client = self._client(key)
+        if client.in_flight() >= self.max_books:
+            raise QuotaExceeded(f"Too many books in progress: at most {self.max_books} per client", self.book_seconds)
+        if client.bucket is not None:
+            if retry_after := client.bucket.retry_after(images):
+                raise QuotaExceeded(f"Illustration quota exceeded: {self.images_per_minute} per minute", retry_after)
+            client.bucket.charge(images)
+
+        if not client.in_flight():
+            # A client that was idle does not bank the turns it skipped
+            client.pass_ = max(client.pass_, self.virtual_time)
+        waiter = Waiter(loop)
+        client.waiting.append(waiter)
+        self._dispatch()
+        return client, waiter
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            waiting = [client for client in self.clients.values() if client.waiting]
+            if not waiting:
+                return
+            client = min(waiting, key=lambda c: c.pass_)
+            self.virtual_time = client.pass_
+            client.pass_ += 1 / client.weight
+            client.running += 1
+            self.running += 1
+            client.waiting.popleft().grant()
+
+    def _give_up(self, client, waiter, images):
+        """
+        Removes a waiter from the queue and gives its reservation back.
+        """
+        client.waiting.remove(waiter)
+        if client.bucket is not None:
+            client.bucket.refund(images)
+
+    def _timed_out(self, client, waiter, images):
+        """
+        Gives up a waiter, unless the slot was granted at the last moment.
+        """
+        with self._lock:
+            if waiter.granted:
+                return
+            self._give_up(client, waiter, images)
+        position = sum(len(c.waiting) for c in self.clients.values()) + 1
+        raise QuotaExceeded(
+            "All generation slots are busy, try again later",
+            self.book_seconds * position / self.slots,
+        )
+
+    def acquire(self, key, images=1):
+        """
+        Waits for a generation slot for a book of about `images` illustrations and returns its Lease.
+        """
+        with self._lock:
+            client, waiter = self._admit(key, images)
+        if not waiter.granted:
+            print(f"  🚦 Client {key} waits for a generation slot")
+            if not waiter.event.wait(self.queue_timeout):
+                self._timed_out(client, waiter, images)
+        return self._lease(client, images)
+
+    async def aacquire(self, key, images=1):
+        with self._lock:
+            client, waiter = self._admit(key, images, asyncio.get_running_loop())
+        if not waiter.granted:
+            print(f"  🚦 Client {key} waits for a generation slot")
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._timed_out(client, waiter, images)
+            except asyncio.CancelledError:
+                # The client went away: give the place or the granted slot back
+                with self._lock:
+                    if waiter.granted:
+                        self._release(client)
+                        if client.bucket is not None:
+                            client.bucket.refund(images)
+                    else:
+                        self._give_up(client, waiter, images)
+                raise
+        return self._lease(client, images)
+
+    def _lease(self, client, images):
+        lease = Lease(self, client, reserved=images if client.bucket is not None else 0)
+        current_lease.set(lease)
+        return lease
+
+    def _release(self, client):
+        client.running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    def release(self, lease):
+        with self._lock:
+            if lease.released:
+                return
+            lease.released = True
+            self.book_seconds = 0.8 * self.book_seconds + 0.2 * (time.monotonic() - lease.started)
+            if lease.reserved:
+                lease.client.bucket.refund(lease.reserved)
+                lease.reserved = 0
+            self._release(lease.client)
+
+    def charge_images(self, lease, count):
+        """
+        Takes generated illustrations from the reservation of the book, the rest from the quota of its client.
+        """
+        if lease.client.bucket is not None:
+            with self._lock:
+                reserved = min(count, lease.reserved)
+                lease.reserved -= reserved
+                lease.client.bucket.charge(count - reserved)
+
+
+def charge_images(count=1):
+    """
+    Charges the illustrations generated for the book of the current context to its client.
+    """
+    lease = current_lease.get()
+    # A worker thread keeps the lease of its last request in its context
+    if lease is not None and not lease.released:
+        lease.charge_images(count)
+
+
+def client_ip(request):
+    """
+    The address of the client. X-Forwarded-For is set by the client itself unless a proxy
+    overwrites it, so only the entry added by the outermost of GENERATION_TRUSTED_PROXIES proxies is used.
+    """
+    trusted = settings.GENERATION_TRUSTED_PROXIES
+    if trusted:
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+        if len(forwarded) >= trusted:
+            return forwarded[-trusted]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def client_key(request):
+    """
+    Who a generation request is accounted to: the credentials DRF authenticated the request with
+    (an API token, else the user), else the address of the client. Unverified headers are not used,
+    a client cannot get a new quota by sending a made-up Authorization header.
+    """
+    auth = getattr(request, 'auth', None)
+    if auth is not None:
+        token = str(getattr(auth, 'key', auth))
+        return f"token:{hashlib.sha256(token.encode()).hexdigest()[:12]}"
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.get_username()}"
+    return f"ip:{client_ip(request)}"
+
+
+def parse_weights(value):
+    """
+    Client weights from "user:editor=2,token:1a2b3c4d5e6f=0.5".
+    """
+    weights = {}
+    for pair in filter(None, (part.strip() for part in value.split(','))):
+        key, _, weight = pair.rpartition('=')
+        weights[key.strip()] = float(weight)
+    return weights
+
+
+scheduler = FairScheduler(
+    slots=settings.GENERATION_SLOTS,
+    max_books=settings.GENERATION_CLIENT_MAX_BOOKS,
+    images_per_minute=settings.GENERATION_CLIENT_IMAGES_PER_MINUTE,
+    weights=parse_weights(settings.GENERATION_CLIENT_WEIGHTS),
+    queue_timeout=settings.GENERATION_QUEUE_TIMEOUT,
+)
@@ -0,0 +1,182 @@
+import re
+import json
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+
+FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)\s*(?:```|$)', re.DOTALL)
+CLOSERS = {'{': '}', '[': ']'}
+
+
+class ContentItem(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    type: Literal['text', 'image_prompt']
+    data: str
+
+    @field_validator('data')
+    @classmethod
+    def not_blank(cls, value):
+        if not value.strip():
+            raise ValueError('empty data')
+        return value
+
+
+class BookStructure(BaseModel):
+    """
+    Structured book as returned by the LLM, see BOOK_PROMPT in generation.py.
+    """
+    title: str = 'Book'
+    author: str = ''
+    content: list[ContentItem]
+
+    @field_validator('content')
+    @classmethod
+    def has_text(cls, value):
+        if not any(item.type == 'text' for item in value):
+            raise ValueError('no text blocks')
+        return value
+
+
+def _strip_fences(raw):
+    match = FENCE_RE.search(raw)
+    text = match.group(1) if match else raw
+    starts = [start for start in (text.find('{'), text.find('[')) if start >= 0]
+    return text[min(starts):] if starts else text
+
+
+def _strip_trailing_commas(text):
+    """
+    Removes commas right before a closing bracket. String literals are copied as they are,
+    the text of the book may contain ", ]" itself.
+    """
+    result, in_string, escaped = [], False, False
+    comma = None
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == ',':
+            comma = len(result)
+        elif char in '}]' and comma is not None:
+            del result[comma]
+            comma = None
+        elif not char.isspace():
+            comma = None
+            in_string = char == '"'
+        result.append(char)
+    return ''.join(result)
+
+
+def _close_truncated(text):
+    """
+    Cuts truncated JSON back to the last complete object or array
+    and closes everything that is still open at that point.
+    Returns the text and whether anything had to be closed.
+    """
+    stack, in_string, escaped = [], False, False
+    cut, cut_stack = None, None
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in CLOSERS:
+            stack.append(char)
+        elif char in '}]' and stack:
+            stack.pop()
+            cut, cut_stack = index + 1, list(stack)
+            if not stack:
+                return text[:cut], False
+    if cut is None:
+        return text, False
+    return text[:cut] + ''.join(CLOSERS[char] for char in reversed(cut_stack)), True
+
+
+def _normalize_item(item):
+    """
+    Accepts the shapes LLMs drift into, e.g. {"text": "..."} or {"image_prompt": "..."}.
+    """
+    if not isinstance(item, dict):
+        return {"type": "text", "data": item} if isinstance(item, str) else None
+    if "type" in item and "data" in item:
+        return item
+    for item_type in ("text", "image_prompt"):
+        if isinstance(item.get(item_type), str):
+            return {"type": item_type, "data": item[item_type]}
+    if isinstance(item.get("data"), str):
+        return {"type": "text", **item}
+    return None
+
+
+def _append_missing_tail(book_data, source_text):
+    """
+    After a truncated answer, adds the rest of the source text as one more text block,
+    if the last text block can be found in it verbatim.
+    """
+    texts = [item["data"] for item in book_data["content"] if item["type"] == "text"]
+    anchor = texts[-1].strip()[-80:] if texts else ''
+    position = source_text.find(anchor) if anchor else -1
+    if position >= 0:
+        tail = source_text[position + len(anchor):].strip()
+        if tail:
+            book_data["content"].append({"type": "text", "data": tail})
+
+
+def parse_book_structure(raw, source_text=''):
+    """
+    Parses the LLM answer into the book structure, repairing code fences,
+    trailing commas, truncation and missing fields.
+    Raises ValueError only if nothing usable is left.
+    """
+    text = _strip_fences(raw.strip()).lstrip()
+    decoder = json.JSONDecoder()
+    repaired, truncated = False, False
+    try:
+        # Text after a complete value, e.g. a remark of the model, is dropped
+        data, end = decoder.raw_decode(text)
+    except ValueError:
+        repaired = True
+        text, truncated = _close_truncated(_strip_trailing_commas(text))
+        try:
+            data, end = decoder.raw_decode(text)
+        except ValueError as e:
+            raise ValueError(f"Unusable JSON in the answer: {e}")
+    repaired = repaired or bool(text[end:].strip())
+
+    if isinstance(data, list):
+        data = {"content": data}
+    if not isinstance(data, dict):
+        raise ValueError("The answer is not a JSON object")
+
+    # Unusable items are dropped, the book is rejected only as a whole
+    content = [item for item in map(_normalize_item, data.get("content") or []) if item and _valid_item(item)]
+    fields = {key: data[key] for key in ("title", "author") if isinstance(data.get(key), str)}
+    try:
+        book_data = BookStructure.model_validate({**fields, "content": content}).model_dump()
+    except ValidationError as e:
+        raise ValueError(f"Unusable book structure: {e}")
+
+    if truncated and source_text:
+        _append_missing_tail(book_data, source_text)
+    if repaired:
+        print(f"  🔧 Repaired the JSON of the answer{' (truncated)' if truncated else ''}")
+    return book_data
+
+
+def _valid_item(item):
+    try:
+        ContentItem.model_validate(item)
+    except ValidationError:
+        return False
+    return True
@@ -0,0 +1,151 @@
+import re
+import sqlite3
+
+from django.db import connection
+
+
+BOOK_TABLE = 'books_book_search'
+IMAGE_TABLE = 'books_image_search'
+WORD_RE = re.compile(r'\w+')
+# A tsvector is limited to 1 MB, longer books are indexed by their beginning
+POSTGRES_MAX_CHARS = 500_000
+# Indexed fields, a save that touches none of them leaves the index alone
+BOOK_FIELDS = {'title', 'author', 'text'}
+IMAGE_FIELDS = {'image_prompt'}
+
+
+def enabled():
+    """
+    Full-text search needs SQLite FTS5 or PostgreSQL, other databases fall back to LIKE lookups.
+    """
+    return connection.vendor in ('sqlite', 'postgresql')
+
+
+def _words(query):
+    return WORD_RE.findall(query.lower())
+
+
+def _fts5_query(words):
+    # Quoted, so that FTS5 operators in user input are plain words; the last word is a prefix
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def create_tables(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        # Contentless tables keep only the index and not another copy of the texts,
+        # deleting from them by rowid needs SQLite 3.43
+        content = ", content='', contentless_delete=1" if sqlite3.sqlite_version_info >= (3, 43) else ''
+        tokenize = "tokenize='unicode61 remove_diacritics 2'"
+        schema_editor.execute(f"CREATE VIRTUAL TABLE {BOOK_TABLE} USING fts5(title, author, text, {tokenize}{content})")
+        schema_editor.execute(f"CREATE VIRTUAL TABLE {IMAGE_TABLE} USING fts5(image_prompt, {tokenize}{content})")
+    elif vendor == 'postgresql':
+        for table in (BOOK_TABLE, IMAGE_TABLE):
+            schema_editor.execute(f"CREATE TABLE {table} (id bigint PRIMARY KEY, document tsvector NOT NULL)")
+            schema_editor.execute(f"CREATE INDEX {table}_document ON {table} USING GIN (document)")
+
+
+def drop_tables(schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        for table in (BOOK_TABLE, IMAGE_TABLE):
+            schema_editor.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def index_book(book_id, title, author, text):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {BOOK_TABLE} WHERE rowid = %s", [book_id])
+            cursor.execute(
+                f"INSERT INTO {BOOK_TABLE} (rowid, title, author, text) VALUES (%s, %s, %s, %s)",
+                [book_id, title, author, text],
+            )
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {BOOK_TABLE} (id, document) VALUES (%s, "
+                "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')"
+                " || to_tsvector('simple', %s)) "
+                "ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document",
+                [book_id, title, author, text[:POSTGRES_MAX_CHARS]],
+            )
+
+
+def index_image(image_id, image_prompt):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {IMAGE_TABLE} WHERE rowid = %s", [image_id])
+            cursor.execute(f"INSERT INTO {IMAGE_TABLE} (rowid, image_prompt) VALUES (%s, %s)", [image_id, image_prompt])
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {IMAGE_TABLE} (id, document) VALUES (%s, to_tsvector('simple', %s)) "
+                "ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document",
+                [image_id, image_prompt],
+            )
+
+
+def unindex(table, object_id):
+    if enabled():
+        column = 'rowid' if connection.vendor == 'sqlite' else 'id'
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table} WHERE {column} = %s", [object_id])
+
+
+def _search(table, words, limit, weights=''):
+    if not words or not enabled():
+        return []
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                f"SELECT rowid FROM {table} WHERE {table} MATCH %s ORDER BY bm25({table}{weights}) LIMIT %s",
+                [_fts5_query(words), limit or -1],
+            )
+        else:
+            # Words are \w+ only, safe to join into tsquery syntax
+            tsquery = ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+            cursor.execute(
+                f"SELECT id FROM {table}, to_tsquery('simple', %s) query WHERE document @@ query "
+                "ORDER BY ts_rank(document, query) DESC LIMIT %s",
+                [tsquery, limit],
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_book_ids(query, limit=50):
+    """
+    Ids of books matching all words of the query, the best matches first.
+    Title matches weigh more than author matches, which weigh more than the text.
+    """
+    return _search(BOOK_TABLE, _words(query), limit, weights=', 10.0, 5.0, 1.0')
+
+
+def search_image_ids(query, limit=50):
+    return _search(IMAGE_TABLE, _words(query), limit)
+
+
+def rebuild(apps=None, batch_size=200):
+    """
+    Indexes all books and illustrations again, in batches ordered by pk.
+    Migrations pass their apps registry.
+    """
+    if not enabled():
+        return
+    if apps is None:
+        from django.apps import apps
+
+    with connection.cursor() as cursor:
+        for table in (BOOK_TABLE, IMAGE_TABLE):
+            cursor.execute(f"DELETE FROM {table}")
+    for model_name, fields, index in (
+        ('Book', ('title', 'author', 'text'), index_book),
+        ('Image', ('image_prompt',), index_image),
+    ):
+        model = apps.get_model('books', model_name)
+        last_pk = 0
+        while rows := list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', *fields)[:batch_size]):
+            for row in rows:
+                index(*row)
+            last_pk = rows[-1][0]
+        print(f"  🔎 {model_name}: indexed up to pk {last_pk}")
@@ -1,7 +1,70 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Book
+from .models import Book, BookFile, Image
+from .structuring import STRUCTURING_CHOICES
 
 class BookSerializer(serializers.ModelSerializer):
+    export_format = serializers.ChoiceField(
+        choices=BookFile.Format.choices,
+        default=BookFile.Format.PDF,
+        write_only=True,
+    )
+    structuring = serializers.ChoiceField(
+        choices=STRUCTURING_CHOICES,
+        default='llm',
+        write_only=True,
+    )
+    latency_budget = serializers.FloatField(
+        help_text='Seconds the client is ready to wait, the book is simplified to fit into them',
+        min_value=1,
+        required=False,
+        write_only=True,
+    )
+    draft = serializers.BooleanField(
+        help_text='Return a draft with placeholder illustrations right after structuring, '
+                  'the final file follows in the background',
+        default=False,
+        write_only=True,
+    )
+
+    class Meta:
+        model = Book
+        fields = (
+            'id', 'title', 'author', 'text', 'export_format', 'structuring', 'latency_budget', 'draft', 'degradation',
+        )
+        read_only_fields = ('degradation',)
+
+
+class BookExportSerializer(serializers.Serializer):
+    export_format = serializers.ChoiceField(
+        choices=BookFile.Format.choices,
+        default=BookFile.Format.PDF,
+    )
+
+
+
+class BookFileSerializer(serializers.ModelSerializer):
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = BookFile
+        fields = ('id', 'format', 'status', 'file', 'download_url', 'content_hash', 'created')
+
+    def get_download_url(self, obj):
+        url = reverse('book-file-download', args=[obj.pk])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+class BookSearchSerializer(serializers.ModelSerializer):
+
     class Meta:
         model = Book
-        fields = ('id', 'title', 'author', 'text')
+        fields = ('id', 'title', 'author', 'created')
+
+
+class ImageSearchSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Image
+        fields = ('id', 'book', 'image_prompt', 'illustration')
@@ -0,0 +1,31 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import search
+from .models import Book, Image
+
+
+def _indexed_fields_changed(update_fields, indexed_fields):
+    return update_fields is None or bool(indexed_fields & set(update_fields))
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, update_fields=None, **kwargs):
+    if _indexed_fields_changed(update_fields, search.BOOK_FIELDS):
+        search.index_book(instance.pk, instance.title, instance.author, instance.text)
+
+
+@receiver(post_save, sender=Image)
+def index_image(sender, instance, update_fields=None, **kwargs):
+    if _indexed_fields_changed(update_fields, search.IMAGE_FIELDS):
+        search.index_image(instance.pk, instance.image_prompt)
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    search.unindex(search.BOOK_TABLE, instance.pk)
+
+
+@receiver(post_delete, sender=Image)
+def unindex_image(sender, instance, **kwargs):
+    search.unindex(search.IMAGE_TABLE, instance.pk)
@@ -0,0 +1,103 @@
+import re
+import hashlib
+from array import array
+
+from django.db import connection
+
+
+# 64 MinHash values split into 16 bands of 4: two prompts share a band, and become candidates,
+# with a probability of 1 - (1 - s^4)^16 for Jaccard similarity s: 0.64 at 0.5, 0.99 at 0.7
+NUM_PERM = 64
+BANDS = 16
+
+WORD_RE = re.compile(r'\w+')
+# Words every prompt has, they would make all prompts look alike
+STOPWORDS = {
+    'a', 'an', 'the', 'of', 'and', 'or', 'in', 'on', 'at', 'to', 'with', 'by', 'for', 'from', 'is', 'are',
+    'as', 'its', 'his', 'her', 'their', 'this', 'that', 'into', 'while', 'detailed', 'book', 'illustration',
+    'following', 'scene', 'picture', 'image', 'style', 'showing', 'depicting',
+}
+
+
+def shingles(prompt):
+    """
+    Content words of the prompt and pairs of neighbouring ones:
+    words catch reworded prompts, pairs keep the order from counting for nothing.
+    """
+    words = [word for word in WORD_RE.findall(prompt.lower()) if word not in STOPWORDS]
+    return set(words) | {f'{first} {second}' for first, second in zip(words, words[1:])}
+
+
+def minhash(prompt):
+    """
+    MinHash signature of the prompt as NUM_PERM 32-bit values packed into bytes,
+    empty for a prompt without content words. One SHAKE-128 digest gives every shingle
+    NUM_PERM independent hash values at once.
+    """
+    hashes = [array('I', hashlib.shake_128(shingle.encode()).digest(NUM_PERM * 4)) for shingle in shingles(prompt)]
+    if not hashes:
+        return b''
+    return array('I', map(min, zip(*hashes))).tobytes()
+
+
+def band_keys(signature):
+    """
+    One lookup key per band, signed 64-bit to fit a BigIntegerField.
+    Prompts with equal keys in any band are candidates for a match.
+    """
+    if not signature:
+        return []
+    size = len(signature) // BANDS
+    return [
+        int.from_bytes(
+            hashlib.blake2b(bytes([band]) + signature[band * size:(band + 1) * size], digest_size=8).digest(),
+            'little',
+            signed=True,
+        )
+        for band in range(BANDS)
+    ]
+
+
+def estimate_similarity(signature, other):
+    """
+    Estimated Jaccard similarity of the shingles of two prompts: the share of equal MinHash values.
+    """
+    if not signature or len(signature) != len(other):
+        return 0.0
+    first, second = array('I', signature), array('I', other)
+    return sum(1 for x, y in zip(first, second) if x == y) / len(first)
+
+
+# Only the candidates sharing the most bands with the prompt are compared in full
+VERIFIED_CANDIDATES = 5
+
+
+def find_similar_image(prompt, threshold):
+    """
+    The stored illustration whose prompt is most similar to the prompt and the estimated similarity,
+    or None below the threshold. Candidates are counted by shared band keys on the index,
+    so the cost grows with the number of near matches, not with the number of images.
+    One raw query: the ORM would take longer to build it than the database to run it.
+    """
+    from .models import Image, ImagePromptBand
+
+    signature = minhash(prompt)
+    keys = band_keys(signature)
+    if not keys:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT image.id, image.prompt_minhash, COUNT(*) AS shared "
+            f"FROM {ImagePromptBand._meta.db_table} band JOIN {Image._meta.db_table} image ON image.id = band.image_id "
+            f"WHERE band.key IN ({', '.join(['%s'] * len(keys))}) AND image.illustration != '' "
+            f"GROUP BY image.id ORDER BY shared DESC LIMIT %s",
+            [*keys, VERIFIED_CANDIDATES],
+        )
+        candidates = cursor.fetchall()
+
+    similarity, pk = max(
+        ((estimate_similarity(signature, bytes(other)), pk) for pk, other, _ in candidates), default=(0.0, None)
+    )
+    if pk is None or similarity < threshold:
+        return None
+    return Image.objects.get(pk=pk), similarity
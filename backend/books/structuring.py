@@ -0,0 +1,158 @@
+import re
+
+
+STRUCTURING_CHOICES = (
+    ('llm', 'Gemini'),
+    ('local', 'Local heuristics, without an LLM call'),
+)
+
+# Target size of one text block in characters
+BLOCK_SIZE = 1500
+# Smallest block a long paragraph is split into
+MIN_BLOCK_SIZE = 200
+# One illustration per this many characters, within the bounds below
+CHARS_PER_ILLUSTRATION = 3000
+MIN_ILLUSTRATIONS = 5
+MAX_ILLUSTRATIONS = 30
+
+# Roman numerals are case-sensitive, "civil" or "Xi" are words
+HEADING_RE = re.compile(r'^((?i:#{1,6}\s+.+|(chapter|part|book|глава|часть)\b.{0,60})|[IVXLC]+\.?)$')
+SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+')
+WORD_RE = re.compile(r'\w+')
+
+
+def estimated_illustrations(text):
+    """
+    How many illustrations a book of this text gets, placed by structure_locally
+    and asked from Gemini (at least 5-7) alike.
+    """
+    return max(MIN_ILLUSTRATIONS, min(MAX_ILLUSTRATIONS, len(text) // CHARS_PER_ILLUSTRATION))
+
+
+def _paragraphs(text):
+    """
+    Returns the paragraphs and whether they were separated by blank lines.
+    Without blank lines every line is a paragraph, which keeps hard-wrapped text and verses as they are.
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n').strip()
+    if '\n\n' in text:
+        paragraphs = [' '.join(line.strip() for line in paragraph.split('\n')) for paragraph in text.split('\n\n')]
+        return [paragraph.strip() for paragraph in paragraphs if paragraph.strip()], True
+    return [line.strip() for line in text.split('\n') if line.strip()], False
+
+
+def _is_heading(paragraph, loose=True):
+    if HEADING_RE.match(paragraph):
+        return True
+    # A short paragraph without final punctuation, e.g. an unnumbered chapter title.
+    # Only reliable when paragraphs are separated by blank lines.
+    return loose and len(paragraph) < 60 and paragraph[-1] not in '.!?…,;:"»”\''
+
+
+def _split_long(paragraph, size):
+    """
+    Splits a paragraph longer than size into pieces of about size characters at sentence ends,
+    a sentence longer than that at spaces, and text without spaces anywhere.
+    """
+    if len(paragraph) <= size:
+        return [paragraph]
+    parts = []
+    for sentence in SENTENCE_RE.split(paragraph):
+        while len(sentence) > size:
+            cut = sentence.rfind(' ', size // 2, size)
+            cut = cut if cut > 0 else size
+            parts.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            parts.append(sentence)
+
+    pieces, piece = [], ''
+    for part in parts:
+        if piece and len(piece) + len(part) + 1 > size:
+            pieces.append(piece)
+            piece = part
+        else:
+            piece = f'{piece} {part}' if piece else part
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def _sections(paragraphs, block_size, loose_headings):
+    """
+    Groups paragraphs into text blocks of about block_size characters.
+    A heading always starts a new block, a longer paragraph is split between blocks.
+    """
+    blocks, block = [], []
+    for paragraph in paragraphs:
+        heading = _is_heading(paragraph, loose_headings)
+        pieces = [paragraph.lstrip('#').strip()] if heading else _split_long(paragraph, block_size)
+        for index, piece in enumerate(pieces):
+            # Pieces of a split paragraph are a block each, they are about block_size long
+            if block and (heading or index or sum(len(p) for p in block) >= block_size):
+                blocks.append('\n'.join(block))
+                block = []
+            block.append(piece)
+    if block:
+        blocks.append('\n'.join(block))
+    return blocks
+
+
+def _sentence_score(sentence):
+    words = WORD_RE.findall(sentence)
+    if not 6 <= len(words) <= 45:
+        return 0
+    # Long words are mostly nouns and adjectives, which describe a scene; dialogue rarely does
+    score = sum(1 for word in words if len(word) > 4)
+    if any(quote in sentence for quote in '"«“—'):
+        score /= 2
+    return score
+
+
+def image_prompt(block):
+    """
+    Derives an illustration prompt from the most descriptive sentence of a text block.
+    """
+    text = ' '.join(line for line in block.split('\n') if not HEADING_RE.match(line))
+    sentences = [sentence.strip() for sentence in SENTENCE_RE.split(text) if sentence.strip()]
+    if not sentences:
+        return block[:300]
+    sentence = max(sentences, key=_sentence_score)
+    return f"A detailed book illustration of the following scene: {sentence[:500]}"
+
+
+def structure_locally(text, title='', author=''):
+    """
+    Builds the same {"title", "author", "content"} structure as the LLM
+    without calling it: the text is split into blocks by paragraphs and headings,
+    and illustrations are placed evenly by text length after the blocks they depict.
+    """
+    print("⚡ Structuring the book text locally...")
+    paragraphs, blank_lines = _paragraphs(text)
+    # An explicit first heading is the title unless the book already has another one
+    if len(paragraphs) > 1 and _is_heading(paragraphs[0], loose=False):
+        heading = paragraphs[0].lstrip('#').strip()
+        if not title or heading.lower() == title.lower():
+            title = heading
+            paragraphs.pop(0)
+
+    count = estimated_illustrations(text)
+    # Short texts get smaller blocks, so that every illustration has its own block
+    block_size = max(MIN_BLOCK_SIZE, min(BLOCK_SIZE, len(text) // (count + 1)))
+    # Every book has at least one text block, even one that is only a heading
+    blocks = _sections(paragraphs, block_size, blank_lines) or [text.strip() or title or "Book"]
+    count = min(count, len(blocks))
+    total = sum(len(block) for block in blocks)
+    # Character positions after which an illustration should follow
+    targets = [total * (index + 1) / count for index in range(count)] if count else []
+
+    content, position = [], 0
+    for block in blocks:
+        content.append({"type": "text", "data": block})
+        position += len(block)
+        if targets and position >= targets[0]:
+            content.append({"type": "image_prompt", "data": image_prompt(block)})
+            while targets and position >= targets[0]:
+                targets.pop(0)
+
+    return {"title": title or "Book", "author": author, "content": content}
@@ -1,3 +1,945 @@
-from django.test import TestCase
+import io
+import os
+import json
+import shutil
+import zipfile
+import importlib
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from PIL import Image as PILImage
+from reportlab import rl_config
+
+from . import ingest, pdf, search
+from .download import parse_range
+from .fields import RAW, ZLIB, ZLIB_DICTIONARY, compress_text, decompress_text
+from .images import normalize_image
+from .models import Book, BookFile, BookLlm, Image, ImagePromptBand, RequestProfile
+from .scheduling import FairScheduler, QuotaExceeded, TokenBucket
+from .schema import parse_book_structure
+from .similarity import BANDS, band_keys, estimate_similarity, find_similar_image, minhash
+from .structuring import structure_locally
+
+
+SOURCE_TEXT = "First part of the story.\n\nSecond part of the story.\n\nThe rest of the story."
+
+
+def answer(content, **fields):
+    return json.dumps({"title": "Title", "author": "Author", "content": content, **fields})
+
+
+class ParseBookStructureTests(SimpleTestCase):
+    def test_valid_answer(self):
+        content = [{"type": "text", "data": "Once upon a time"}, {"type": "image_prompt", "data": "A castle"}]
+        book_data = parse_book_structure(answer(content))
+        self.assertEqual(book_data, {"title": "Title", "author": "Author", "content": content})
+
+    def test_code_fence(self):
+        raw = f"```json\n{answer([{'type': 'text', 'data': 'Text'}])}\n```"
+        self.assertEqual(parse_book_structure(raw)["content"], [{"type": "text", "data": "Text"}])
+
+    def test_trailing_commas(self):
+        raw = '{"title": "Title", "content": [{"type": "text", "data": "Text",},],}'
+        self.assertEqual(parse_book_structure(raw)["content"], [{"type": "text", "data": "Text"}])
+
+    def test_commas_inside_strings_are_kept(self):
+        raw = '{"content": [{"type": "text", "data": "list: a, ] and \\"b, }\\""},]}'
+        self.assertEqual(parse_book_structure(raw)["content"][0]["data"], 'list: a, ] and "b, }"')
+
+    def test_trailing_garbage_is_dropped(self):
+        raw = answer([{"type": "text", "data": "First part of the story."}]) + "\nHope this helps! {"
+        book_data = parse_book_structure(raw, SOURCE_TEXT)
+        self.assertEqual(book_data["content"], [{"type": "text", "data": "First part of the story."}])
+
+    def test_truncated_answer_gets_the_rest_of_the_text(self):
+        raw = answer([
+            {"type": "text", "data": "First part of the story."},
+            {"type": "image_prompt", "data": "A forest"},
+            {"type": "text", "data": "Second part"},
+        ])[:-30]
+        book_data = parse_book_structure(raw, SOURCE_TEXT)
+        self.assertEqual(book_data["content"], [
+            {"type": "text", "data": "First part of the story."},
+            {"type": "image_prompt", "data": "A forest"},
+            {"type": "text", "data": "Second part of the story.\n\nThe rest of the story."},
+        ])
+
+    def test_item_shapes_are_normalized(self):
+        raw = json.dumps({"content": [{"text": "Text"}, {"image_prompt": "A river"}, "More text", 42, {"data": "Data"}]})
+        book_data = parse_book_structure(raw)
+        self.assertEqual(book_data["title"], "Book")
+        self.assertEqual(book_data["content"], [
+            {"type": "text", "data": "Text"},
+            {"type": "image_prompt", "data": "A river"},
+            {"type": "text", "data": "More text"},
+            {"type": "text", "data": "Data"},
+        ])
+
+    def test_list_answer(self):
+        raw = json.dumps([{"type": "text", "data": "Text"}])
+        self.assertEqual(parse_book_structure(raw)["content"], [{"type": "text", "data": "Text"}])
+
+    def test_invalid_items_are_dropped(self):
+        content = [{"type": "text", "data": "Text"}, {"type": "text", "data": "  "}, {"type": "video", "data": "x"}]
+        self.assertEqual(parse_book_structure(answer(content))["content"], [{"type": "text", "data": "Text"}])
+
+    def test_no_text_blocks(self):
+        with self.assertRaises(ValueError):
+            parse_book_structure(answer([{"type": "image_prompt", "data": "A castle"}]))
+
+    def test_not_json(self):
+        with self.assertRaises(ValueError):
+            parse_book_structure("I cannot help with that.")
+
+
+class StructureLocallyTests(SimpleTestCase):
+    def texts(self, book_data):
+        return [item["data"] for item in book_data["content"] if item["type"] == "text"]
+
+    def test_explicit_heading_is_the_title(self):
+        book_data = structure_locally("# The Forest\n\nIt was a dark and quiet night in the forest.")
+        self.assertEqual(book_data["title"], "The Forest")
+        self.assertEqual(self.texts(book_data), ["It was a dark and quiet night in the forest."])
+
+    def test_single_short_paragraph_is_not_the_title(self):
+        book_data = structure_locally("Hi")
+        self.assertEqual(book_data["title"], "Book")
+        self.assertEqual(self.texts(book_data), ["Hi"])
+
+    def test_lowercase_roman_letters_are_not_a_heading(self):
+        book_data = structure_locally("civil\n\nThe war was long.")
+        self.assertEqual(book_data["title"], "Book")
+        self.assertEqual(self.texts(book_data), ["civil\nThe war was long."])
+
+    def test_text_without_line_breaks_is_split(self):
+        text = " ".join(["The river flowed slowly past the old mill under the grey sky."] * 300)
+        book_data = structure_locally(text)
+        texts = self.texts(book_data)
+        self.assertGreater(len(texts), 1)
+        self.assertEqual(" ".join(texts), text)
+        self.assertEqual(sum(item["type"] == "image_prompt" for item in book_data["content"]), len(text) // 3000)
+
+    def test_text_without_spaces_is_split(self):
+        book_data = structure_locally("x" * 5000)
+        self.assertEqual(book_data["title"], "Book")
+        self.assertEqual("".join(self.texts(book_data)), "x" * 5000)
+        self.assertGreater(len(self.texts(book_data)), 1)
+
+
+class MediaTestCase(TestCase):
+    """
+    Keeps the files saved by a test in a temporary MEDIA_ROOT.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.enterClassContext(override_settings(MEDIA_ROOT=cls.media_root, USE_TEST_IMAGES=True))
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+BOOK_TEXT = "# The Forest\n\n" + "\n\n".join(["It was a dark and quiet night in the forest."] * 100)
+
+
+class CreateBookTests(MediaTestCase):
+    def create(self, **data):
+        response = self.client.post(
+            "/api/books/", {"title": "Forest", "text": BOOK_TEXT, "structuring": "local", **data},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content)
+
+    def test_created_file_is_sent_whole(self):
+        for export_format in BookFile.Format.values:
+            with self.subTest(export_format=export_format):
+                response, body = self.create(export_format=export_format)
+                book_file = BookFile.objects.get(book_id=response["X-Book-Id"], format=export_format)
+                with book_file.file.storage.open(book_file.file.name) as f:
+                    self.assertEqual(body, f.read())
+                self.assertEqual(response["X-Book-Status"], BookFile.Status.PUBLISHED)
+
+    def test_draft_is_sent_whole(self):
+        with mock.patch("books.views.finish_book_in_background", lambda *args, done: done()):
+            response, body = self.create(draft=True)
+        self.assertEqual(response["X-Book-Status"], BookFile.Status.DRAFT)
+        self.assertTrue(body.startswith(b"%PDF"))
+
+    def test_export_of_a_new_format_is_sent_whole(self):
+        response, _ = self.create()
+        response = self.client.get(f"/api/books/{response['X-Book-Id']}/export/", {"export_format": "html"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"The Forest", b"".join(response.streaming_content))
+
+
+class GcMediaTests(SimpleTestCase):
+    def test_refuses_empty_media_root(self):
+        with override_settings(MEDIA_ROOT=''), self.assertRaisesMessage(CommandError, 'MEDIA_ROOT is not set'):
+            call_command('gc_media', dry_run=True)
+
+    def test_refuses_media_root_containing_the_project(self):
+        for media_root in (settings.BASE_DIR, settings.BASE_DIR.parent):
+            with self.subTest(media_root=media_root), override_settings(MEDIA_ROOT=str(media_root)):
+                with self.assertRaisesMessage(CommandError, 'contains the project directory'):
+                    call_command('gc_media', dry_run=True)
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        cases = [
+            (None, None),
+            ("bytes=0-9", (0, 9)),
+            ("bytes=90-", (90, 99)),
+            ("bytes=90-200", (90, 99)),
+            ("bytes=-10", (90, 99)),
+            ("bytes=-200", (0, 99)),
+            ("bytes=100-", False),
+            ("bytes=-0", False),
+            ("bytes=9-0", None),
+            ("bytes=0-1,5-6", None),
+            ("items=0-1", None),
+            ("bytes=-", None),
+        ]
+        for header, expected in cases:
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 100), expected)
+
+
+class DownloadBookFileTests(MediaTestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        book = Book.objects.create(title="Forest", text="Text")
+        self.book_file = BookFile(book=book, format=BookFile.Format.PDF)
+        self.book_file.file.save("book.pdf", ContentFile(self.content))
+        self.url = f"/api/books/files/{self.book_file.pk}/download/"
+        self.etag = f'"{self.book_file.content_hash}"'
+
+    def test_whole_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+
+    def test_range(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.content)}")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(b"".join(response.streaming_content), self.content[10:20])
+
+    def test_suffix_range(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=-100"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.content[-100:])
+
+    def test_if_range_of_the_current_version(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=0-9", "If-Range": self.etag})
+        self.assertEqual(response.status_code, 206)
+
+    def test_if_range_of_another_version_sends_the_whole_file(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, headers={"Range": f"bytes={len(self.content)}-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.content)}")
+
+    def test_if_none_match(self):
+        response = self.client.get(self.url, headers={"If-None-Match": self.etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_hash_of_an_older_file_is_stored(self):
+        BookFile.objects.filter(pk=self.book_file.pk).update(content_hash="")
+        response = self.client.get(self.url)
+        self.assertEqual(response["ETag"], self.etag)
+        self.book_file.refresh_from_db()
+        self.assertEqual(self.book_file.content_hash, self.etag.strip('"'))
+
+    def test_missing_file(self):
+        self.book_file.file.storage.delete(self.book_file.file.name)
+        BookFile.objects.filter(pk=self.book_file.pk).update(content_hash="")
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_sendfile(self):
+        with override_settings(SENDFILE_BACKEND="x-accel-redirect", SENDFILE_URL="/protected/media/"):
+            response = self.client.get(self.url)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/media/{self.book_file.file.name}")
+        self.assertEqual(response.content, b"")
+
+
+class CompressedTextTests(SimpleTestCase):
+    def test_round_trip(self):
+        long_text = "Глава первая. It was a dark and quiet night in the forest. " * 20
+        cases = [
+            ("", None, RAW),
+            ("Short text", None, RAW),
+            ("Short text", "book_llm", RAW),
+            (long_text, None, ZLIB),
+            (long_text, "book_llm", ZLIB_DICTIONARY),
+        ]
+        for text, dictionary, marker in cases:
+            with self.subTest(text=text[:10], dictionary=dictionary):
+                stored = compress_text(text, dictionary)
+                self.assertEqual(stored[:1], marker)
+                self.assertEqual(decompress_text(memoryview(stored), dictionary), text)
+
+    def test_compresses(self):
+        text = json.dumps({"content": [{"type": "text", "data": "Once upon a time"}] * 50}, indent=2)
+        self.assertLess(len(compress_text(text, "book_llm")), len(compress_text(text)))
+        self.assertLess(len(compress_text(text)), len(text) // 5)
+
+    def test_unknown_marker(self):
+        with self.assertRaises(ValueError):
+            decompress_text(b"\x07data")
+
+
+class CompressedTextFieldTests(TestCase):
+    def test_stored_compressed(self):
+        text = "It was a dark and quiet night in the forest. " * 20
+        book = Book.objects.create(title="Forest", text=text)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT text FROM books_book WHERE id = %s", [book.pk])
+            stored = bytes(cursor.fetchone()[0])
+        self.assertEqual(stored[:1], ZLIB)
+        self.assertLess(len(stored), len(text))
+        self.assertEqual(Book.objects.get(pk=book.pk).text, text)
+
+    def test_legacy_text_value(self):
+        book = Book.objects.create(title="Forest", text="")
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE books_book SET text = %s WHERE id = %s", ["Text stored before compression", book.pk])
+        self.assertEqual(Book.objects.get(pk=book.pk).text, "Text stored before compression")
+
+
+class CompressTextsMigrationTests(TransactionTestCase):
+    before = [("books", "0010_bookfile_content_hash")]
+    after = [("books", "0011_compress_texts")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def stored(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id, text FROM {table} ORDER BY id")
+            return cursor.fetchall()
+
+    def test_forward_and_backward(self):
+        migration = importlib.import_module("books.migrations.0011_compress_texts")
+        texts = ["Short", "Long text of the book. " * 50, ""]
+        llm_text = json.dumps({"title": "Forest", "content": [{"type": "text", "data": "Text"}] * 20}, indent=2)
+
+        old_apps = self.migrate(self.before)
+        OldBook, OldBookLlm = old_apps.get_model("books", "Book"), old_apps.get_model("books", "BookLlm")
+        books = [OldBook.objects.create(title=str(i), text=text) for i, text in enumerate(texts)]
+        OldBookLlm.objects.create(book=books[0], text=llm_text)
+
+        # Several batches
+        with mock.patch.object(migration, "BATCH_SIZE", 2):
+            new_apps = self.migrate(self.after)
+        self.assertEqual([bytes(text)[:1] for _, text in self.stored("books_book")], [RAW, ZLIB, RAW])
+        self.assertEqual([bytes(text)[:1] for _, text in self.stored("books_bookllm")], [ZLIB_DICTIONARY])
+        NewBook, NewBookLlm = new_apps.get_model("books", "Book"), new_apps.get_model("books", "BookLlm")
+        self.assertEqual(list(NewBook.objects.order_by("pk").values_list("text", flat=True)), texts)
+        self.assertEqual(NewBookLlm.objects.get().text, llm_text)
+
+        with mock.patch.object(migration, "BATCH_SIZE", 2):
+            self.migrate(self.before)
+        self.assertEqual([text for _, text in self.stored("books_book")], texts)
+        self.assertEqual([text for _, text in self.stored("books_bookllm")], [llm_text])
+
+
+class FairSchedulerTests(SimpleTestCase):
+    def test_weighted_stride_order(self):
+        scheduler = FairScheduler(slots=1, max_books=10, weights={"a": 2})
+        lease = scheduler.acquire("x")
+        queued = [(key, *scheduler._admit(key, 1)) for key in ["a"] * 4 + ["b"] * 2]
+        order = []
+        lease.release()
+        while len(order) < len(queued):
+            key, client, waiter = next(item for item in queued if item[2].granted and item not in order)
+            order.append((key, client, waiter))
+            scheduler._release(client)
+        self.assertEqual([key for key, _, _ in order], ["a", "b", "a", "a", "b", "a"])
+
+    def test_max_books_per_client(self):
+        scheduler = FairScheduler(slots=1, max_books=2, queue_timeout=0.01)
+        scheduler.acquire("a")
+        scheduler._admit("a", 1)
+        with self.assertRaisesMessage(QuotaExceeded, "at most 2 per client"):
+            scheduler.acquire("a")
+        # Other clients are not affected
+        scheduler._admit("b", 1)
+
+    def test_queue_timeout(self):
+        scheduler = FairScheduler(slots=1, max_books=3, queue_timeout=0.01)
+        scheduler.acquire("a")
+        with self.assertRaisesMessage(QuotaExceeded, "All generation slots are busy") as raised:
+            scheduler.acquire("b")
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertFalse(scheduler.clients["b"].waiting)
+
+    def test_released_slot_goes_to_the_next_book(self):
+        scheduler = FairScheduler(slots=1, max_books=3)
+        lease = scheduler.acquire("a")
+        _, waiter = scheduler._admit("b", 1)
+        self.assertFalse(waiter.granted)
+        lease.release()
+        lease.release()
+        self.assertTrue(waiter.granted)
+        self.assertEqual(scheduler.running, 1)
+
+    @mock.patch("books.scheduling.time.monotonic", return_value=1000.0)
+    def test_images_are_reserved_at_admission(self, monotonic):
+        scheduler = FairScheduler(slots=4, max_books=4, images_per_minute=60)
+        lease = scheduler.acquire("a", images=50)
+        with self.assertRaisesMessage(QuotaExceeded, "Illustration quota exceeded") as raised:
+            scheduler.acquire("a", images=20)
+        self.assertEqual(raised.exception.retry_after, 10)
+        # Only 5 of the 50 illustrations were generated, the rest is given back
+        lease.charge_images(5)
+        lease.release()
+        self.assertEqual(scheduler.clients["a"].bucket.tokens, 55)
+        scheduler.acquire("a", images=20)
+
+    @mock.patch("books.scheduling.time.monotonic", return_value=1000.0)
+    def test_illustrations_beyond_the_reservation_leave_a_debt(self, monotonic):
+        scheduler = FairScheduler(slots=4, max_books=4, images_per_minute=60)
+        lease = scheduler.acquire("a", images=10)
+        lease.charge_images(70)
+        lease.release()
+        self.assertEqual(scheduler.clients["a"].bucket.tokens, -10)
+        with self.assertRaises(QuotaExceeded) as raised:
+            scheduler.acquire("a")
+        self.assertEqual(raised.exception.retry_after, 11)
+        monotonic.return_value += 11
+        scheduler.acquire("a")
+
+    @mock.patch("books.scheduling.time.monotonic", return_value=1000.0)
+    def test_book_larger_than_the_bucket_waits_for_a_full_one(self, monotonic):
+        bucket = TokenBucket(per_minute=60)
+        self.assertEqual(bucket.retry_after(100), 0)
+        bucket.charge(30)
+        self.assertEqual(bucket.retry_after(100), 30)
+        self.assertEqual(bucket.retry_after(10), 0)
+
+
+class SchedulingViewTests(MediaTestCase):
+    def test_queue_timeout_answers_429(self):
+        scheduler = FairScheduler(slots=1, max_books=3, queue_timeout=0.01)
+        scheduler.acquire("user:someone")
+        with mock.patch("books.views.scheduler", scheduler):
+            response = self.client.post(
+                "/api/books/", {"title": "Forest", "text": BOOK_TEXT, "structuring": "local"},
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], str(response.json()["retry_after"]))
+        self.assertFalse(Book.objects.exists())
+
+
+PROMPT = "A detailed book illustration of the following scene: an old fisherman pulls a silver net out of the stormy sea at dawn"
+SIMILAR_PROMPT = "A detailed book illustration of the following scene: an old fisherman pulls a silver net from the stormy sea at dawn"
+UNRELATED_PROMPT = "A detailed book illustration of the following scene: a little girl reads by the fireplace in a cozy library"
+
+
+class MinHashTests(SimpleTestCase):
+    def test_signature(self):
+        signature = minhash(PROMPT)
+        self.assertEqual(len(signature), 64 * 4)
+        self.assertEqual(len(band_keys(signature)), BANDS)
+        self.assertEqual(minhash(""), b"")
+        self.assertEqual(band_keys(b""), [])
+
+    def test_stopwords_and_case_do_not_count(self):
+        reworded = "The old fisherman pulls the silver net out of the stormy sea at dawn."
+        self.assertEqual(estimate_similarity(minhash(PROMPT), minhash(reworded.upper())), 1.0)
+
+    def test_similarity(self):
+        signature = minhash(PROMPT)
+        self.assertGreater(estimate_similarity(signature, minhash(SIMILAR_PROMPT)), 0.6)
+        self.assertLess(estimate_similarity(signature, minhash(UNRELATED_PROMPT)), 0.1)
+        self.assertTrue(set(band_keys(signature)) & set(band_keys(minhash(SIMILAR_PROMPT))))
+        self.assertFalse(set(band_keys(signature)) & set(band_keys(minhash(UNRELATED_PROMPT))))
+
+
+class FindSimilarImageTests(MediaTestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title="Sea", text="Text")
+
+    def image(self, prompt, source=Image.Source.GENERATED):
+        image = Image(book=self.book, image_prompt=prompt, source=source)
+        with open("test_images/1.jpg", "rb") as f:
+            image.illustration.save("1.jpg", ContentFile(f.read()))
+        return image
+
+    def test_near_duplicate_is_found(self):
+        image = self.image(PROMPT)
+        self.image(UNRELATED_PROMPT)
+        found, similarity = find_similar_image(SIMILAR_PROMPT, 0.6)
+        self.assertEqual(found, image)
+        self.assertGreater(similarity, 0.6)
+
+    def test_below_the_threshold(self):
+        self.image(PROMPT)
+        self.assertIsNone(find_similar_image(SIMILAR_PROMPT, 0.95))
+        self.assertIsNone(find_similar_image(UNRELATED_PROMPT, 0.1))
+        self.assertIsNone(find_similar_image("", 0.1))
+
+    def test_placeholders_and_test_images_are_not_indexed(self):
+        for source in (Image.Source.PLACEHOLDER, Image.Source.TEST):
+            with self.subTest(source=source):
+                image = self.image(PROMPT, source)
+                self.assertFalse(ImagePromptBand.objects.filter(image=image).exists())
+                self.assertIsNone(find_similar_image(PROMPT, 0.5))
+                image.delete()
+
+    def test_index_follows_the_source_and_the_prompt(self):
+        image = self.image(PROMPT, Image.Source.PLACEHOLDER)
+        image.source = Image.Source.GENERATED
+        image.save(update_fields=["source"])
+        self.assertEqual(ImagePromptBand.objects.filter(image=image).count(), BANDS)
+        self.assertEqual(find_similar_image(PROMPT, 0.9)[0], image)
+
+        image.image_prompt = UNRELATED_PROMPT
+        image.save(update_fields=["image_prompt"])
+        self.assertIsNone(find_similar_image(PROMPT, 0.5))
+        self.assertEqual(find_similar_image(UNRELATED_PROMPT, 0.9)[0], image)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.in_text = Book.objects.create(title="Night", author="Smith", text="The lighthouse keeper slept.")
+        self.in_author = Book.objects.create(title="Storm", author="Lighthouse Press", text="Waves.")
+        self.in_title = Book.objects.create(title="The Lighthouse", author="Brown", text="Waves.")
+
+    def test_ranking(self):
+        self.assertEqual(
+            search.search_book_ids("lighthouse"), [self.in_title.pk, self.in_author.pk, self.in_text.pk],
+        )
+        self.assertEqual(search.search_book_ids("lighthouse keeper"), [self.in_text.pk])
+        self.assertEqual(search.search_book_ids("lighthouse", limit=1), [self.in_title.pk])
+
+    def test_last_word_is_a_prefix(self):
+        self.assertEqual(search.search_book_ids("keep"), [self.in_text.pk])
+        self.assertEqual(search.search_book_ids("keeper sle"), [self.in_text.pk])
+        self.assertEqual(search.search_book_ids("keep slept"), [])
+
+    def test_operators_are_plain_words(self):
+        for query in ('lighthouse AND', 'NOT lighthouse', '"lighthouse', 'NEAR(lighthouse keeper)', 'light* -house',
+                      'title:lighthouse', '(', '^lighthouse OR'):
+            with self.subTest(query=query):
+                search.search_book_ids(query)
+        self.assertEqual(len(search.search_book_ids('"lighthouse"*')), 3)
+        # Not a column filter: "title" is a word that has to be found as well
+        self.assertEqual(search.search_book_ids("title:lighthouse"), [])
+        self.assertEqual(search.search_book_ids("...!"), [])
+
+    def test_saves_and_deletes_update_the_index(self):
+        self.in_text.title = "Lantern"
+        # Not an indexed field, the index keeps the old title
+        self.in_text.save(update_fields=["degradation"])
+        self.assertEqual(search.search_book_ids("lantern"), [])
+        self.in_text.save(update_fields=["title"])
+        self.assertEqual(search.search_book_ids("lantern"), [self.in_text.pk])
+        self.in_text.delete()
+        self.assertEqual(search.search_book_ids("lantern"), [])
+
+    def test_image_prompts(self):
+        image = Image.objects.create(book=self.in_title, image_prompt="A lighthouse in the fog")
+        self.assertEqual(search.search_image_ids("fog"), [image.pk])
+        image.image_prompt = "A ship"
+        image.save(update_fields=["image_prompt"])
+        self.assertEqual(search.search_image_ids("fog"), [])
+        image.delete()
+        self.assertEqual(search.search_image_ids("ship"), [])
+
+    def test_view_clamps_the_limit(self):
+        for limit, count in (("0", 1), ("-5", 1), ("2", 2), ("1000", 3), ("many", 3)):
+            with self.subTest(limit=limit):
+                response = self.client.get("/api/books/search/", {"q": "lighthouse", "limit": limit})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json()["books"]), count)
+        response = self.client.get("/api/books/search/", {"q": "lighthouse"})
+        self.assertEqual([book["id"] for book in response.json()["books"]], search.search_book_ids("lighthouse"))
+
+
+class LayoutCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        # Without the creation date and the random document id
+        self.enterContext(mock.patch.object(rl_config, "invariant", 1))
+        self.enterContext(mock.patch.object(pdf, "layout_cache", pdf.LayoutCache()))
+
+    def render(self, book_data, name):
+        path = f"{self.temp_dir}/{name}.pdf"
+        pdf.create_pdf(book_data, path)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_rebuild_is_identical_to_a_cold_render(self):
+        # Paragraphs longer than a page are split at page breaks, the pieces share the cached layout
+        content = [
+            {"type": "text", "data": " ".join(f"Sentence {index} of part {part} & <more>." for index in range(400))}
+            for part in range(3)
+        ]
+        content.insert(1, {"type": "image_prompt", "data": "A mill", "image_path": "test_images/1.jpg"})
+        content.append({"type": "text", "data": "Line one\nline two"})
+        book_data = {"title": "Mill", "author": "Author", "content": content}
+
+        cold = self.render(book_data, "cold")
+        self.assertGreater(pdf.layout_cache.size, 0)
+        warm = self.render(book_data, "warm")
+        self.assertEqual(warm, cold)
+        self.assertEqual(self.render(book_data, "again"), cold)
+
+        pdf.layout_cache.clear()
+        self.assertEqual(pdf.layout_cache.size, 0)
+        self.assertEqual(self.render(book_data, "cleared"), cold)
+
+    def test_cache_is_bounded(self):
+        cache = pdf.LayoutCache(max_bytes=100)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 30)
+        cache.get("a")
+        cache.set("c", 3, 30)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        cache.set("d", 4, 1000)
+        self.assertIsNone(cache.get("d"))
+        cache.resize(40)
+        self.assertEqual((cache.get("a"), cache.get("c"), cache.size), (None, 3, 30))
+
+
+def epub(documents, spine):
+    """
+    A minimal EPUB with the documents {id: xhtml} listed in the manifest in their order and read in the spine order.
+    """
+    manifest = "".join(f'<item id="{id_}" href="text/{id_}.xhtml" media-type="application/xhtml+xml"/>' for id_ in documents)
+    itemrefs = "".join(f'<itemref idref="{id_}"/>' for id_ in spine)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("mimetype", "application/epub+zip")
+        archive.writestr(
+            "META-INF/container.xml",
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+            '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>',
+        )
+        archive.writestr(
+            "OEBPS/content.opf",
+            f'<package xmlns="http://www.idpf.org/2007/opf" version="3.0"><manifest>{manifest}</manifest>'
+            f'<spine>{itemrefs}</spine></package>',
+        )
+        for id_, body in documents.items():
+            archive.writestr(f"OEBPS/text/{id_}.xhtml", f"<html><head><title>{id_}</title></head><body>{body}</body></html>")
+    return buffer.getvalue()
+
+
+class IngestTests(SimpleTestCase):
+    def decode(self, data, max_chars=1000, fallback_encoding="cp1251"):
+        return ingest.decode_stream(io.BytesIO(data), max_chars, fallback_encoding)
+
+    def test_boms(self):
+        text = "Глава 1\n\nТекст книги"
+        for data in (
+            b"\xef\xbb\xbf" + text.encode("utf-8"),
+            b"\xff\xfe" + text.encode("utf-16-le"),
+            b"\xfe\xff" + text.encode("utf-16-be"),
+            text.encode("utf-8"),
+        ):
+            with self.subTest(data=data[:4]):
+                self.assertEqual(self.decode(data), text)
+
+    def test_fallback_encoding(self):
+        self.assertEqual(self.decode("Глава первая".encode("cp1251")), "Глава первая")
+        self.assertEqual(self.decode("Ärger".encode("latin-1"), fallback_encoding="latin-1"), "Ärger")
+
+    def test_fallback_after_the_first_chunk(self):
+        data = b"a" * (ingest.CHUNK_SIZE + 10) + "ё".encode("cp1251")
+        self.assertEqual(self.decode(data, max_chars=ingest.CHUNK_SIZE * 2), "a" * (ingest.CHUNK_SIZE + 10) + "ё")
+
+    def test_crlf_split_between_chunks(self):
+        head = b"a" * (ingest.CHUNK_SIZE - 1)
+        text = self.decode(head + b"\r\nb\r\rc\r", max_chars=ingest.CHUNK_SIZE * 2)
+        self.assertEqual(text, "a" * (ingest.CHUNK_SIZE - 1) + "\nb\n\nc")
+
+    def test_max_chars(self):
+        self.assertEqual(self.decode(b"a" * 10, max_chars=10), "a" * 10)
+        with self.assertRaisesMessage(ValueError, "longer than 10 characters"):
+            self.decode(b"a" * 11, max_chars=10)
+        with self.assertRaisesMessage(ValueError, "longer than 10 characters"):
+            ingest.read_epub(io.BytesIO(epub({"one": "<p>" + "a" * 11 + "</p>"}, ["one"])), 10)
+
+    def test_epub_spine_order(self):
+        data = epub(
+            {
+                "second": "<h1>Chapter 2</h1><p>The end\n  of the   story.</p>",
+                "first": "<h1>Chapter 1</h1><p>Once upon &amp; a time.</p><p>Line<br/>break</p>"
+                         "<script>ignored()</script>",
+                "unread": "<p>Not in the spine</p>",
+            },
+            ["first", "second", "missing"],
+        )
+        self.assertEqual(
+            ingest.read_epub(io.BytesIO(data), 1000),
+            "Chapter 1\n\nOnce upon & a time.\n\nLine\nbreak\n\nChapter 2\n\nThe end of the story.",
+        )
+
+    def test_invalid_epub(self):
+        with self.assertRaisesMessage(ValueError, "Not a valid EPUB file"):
+            ingest.read_epub(io.BytesIO(b"not a zip"), 1000)
+
+    def test_unsupported_extension(self):
+        with self.assertRaisesMessage(ValueError, "Unsupported file type .pdf"):
+            ingest.read_book_upload(SimpleUploadedFile("book.pdf", b"%PDF"), 1000)
+
+    def test_max_size_handler_counts_chunks(self):
+        handler = ingest.MaxSizeUploadHandler(10)
+        handler.handle_raw_input(None, {}, None, None)
+        self.assertEqual(handler.receive_data_chunk(b"a" * 6, 0), b"a" * 6)
+        with self.assertRaises(ingest.UploadTooLarge):
+            handler.receive_data_chunk(b"a" * 6, 6)
+
+
+class UploadBookTests(MediaTestCase):
+    def upload(self, name, data, client=None, **fields):
+        return (client or self.client).post(
+            "/api/books/upload/", {"file": SimpleUploadedFile(name, data), "structuring": "local", **fields},
+        )
+
+    def test_txt_upload(self):
+        text = "Глава 1\r\n\r\n" + "Долгая ночь в лесу. " * 200
+        response = self.upload("book.txt", text.encode("cp1251"), title="Лес")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+        book = Book.objects.get(pk=response["X-Book-Id"])
+        self.assertEqual((book.title, book.text), ("Лес", text.replace("\r\n", "\n").strip()))
+
+    def test_epub_upload(self):
+        data = epub({"one": "<h1>Chapter 1</h1><p>" + "It was a quiet night. " * 50 + "</p>"}, ["one"])
+        response = self.upload("book.epub", data, export_format="html")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Book.objects.get(pk=response["X-Book-Id"]).text.startswith("Chapter 1\n\nIt was"))
+
+    def test_invalid_uploads(self):
+        self.assertEqual(self.client.post("/api/books/upload/", {"title": "No file"}).status_code, 400)
+        self.assertEqual(self.upload("book.pdf", b"%PDF").status_code, 400)
+        self.assertEqual(self.upload("book.txt", b"   \n").status_code, 400)
+        with override_settings(BOOK_TEXT_MAX_CHARS=10):
+            response = self.upload("book.txt", b"a" * 11)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("longer than 10 characters", response.json()["file"][0])
+        self.assertFalse(Book.objects.exists())
+
+    @override_settings(BOOK_UPLOAD_MAX_BYTES=1000)
+    def test_too_large_upload(self):
+        self.assertEqual(self.upload("book.txt", b"a" * 2000).status_code, 413)
+
+    @override_settings(BOOK_UPLOAD_MAX_BYTES=1000)
+    def test_too_large_upload_of_a_session_user(self):
+        # The CSRF check of SessionAuthentication reads the body before the action runs
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(User.objects.create_user("reader"))
+        client.cookies[settings.CSRF_COOKIE_NAME] = "a" * 32
+        self.assertEqual(self.upload("book.txt", b"a" * 2000, client=client).status_code, 413)
+
+
+def image_bytes(mode, size=(40, 20), pil_format="PNG", color=None, **params):
+    output = io.BytesIO()
+    PILImage.new(mode, size, color).save(output, format=pil_format, **params)
+    return output.getvalue()
+
+
+def decoded(data):
+    img = PILImage.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+class NormalizeImageTests(SimpleTestCase):
+    def test_target_format_and_size_is_kept_as_is(self):
+        for data, storage_format in (
+            (image_bytes("RGB", pil_format="PNG"), "png"),
+            (image_bytes("RGB", pil_format="JPEG"), "jpeg"),
+            (image_bytes("RGB", pil_format="WEBP"), "webp"),
+            (image_bytes("RGB", pil_format="PNG"), "original"),
+        ):
+            with self.subTest(storage_format=storage_format):
+                stored, _ = normalize_image(data, storage_format, max_dimension=40)
+                self.assertIs(stored, data)
+
+    def test_conversion_and_extension(self):
+        data = image_bytes("RGB", color=(200, 10, 10))
+        for storage_format, pil_format, extension in (
+            ("jpeg", "JPEG", ".jpg"), ("webp", "WEBP", ".webp"), ("original", "PNG", ".png"),
+        ):
+            with self.subTest(storage_format=storage_format):
+                stored, stored_extension = normalize_image(data, storage_format)
+                self.assertEqual((decoded(stored).format, stored_extension), (pil_format, extension))
+
+    def test_downscale(self):
+        stored, _ = normalize_image(image_bytes("RGB", size=(400, 100)), "png", max_dimension=100)
+        self.assertEqual(decoded(stored).size, (100, 25))
+
+    def test_cmyk(self):
+        data = image_bytes("CMYK", pil_format="JPEG", color=(0, 255, 255, 0))
+        for storage_format, pil_format in (("png", "PNG"), ("webp", "WEBP")):
+            with self.subTest(storage_format=storage_format):
+                img = decoded(normalize_image(data, storage_format)[0])
+                self.assertEqual((img.format, img.mode), (pil_format, "RGB"))
+                red, green, blue = img.getpixel((0, 0))
+                self.assertGreater(red, 200)
+                self.assertLess(max(green, blue), 60)
+
+    def test_transparency_is_kept(self):
+        for mode, color in (("RGBA", (255, 0, 0, 0)), ("LA", (255, 0))):
+            data = image_bytes(mode, color=color)
+            for storage_format in ("png", "webp"):
+                with self.subTest(mode=mode, storage_format=storage_format):
+                    img = decoded(normalize_image(data, storage_format)[0])
+                    self.assertTrue(img.has_transparency_data)
+                    self.assertEqual(img.convert("RGBA").getpixel((0, 0))[3], 0)
+
+    def test_palette_transparency_is_kept(self):
+        img = PILImage.new("P", (10, 10), 0)
+        output = io.BytesIO()
+        img.save(output, format="PNG", transparency=0)
+        stored = decoded(normalize_image(output.getvalue(), "webp")[0])
+        self.assertEqual(stored.convert("RGBA").getpixel((0, 0))[3], 0)
+
+    def test_transparency_is_white_in_jpeg(self):
+        img = decoded(normalize_image(image_bytes("RGBA", color=(255, 0, 0, 0)), "jpeg")[0])
+        self.assertEqual(img.mode, "RGB")
+        self.assertTrue(all(channel > 245 for channel in img.getpixel((0, 0))))
+
+    def test_broken_data(self):
+        data = image_bytes("RGB", size=(200, 200), pil_format="PNG")
+        for broken in (b"", b"not an image", data[: len(data) // 2]):
+            with self.subTest(broken=broken[:10]):
+                with self.assertRaisesMessage(ValueError, "Not a valid image"):
+                    normalize_image(broken, "jpeg")
+
+
+class ImageMetadataTests(MediaTestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title="Sea", text="Text")
+        self.image = Image(book=self.book, image_prompt="A ship")
+        self.image.illustration.save("ship.png", ContentFile(image_bytes("RGB", size=(40, 20))))
+
+    def stored(self):
+        return Image.objects.values_list(*Image.METADATA_FIELDS).get(pk=self.image.pk)
+
+    def test_metadata_is_stored(self):
+        width, height, file_size, image_format, content_hash = self.stored()
+        self.assertEqual((width, height, image_format), (40, 20, "png"))
+        self.assertEqual(file_size, self.image.illustration.size)
+        self.assertEqual(len(content_hash), 64)
+
+    def test_metadata_is_saved_with_update_fields(self):
+        self.image.illustration.save("ship.jpg", ContentFile(image_bytes("RGB", size=(30, 60), pil_format="JPEG")), save=False)
+        self.image.save(update_fields=["illustration"])
+        self.assertEqual(self.stored()[:3], (30, 60, self.image.illustration.size))
+
+    def test_metadata_of_an_older_row_is_filled_on_save(self):
+        Image.objects.filter(pk=self.image.pk).update(width=None, height=None, content_hash="")
+        image = Image.objects.get(pk=self.image.pk)
+        image.title = "Ship"
+        image.save(update_fields=["title"])
+        self.assertEqual(self.stored()[:2], (40, 20))
+
+    def test_missing_file_is_saved_without_metadata(self):
+        self.image.illustration.storage.delete(self.image.illustration.name)
+        Image.objects.filter(pk=self.image.pk).update(width=None, height=None, content_hash="")
+        image = Image.objects.get(pk=self.image.pk)
+        image.title = "Ship"
+        image.save()
+        self.assertEqual(Image.objects.get(pk=self.image.pk).title, "Ship")
+        self.assertEqual(self.stored()[4], "")
+
+    def test_backfill(self):
+        Image.objects.filter(pk=self.image.pk).update(width=None, height=None, file_size=None, image_format="", content_hash="")
+        call_command("backfill_image_metadata", stdout=io.StringIO())
+        self.assertEqual(self.stored()[:3], (40, 20, self.image.illustration.size))
+
+    def test_admin_does_not_decode_rows_without_metadata(self):
+        admin = site._registry[Image]
+        self.assertIn('width="40"', admin.resize_illustration(self.image))
+        self.image.illustration.storage.delete(self.image.illustration.name)
+        Image.objects.filter(pk=self.image.pk).update(width=None, height=None)
+        self.assertEqual(admin.resize_illustration(Image.objects.get(pk=self.image.pk)), "—")
+
+
+@override_settings(PROFILING_HEADER=True)
+class ProfilingMiddlewareTests(MediaTestCase):
+    url = "/api/books/search/"
+
+    def setUp(self):
+        self.staff = User.objects.create_user("admin", is_staff=True)
+
+    def get(self, user=None):
+        if user is not None:
+            self.client.force_login(user)
+        response = self.client.get(self.url, {"q": "forest"}, headers={"X-Profile": "1"})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_staff_header(self):
+        self.get(self.staff)
+        profile = RequestProfile.objects.get()
+        self.assertEqual((profile.trigger, profile.profiler), (RequestProfile.Trigger.HEADER, RequestProfile.Profiler.CPROFILE))
+        self.assertTrue(profile.file.name.endswith(".prof"))
+        self.assertIn("function calls", profile.report)
+
+    def test_header_of_other_clients_is_ignored(self):
+        self.get()
+        self.get(User.objects.create_user("reader"))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_header_is_opt_in(self):
+        with override_settings(PROFILING_HEADER=False):
+            self.get(self.staff)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    async def test_staff_header_under_asgi(self):
+        client = AsyncClient()
+        await client.aforce_login(await User.objects.acreate(username="async-admin", is_staff=True))
+        response = await client.get(self.url, {"q": "forest"}, headers={"X-Profile": "1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await RequestProfile.objects.filter(trigger=RequestProfile.Trigger.HEADER).acount(), 1)
+
+    def test_failed_save_keeps_the_response(self):
+        with mock.patch.object(RequestProfile, "save", side_effect=OSError("disk full")):
+            response = self.get(self.staff)
+        self.assertIn("books", response.json())
+        self.assertFalse(RequestProfile.objects.exists())
+        profile_dir = f"{self.media_root}/books/request_profile/file"
+        self.assertEqual(os.listdir(profile_dir) if os.path.isdir(profile_dir) else [], [])
+
+    @override_settings(PROFILING_SLOW_SECONDS=0.000001)
+    def test_slow_request_keeps_its_samples(self):
+        self.get()
+        profile = RequestProfile.objects.get()
+        self.assertEqual((profile.trigger, profile.profiler), (RequestProfile.Trigger.SLOW, RequestProfile.Profiler.SAMPLING))
@@ -1,10 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import BookViewSet
+from .views import BookViewSet, create_book_async, download_book_file
 
 router = DefaultRouter()
 router.register(r'', BookViewSet, basename='book')
 
 urlpatterns = [
+    path('async/', create_book_async, name='book-create-async'),
+    path('files/<int:pk>/download/', download_book_file, name='book-file-download'),
     path('', include(router.urls)),
 ]
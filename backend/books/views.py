@@ -1,266 +1,277 @@
-import os
 import json
-import time
-import shutil
-# from dotenv import load_dotenv
-from google import genai
-from google.genai import types
-from PIL import Image as PILImage
-import io
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.http import FileResponse
+from django.http import FileResponse, Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST, require_safe
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 
-from .models import Book, BookLlm, BookFile, Image
-from .serializers import BookSerializer
+from .deadline import Deadline
+from .download import file_response
+from .export import export_book
+from .generation import (
+    generate_book, agenerate_book, draft_book, adraft_book, finish_book_in_background, afinish_book_in_background,
+)
+from .ingest import MaxSizeUploadHandler, UploadTooLarge, read_book_upload
+from .models import Book, BookFile, Image
+from .scheduling import QuotaExceeded, client_key, scheduler
+from . import search
+from .serializers import (
+    BookSerializer, BookExportSerializer, BookFileSerializer, BookSearchSerializer, ImageSearchSerializer,
+)
+from .structuring import estimated_illustrations
 
 
-client = genai.Client(api_key=settings.GEMINI_API_KEY)
+def get_deadline(serializer):
+    latency_budget = serializer.validated_data.pop('latency_budget', None)
+    return Deadline(latency_budget) if latency_budget else None
 
 
-def get_book_content_with_markers(text):
-    """
-    Sends text to Gemini and receives a structured list of blocks (text and illustration prompts).
-    """
-    print("🚀 Analyzing the book text and placing markers for illustrations...")
-
-    prompt = f"""
-    Analyze the following text and turn it into a structure for an illustrated book.
-    Divide the text into logical parts. Between the parts of the text, add descriptions for illustrations that best fit that moment.
-
-    Return the response ONLY in JSON format:
-    {{
-      "title": "Book Title",
-      "author": "Author",
-      "content": [
-        {{"type": "text", "data": "A piece of text..."}},
-        {{"type": "image_prompt", "data": "A detailed description of what should be in the picture for this moment..."}},
-        {{"type": "text", "data": "The next piece of text..."}}
-      ]
-    }}
-
-    Make at least 5-7 illustrations for this book. The descriptions for the images (image_prompt) should be in English for better generation.
-
-    Text:
-    {text}
-    """
-
-    # Trying available models
-    models_to_try = ["gemini-2.5-flash", "gemini-flash-latest", "gemini-2.0-flash"]
-
-    for model_name in models_to_try:
-        try:
-            print(f"  - We use the model {model_name}...")
-            response = client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    temperature=0.7
-                )
-            )
-            return json.loads(response.text)
-        except Exception as e:
-            print(f"  ⚠️ Error with {model_name}: {e}")
-            if "429" in str(e):
-                print("  ⌛ Limit reached, wait 10 seconds...")
-                time.sleep(10)
-            else:
-                continue
-
-    raise Exception("Unable to get a response from any of the Gemini models.")
+def quota_exceeded_response(error, response_class=Response):
+    response = response_class(
+        {"error": str(error), "retry_after": error.retry_after}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+    )
+    response['Retry-After'] = error.retry_after
+    return response
 
 
-def generate_images(book, book_data):
-    """
-    Iterates through the content, finds image_prompt, generates images,
-    and saves them to the Image model.
-    """
-    print("🎨 Generating illustrations...")
-
-    image_count = 0
-    for item in book_data.get("content", []):
-        if item["type"] == "image_prompt":
-            prompt = item["data"]
-            image_count += 1
-            print(f"  - Generating a picture {image_count}: {prompt[:50]}...")
-
-            image_models = ["gemini-2.5-flash-image"]
-
-            for img_model in image_models:
-                try:
-                    print(f"    - Trying with {img_model}...")
-                    resp_alt = client.models.generate_content(
-                        model=img_model,
-                        contents=[prompt]
-                    )
-                    if resp_alt.candidates and resp_alt.candidates[0].content.parts:
-                        for part in resp_alt.candidates[0].content.parts:
-                            if part.inline_data:
-                                image_bytes = part.inline_data.data
-                                image_name = f"gen_{book.id}_{image_count}.png"
-
-                                # Create an Image object and save it
-                                image_instance = Image(
-                                    book=book,
-                                    image_prompt=prompt
-                                )
-                                image_instance.illustration.save(image_name, ContentFile(image_bytes), save=True)
-
-                                # Add the path to the saved file to book_data
-                                item["image_path"] = image_instance.illustration.path
-                                print(f"    ✅ Image saved to model: {image_instance.illustration.name}")
-                                break  # Exit the loop over models, as the image was successfully generated
-                except Exception as e:
-                    print(f"    ❌ Error with {img_model}: {e}")
-
-    return book_data
-
-
-def create_pdf(book_data, output_filename="generated_book.pdf"):
-    """
-    Creates a PDF file based on the received data.
-    """
-    print(f"📚 Create a PDF: {output_filename}...")
-    doc = SimpleDocTemplate(output_filename, pagesize=letter)
-    styles = getSampleStyleSheet()
-
-    # Font setup
-    font_path = "DejaVu_Sans/DejaVuSans.ttf"
-    if os.path.exists(font_path):
-        pdfmetrics.registerFont(TTFont('DejaVuSans', font_path))
-        font_name = 'DejaVuSans'
-    else:
-        font_name = 'Helvetica'
-
-    styles.add(ParagraphStyle(name='BookText', fontName=font_name, fontSize=14, leading=18, spaceAfter=12))
-    styles.add(ParagraphStyle(name='BookTitle', fontName=font_name, fontSize=28, alignment=1, spaceAfter=30))
-    styles.add(ParagraphStyle(name='BookAuthor', fontName=font_name, fontSize=18, alignment=1, spaceAfter=50))
-
-    story = []
-
-    # Title page
-    story.append(Spacer(1, 2 * inch))
-    story.append(Paragraph(book_data.get("title", "Book"), styles['BookTitle']))
-    story.append(Paragraph(book_data.get("author", ""), styles['BookAuthor']))
-    story.append(PageBreak())
-
-    # Main content
-    for item in book_data.get("content", []):
-        if item["type"] == "text":
-            text_data = item["data"].replace("\n", "<br/>")
-            story.append(Paragraph(text_data, styles['BookText']))
-        elif item["type"] == "image_prompt" and "image_path" in item:
-            img_path = item["image_path"]
-            if os.path.exists(img_path):
-                img = RLImage(img_path, width=5.5*inch, height=5.5*inch, kind='proportional')
-                story.append(img)
-                story.append(Spacer(1, 12))
-
-    doc.build(story)
-    print(f"✨ PDF is ready: {output_filename}")
+def book_file_response(book, book_file):
+    response = FileResponse(book_file.file, as_attachment=True, filename=f"generated_book_{book.id}.{book_file.format}")
+    # Draft while the final file is still being illustrated, see BookViewSet.files
+    response['X-Book-Id'] = book.id
+    response['X-Book-Status'] = book_file.status
+    return response
 
 
 class BookViewSet(viewsets.ModelViewSet):
     queryset = Book.objects.all()
     serializer_class = BookSerializer
 
+    def initialize_request(self, request, *args, **kwargs):
+        api_request = super().initialize_request(request, *args, **kwargs)
+        if self.action == 'upload':
+            # Before authentication: the CSRF check of session users already parses the body
+            request.upload_handlers.insert(0, MaxSizeUploadHandler(settings.BOOK_UPLOAD_MAX_BYTES, request))
+        return api_request
+
+    def handle_exception(self, exc):
+        if isinstance(exc, UploadTooLarge):
+            return Response({"error": str(exc)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        return super().handle_exception(exc)
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
+        return self.generate(serializer)
+
+    def generate(self, serializer):
+        """
+        Saves the book of a validated request and returns its generated file.
+        The generation waits for a slot of the fair scheduler, beyond the quotas of the client it gets 429.
+        """
         serializer.is_valid(raise_exception=True)
+        export_format = serializer.validated_data.pop('export_format')
+        deadline = get_deadline(serializer)
+        structuring = serializer.validated_data.pop('structuring')
+        draft = serializer.validated_data.pop('draft')
+        try:
+            lease = scheduler.acquire(
+                client_key(self.request), estimated_illustrations(serializer.validated_data['text']),
+            )
+        except QuotaExceeded as e:
+            return quota_exceeded_response(e)
         self.perform_create(serializer)
 
         book = serializer.instance
 
+        in_background = False
         try:
-            print("Step 1: Getting book content with markers")
-            # 1. We get the structure
-            book_data = get_book_content_with_markers(book.text)
-            book_llm_instance = BookLlm.objects.create(
-                book=book,
-                text=json.dumps(book_data, ensure_ascii=False, indent=2)
-            )
-            print("Step 1 finished")
-
-            if settings.USE_TEST_IMAGES:
-                print("Step 2: Using test images")
-                test_images_dir = 'test_images'
-                image_paths = [os.path.join(test_images_dir, f) for f in os.listdir(test_images_dir) if
-                               f.endswith(('.png', '.jpg', '.jpeg'))]
-                print(f"Found {len(image_paths)} test images.")
-
-                image_index = 0
-                for item in book_data.get("content", []):
-                    if item["type"] == "image_prompt":
-                        if image_index < len(image_paths):
-                            source_path = image_paths[image_index]
-                            filename = os.path.basename(source_path)
-
-                            # Create an Image instance, but don't save it to the DB yet
-                            image_instance = Image(book=book, image_prompt=item["data"])
-
-                            # Copy the file to media and save it in the ImageField
-                            with open(source_path, 'rb') as f:
-                                image_instance.illustration.save(filename, ContentFile(f.read()), save=True)
-
-                            item["image_path"] = image_instance.illustration.path
-                            print(f"    ✅ Test image saved to model: {image_instance.illustration.name}")
-
-                            image_index = (image_index + 1) % len(image_paths)  # Use images cyclically
-                book_data_with_images = book_data
-                book_llm_instance.text = json.dumps(book_data_with_images, ensure_ascii=False, indent=2)
-                book_llm_instance.save()
-                print("Step 2 finished")
+            if draft:
+                book_file, finish_args = draft_book(book, export_format, deadline, structuring)
+                # The slot is held until the final version is ready
+                finish_book_in_background(*finish_args, done=lease.release)
+                in_background = True
             else:
-                print("Step 2: Generating and saving images")
-                # 2. Generate and save images
-                book_data_with_images = generate_images(book, book_data)
-                # Update the BookLlm record with image paths
-                # book_llm_instance = BookLlm.objects.get(book=book)
-                book_llm_instance.text = json.dumps(book_data_with_images, ensure_ascii=False, indent=2)
-                book_llm_instance.save()
-                print("Step 2 finished")
-
-            print("Step 3: Creating PDF")
-            # 3. Create PDF
-            pdf_filename = f"generated_book_{book.id}.pdf"
-            # Create a temporary directory if it doesn't exist
-            temp_dir = os.path.join(settings.BASE_DIR, 'tmp')
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_pdf_path = os.path.join(temp_dir, pdf_filename)
-
-            create_pdf(book_data_with_images, temp_pdf_path)
-            print("Step 3 finished")
-
-            print("Step 4: Saving PDF to model")
-            if os.path.exists(temp_pdf_path):
-                with open(temp_pdf_path, 'rb') as f:
-                    book_file = BookFile(book=book)
-                    book_file.file.save(pdf_filename, f)
-                    book_file.save()
-                print("Step 4 finished")
-
-                print("Step 5: Returning PDF from media")
-                response = FileResponse(book_file.file, as_attachment=True, filename=pdf_filename)
-
-                # 6. Remove the temporary file
-                os.remove(temp_pdf_path)
-                print("Step 6: Temporary PDF file removed")
-
-                return response
-            else:
-                print("Error: PDF file not found.")
-                return Response({"error": "PDF file not found."}, status=status.HTTP_404_NOT_FOUND)
+                book_file = generate_book(book, export_format, deadline, structuring)
+            print("Step 4: Returning the book file from media")
+            return book_file_response(book, book_file)
 
         except Exception as e:
             print(f"An error occurred: {e}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        finally:
+            if not in_background:
+                lease.release()
+
+    @action(detail=False, methods=['post'], parser_classes=[MultiPartParser])
+    def upload(self, request):
+        """
+        Creates a book from a .txt, .md or .epub file in the "file" field,
+        the other fields are the same as for create. Large files are streamed
+        to a temporary file and decoded in chunks instead of being sent as a JSON string.
+        """
+        # Beyond BOOK_UPLOAD_MAX_BYTES the handler installed by initialize_request answers 413
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"file": ["No file was submitted."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            text = read_book_upload(upload, settings.BOOK_TEXT_MAX_CHARS, settings.BOOK_UPLOAD_FALLBACK_ENCODING)
+        except ValueError as e:
+            return Response({"file": [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            # Removes the temporary file of a large upload
+            upload.close()
+
+        data = request.POST.dict()
+        data['text'] = text
+        return self.generate(self.get_serializer(data=data))
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over ?q= in book titles, authors and texts and in illustration prompts,
+        the best matches first.
+        """
+        query = request.query_params.get('q', '')
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+        except ValueError:
+            limit = 20
+        book_ids = search.search_book_ids(query, limit)
+        image_ids = search.search_image_ids(query, limit)
+        # in_bulk loses the ranking order
+        books = Book.objects.only('id', 'title', 'author', 'created').in_bulk(book_ids)
+        images = Image.objects.in_bulk(image_ids)
+        context = {'request': request}
+        return Response({
+            "books": BookSearchSerializer([books[pk] for pk in book_ids if pk in books], many=True, context=context).data,
+            "images": ImageSearchSerializer([images[pk] for pk in image_ids if pk in images], many=True, context=context).data,
+        })
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Returns the book in the format from ?export_format=pdf|epub|html,
+        reusing an already exported file of the same content.
+        """
+        book = self.get_object()
+        serializer = BookExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        book_llm = book.llm_texts.order_by('-created').first()
+        if book_llm is None:
+            return Response({"error": "The book has no structured text yet."}, status=status.HTTP_404_NOT_FOUND)
+
+        book_file = export_book(book, json.loads(book_llm.text), serializer.validated_data['export_format'])
+        return book_file_response(book, book_file)
+
+    @action(detail=True, methods=['get'])
+    def files(self, request, pk=None):
+        """
+        Lists the files of the book, newest first: drafts and final versions.
+        """
+        book = self.get_object()
+        book_files = book.files.exclude(file='').order_by('-created')
+        return Response(BookFileSerializer(book_files, many=True, context={'request': request}).data)
+
+
+def check_api_access(request, action='create'):
+    """
+    Runs the authentication, permission and throttle checks of a BookViewSet action on a plain Django request.
+    Returns the DRF request, and the rendered error response when the request is refused, else None.
+    """
+    view = BookViewSet(action_map={request.method.lower(): action}, args=(), kwargs={}, format_kwarg=None)
+    view.request = api_request = view.initialize_request(request)
+    view.headers = view.default_response_headers
+    try:
+        view.initial(api_request)
+    except APIException as e:
+        return api_request, view.finalize_response(api_request, view.handle_exception(e)).render()
+    return api_request, None
+
+
+@csrf_exempt
+@require_POST
+async def create_book_async(request):
+    """
+    Async counterpart of BookViewSet.create for ASGI servers (core.asgi), with the same
+    authentication, permissions and throttling. While a book waits for Gemini the worker keeps serving other books.
+    """
+    # Sessions and users are loaded from the database
+    api_request, refused = await sync_to_async(check_api_access)(request)
+    if refused is not None:
+        return refused
+
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
+    except ValueError as e:
+        return JsonResponse({"error": f"Invalid JSON: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = BookSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    export_format = serializer.validated_data.pop('export_format')
+    deadline = get_deadline(serializer)
+    structuring = serializer.validated_data.pop('structuring')
+    draft = serializer.validated_data.pop('draft')
+    try:
+        lease = await scheduler.aacquire(
+            client_key(api_request), estimated_illustrations(serializer.validated_data['text']),
+        )
+    except QuotaExceeded as e:
+        return quota_exceeded_response(e, JsonResponse)
+    book = await Book.objects.acreate(**serializer.validated_data)
+
+    in_background = False
+    try:
+        if draft:
+            book_file, finish_args = await adraft_book(book, export_format, deadline, structuring)
+            afinish_book_in_background(*finish_args, done=lease.release)
+            in_background = True
+        else:
+            book_file = await agenerate_book(book, export_format, deadline, structuring)
+        print("Step 4: Returning the book file from media")
+        await sync_to_async(book_file.file.open)('rb')
+        return book_file_response(book, book_file)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    finally:
+        if not in_background:
+            lease.release()
+
+
+def book_file_etag(request, pk):
+    book_file = BookFile.objects.exclude(file='').filter(pk=pk).first()
+    if book_file is None:
+        return None
+    # Files saved before content hashes were stored
+    if not book_file.content_hash:
+        try:
+            book_file.update_content_hash()
+        except FileNotFoundError:
+            # download_book_file answers 404
+            return None
+        book_file.save(update_fields=['content_hash'])
+    return book_file.content_hash
+
+
+@require_safe
+@condition(etag_func=book_file_etag)
+def download_book_file(request, pk):
+    """
+    Downloads a BookFile with Range and ETag (If-None-Match, If-Range) support.
+    With SENDFILE_BACKEND the transfer is left to the front proxy.
+    """
+    book_file = get_object_or_404(BookFile.objects.exclude(file=''), pk=pk)
+    if not book_file.file.storage.exists(book_file.file.name):
+        raise Http404("The file of the book is missing")
+    filename = f"generated_book_{book_file.book_id}.{book_file.format}"
+    return file_response(request, book_file.file, filename, book_file.content_hash)
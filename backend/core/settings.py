@@ -81,6 +81,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'books.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'core.urls'
@@ -174,5 +175,66 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '*** GEMINI_API_KEY DOES NOT EXIST ***')
 USE_TEST_IMAGES = os.getenv('USE_TEST_IMAGES', 'False').lower() in ('true', '1', 't')
+# Books with at least PDF_PARALLEL_MIN_ITEMS content blocks are rendered by PDF_RENDER_WORKERS processes
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_MIN_ITEMS = int(os.getenv('PDF_PARALLEL_MIN_ITEMS', 200))
+# Memory budget of the in-process cache of laid out paragraphs, reused when a book is rebuilt
+PDF_LAYOUT_CACHE_BYTES = int(os.getenv('PDF_LAYOUT_CACHE_BYTES', 64 * 1024 * 1024))
+# Fallback models are ordered by latency and error rate over the last MODEL_STATS_WINDOW calls.
+# With MODEL_HEDGING a call slower than the p95 of its model is duplicated to the next model.
+MODEL_STATS_WINDOW = int(os.getenv('MODEL_STATS_WINDOW', 50))
+MODEL_STATS_MIN_SAMPLES = int(os.getenv('MODEL_STATS_MIN_SAMPLES', 10))
+MODEL_HEDGING = os.getenv('MODEL_HEDGING', 'False').lower() in ('true', '1', 't')
+# Illustrations of one book requested at the same time by the async endpoint
+IMAGE_GENERATION_CONCURRENCY = int(os.getenv('IMAGE_GENERATION_CONCURRENCY', 4))
+# Requests with latency_budget: seconds kept for rendering, assumed seconds per picture
+# until the image model is measured, and what replaces pictures that do not fit
+# into the budget: 'placeholder', 'test_images' or 'skip'
+DEADLINE_RENDER_RESERVE = float(os.getenv('DEADLINE_RENDER_RESERVE', 5))
+DEADLINE_IMAGE_ESTIMATE = float(os.getenv('DEADLINE_IMAGE_ESTIMATE', 20))
+DEADLINE_SUBSTITUTE = os.getenv('DEADLINE_SUBSTITUTE', 'placeholder')
+# Structure the book with local heuristics when no Gemini model answers
+LOCAL_STRUCTURING_FALLBACK = os.getenv('LOCAL_STRUCTURING_FALLBACK', 'True').lower() in ('true', '1', 't')
+# Book file downloads are sent by the front proxy with SENDFILE_BACKEND = 'x-accel-redirect' (nginx,
+# the internal location SENDFILE_URL aliases MEDIA_ROOT) or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+SENDFILE_BACKEND = os.getenv('SENDFILE_BACKEND', '')
+SENDFILE_URL = os.getenv('SENDFILE_URL', '/protected/media/')
+# Limits of book uploads (POST /api/books/upload/) and the encoding of text files that are not UTF-8
+BOOK_UPLOAD_MAX_BYTES = int(os.getenv('BOOK_UPLOAD_MAX_BYTES', 50 * 1024 * 1024))
+BOOK_TEXT_MAX_CHARS = int(os.getenv('BOOK_TEXT_MAX_CHARS', 10 * 1000 * 1000))
+BOOK_UPLOAD_FALLBACK_ENCODING = os.getenv('BOOK_UPLOAD_FALLBACK_ENCODING', 'cp1251')
+# Illustrations of prompts at least IMAGE_REUSE_THRESHOLD similar (estimated Jaccard of prompt words)
+# to an existing one: 'off', 'suggest' (noted in the structured text) or 'auto' (copied instead of generated)
+IMAGE_REUSE = os.getenv('IMAGE_REUSE', 'suggest')
+IMAGE_REUSE_THRESHOLD = float(os.getenv('IMAGE_REUSE_THRESHOLD', 0.8))
+# Profiling of requests under PROFILING_PATH_PREFIX (books.profiling): with the X-Profile header of staff users when
+# PROFILING_HEADER is on, and a PROFILING_SAMPLE_RATE share of requests, with cProfile and tracemalloc. Requests slower than
+# PROFILING_SLOW_SECONDS (0 turns it off) keep the stacks sampled every PROFILING_SAMPLE_INTERVAL seconds
+PROFILING_PATH_PREFIX = os.getenv('PROFILING_PATH_PREFIX', '/api/')
+PROFILING_HEADER = os.getenv('PROFILING_HEADER', 'False').lower() in ('true', '1', 't')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_SLOW_SECONDS = float(os.getenv('PROFILING_SLOW_SECONDS', 120))
+PROFILING_SAMPLE_INTERVAL = float(os.getenv('PROFILING_SAMPLE_INTERVAL', 0.01))
+PROFILING_MAX_PROFILES = int(os.getenv('PROFILING_MAX_PROFILES', 500))
+# Books regenerated at the same time by the admin actions and the regenerate_books command
+REGENERATION_WORKERS = int(os.getenv('REGENERATION_WORKERS', 4))
+# Fair sharing of book generation between API clients (books.scheduling): GENERATION_SLOTS books are generated
+# at once per process, a client may have GENERATION_CLIENT_MAX_BOOKS books running or queued and generate
+# GENERATION_CLIENT_IMAGES_PER_MINUTE illustrations (0 for no limit). Weights look like "user:editor=2,ip:10.0.0.7=0.5"
+GENERATION_SLOTS = int(os.getenv('GENERATION_SLOTS', 4))
+GENERATION_CLIENT_MAX_BOOKS = int(os.getenv('GENERATION_CLIENT_MAX_BOOKS', 3))
+GENERATION_CLIENT_IMAGES_PER_MINUTE = int(os.getenv('GENERATION_CLIENT_IMAGES_PER_MINUTE', 60))
+GENERATION_CLIENT_WEIGHTS = os.getenv('GENERATION_CLIENT_WEIGHTS', '')
+GENERATION_QUEUE_TIMEOUT = float(os.getenv('GENERATION_QUEUE_TIMEOUT', 60))
+# Proxies in front of the server that append to X-Forwarded-For, 0 to account anonymous clients by REMOTE_ADDR
+GENERATION_TRUSTED_PROXIES = int(os.getenv('GENERATION_TRUSTED_PROXIES', 0))
+# Generated illustrations are validated and stored as IMAGE_STORAGE_FORMAT: 'jpeg' (embedded into PDFs without
+# re-encoding), 'webp', 'png' or 'original', at most IMAGE_MAX_DIMENSION px on the longer side (0 for no limit).
+# IMAGE_KEEP_ORIGINAL also stores the picture as generated. Conversion runs in IMAGE_INGEST_WORKERS threads
+IMAGE_STORAGE_FORMAT = os.getenv('IMAGE_STORAGE_FORMAT', 'jpeg')
+IMAGE_STORAGE_QUALITY = int(os.getenv('IMAGE_STORAGE_QUALITY', 85))
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 0))
+IMAGE_KEEP_ORIGINAL = os.getenv('IMAGE_KEEP_ORIGINAL', 'False').lower() in ('true', '1', 't')
+IMAGE_INGEST_WORKERS = int(os.getenv('IMAGE_INGEST_WORKERS', 2))
 print(f'Your GEMINI_API_KEY: {GEMINI_API_KEY}')
 print(f'USE_TEST_IMAGES: {USE_TEST_IMAGES}')
\ No newline at end of file
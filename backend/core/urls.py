@@ -3,12 +3,9 @@ from django.urls import path, include
 from django.conf.urls.static import static
 from django.conf import settings
 
-
-from books.urls import router as books_router
-
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/books/', include(books_router.urls)),
+    path('api/books/', include('books.urls')),
 ]
 
 